@@ -0,0 +1,821 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright (c) 2012, Polar Mobile.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name Polar Mobile nor the names of its contributors
+#     may be used to endorse or promote products derived from this software
+#     without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL POLAR MOBILE BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Used to time the benchmarks.
+from time import time
+
+# Used to run the benchmarks from several threads at once.
+from threading import Thread
+
+# Used to select the benchmarks from the command line.
+from sys import argv
+
+# Used to measure the memory used by the benchmarks.
+from os import sysconf
+
+# Used to measure worker processes sharing the SQLite storage.
+from os import fork, waitpid, _exit
+from traceback import print_exc
+from resource import getrusage, RUSAGE_SELF
+from gc import collect
+
+# Used to benchmark the journaled storage in a temporary directory.
+from tempfile import mkdtemp
+from shutil import rmtree
+from os.path import join
+from uuid import uuid4
+from publisher.storage import MemoryStorage, JournaledStorage, SQLiteStorage
+
+# Used to benchmark loading a catalog of users.
+from publisher.loader import load_users
+
+# The model is the subject of most benchmarks.
+import publisher.model
+from publisher.model import model
+
+# Used to compare itty's routing with the dispatcher. Importing the server
+# registers the itty routes.
+import publisher.server
+from itty import Request, find_matching_url, handle_request
+from publisher.utils import check_base_url, error_report, encode_error
+from publisher.dispatch import normalize, resolve, application, failure
+from StringIO import StringIO
+from json import dumps
+
+# Used to compare raised errors with returned errors.
+from itty import RequestError
+from publisher.validate import validate_result
+from publisher.constants import SESSION_AUTHORIZATION_HEADER
+from publisher.constants import DIRECTORY_CONNECTIONS
+
+# Used to benchmark 401 responses.
+from re import match
+from publisher.errors import unauthorized
+from publisher.utils import raise_error, JsonUnauthorized
+from publisher.constants import AUTH, VALIDATE, AUTH_AUTHORIZATION_HEADER
+
+# Used to compare the json codecs.
+from publisher.codec import load_codec
+from publisher.products import ProductList
+
+# Used to benchmark persistent connections to the event driven front end.
+from publisher.frontend import Frontend
+from httplib import HTTPConnection
+
+# Used to measure the cost of verifying hashed passwords.
+from publisher.passwords import hash_password, VerifierPool, CredentialCache
+
+# Used to measure the cost of limiting attempts to log in.
+import publisher.throttle
+from publisher.throttle import TokenBuckets
+from publisher.auth import auth_result
+
+# Used to compare the compiled auth body schema with the separate checks.
+from publisher.auth import (auth_body_error, device_error, auth_params_error,
+                            publisher_auth_params_error)
+
+# Used to measure the cost of looking users up in an external directory.
+from publisher.directory import UserDirectory, FakeDirectory
+
+
+def add_users(count, products=('product01', 'product02')):
+    '''
+    Resets the model and fills it with the given number of valid test users.
+    The users are named user0, user1 and so on, and their password is "test".
+    '''
+    model.storage = None
+    storage = model().storage
+    for index in range(count):
+        storage.add_user('user%d' % index, 'test', True, products)
+
+
+def report(name, count, elapsed):
+    '''
+    Prints the result of a benchmark in operations per second.
+    '''
+    rate = count / elapsed if elapsed > 0 else float('inf')
+    print('%-40s %10d ops %10.3f s %12.0f ops/s' % (name, count, elapsed,
+                                                    rate))
+
+
+def resident_memory():
+    '''
+    Returns the number of bytes of memory currently used by the process. On
+    systems without /proc, the peak memory usage is returned instead.
+    '''
+    collect()
+    try:
+        statm = open('/proc/self/statm').read().split()
+        return int(statm[1]) * sysconf('SC_PAGE_SIZE')
+    except IOError:
+        return getrusage(RUSAGE_SELF).ru_maxrss * 1024
+
+
+def benchmark_session_memory(sessions=1000000, users=100000):
+    '''
+    Measures the number of bytes used by each session stored in the model,
+    including the session record, the session index, the user's session id set
+    and the expiry heap.
+    '''
+    product = 'product01'
+    add_users(users)
+    instance = model()
+
+    before = resident_memory()
+    start = time()
+    for index in xrange(sessions):
+        instance.create_session_id('user%d' % (index % users), product)
+    elapsed = time() - start
+    after = resident_memory()
+
+    report('create_session_id', sessions, elapsed)
+    print('%-40s %10.1f bytes/session' % ('session memory',
+                                          float(after - before) / sessions))
+
+
+def benchmark_validate_threads(users=1000, requests=200000,
+                               threads=(1, 2, 4, 8)):
+    '''
+    Measures the throughput of model.validate_session as the number of threads
+    grows. Each thread validates the sessions of its own set of users, so the
+    only contention left is the lock striping itself.
+
+    Note that CPython runs one thread at a time, so on CPython the throughput
+    should stay flat rather than drop as threads are added.
+    '''
+    url = '/benchmark/'
+    product = 'product01'
+    add_users(users)
+    session_ids = [model().create_session_id('user%d' % index, product)
+                   for index in range(users)]
+
+    for count in threads:
+        # Split the session ids between the threads.
+        per_thread = requests // count
+
+        def work(offset):
+            instance = model()
+            for index in xrange(per_thread):
+                session_id = session_ids[(offset + index) % users]
+                instance.validate_session(url, session_id, product)
+
+        workers = [Thread(target=work, args=(index * users // count,))
+                   for index in range(count)]
+        start = time()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time() - start
+
+        report('validate_session, %d threads' % count, per_thread * count,
+               elapsed)
+
+
+def benchmark_session_tokens(users=1000, requests=200000):
+    '''
+    Compares the cost of creating and validating stored sessions with the cost
+    of creating and validating signed session tokens.
+    '''
+    url = '/benchmark/'
+    product = 'product01'
+
+    for tokens in (False, True):
+        name = 'tokens' if tokens else 'stored sessions'
+        publisher.model.SESSION_TOKENS = tokens
+        try:
+            add_users(users)
+            instance = model()
+
+            start = time()
+            session_ids = [instance.create_session_id('user%d' % index,
+                                                      product)
+                           for index in range(users)]
+            report('create_session_id, ' + name, users, time() - start)
+
+            start = time()
+            for index in xrange(requests):
+                session_id = session_ids[index % users]
+                instance.validate_session(url, session_id, product)
+            report('validate_session, ' + name, requests, time() - start)
+
+        finally:
+            publisher.model.SESSION_TOKENS = False
+
+
+def benchmark_recovery(sessions=1000000, users=100000, journaled=20000,
+                       threads=8):
+    '''
+    Measures how long the journaled storage takes to write a snapshot of the
+    given number of sessions and to recover them after a restart. The sessions
+    in the snapshot are created without the journal to save time, then more
+    sessions are created through the journal by several threads at once, so
+    that recovery has to replay them as well.
+    '''
+    directory = mkdtemp()
+    path = join(directory, 'journal')
+    deadline = int(time()) + 60 * 60
+    try:
+        storage = JournaledStorage(path, 0)
+        for index in xrange(users):
+            storage.add_user('user%d' % index, 'test', True, ['product01'])
+        storage.open()
+        for index in xrange(sessions):
+            MemoryStorage.create_session(storage, str(uuid4()),
+                                         'user%d' % (index % users),
+                                         'product01', deadline)
+
+        start = time()
+        storage.snapshot()
+        report('snapshot', sessions, time() - start)
+
+        # Create the journaled sessions.
+        per_thread = journaled // threads
+
+        def work(offset):
+            for index in xrange(per_thread):
+                storage.create_session(str(uuid4()),
+                                       'user%d' % ((offset + index) % users),
+                                       'product01', deadline)
+
+        workers = [Thread(target=work, args=(index * per_thread,))
+                   for index in range(threads)]
+        start = time()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        report('journaled create_session, %d threads' % threads,
+               per_thread * threads, time() - start)
+        storage.close()
+        storage = None
+
+        # Restart.
+        storage = JournaledStorage(path, 0)
+        for index in xrange(users):
+            storage.add_user('user%d' % index, 'test', True, ['product01'])
+        start = time()
+        storage.open()
+        report('recovery', len(storage.sessions), time() - start)
+        storage.close()
+
+    finally:
+        rmtree(directory)
+
+
+def benchmark_prefork(users=1000, requests=20000, workers=(1, 2, 4)):
+    '''
+    Measures the throughput of model.validate_session in several worker
+    processes sharing the SQLite storage, as prefork.py runs them. Each
+    worker validates the sessions of its own set of users.
+    '''
+    directory = mkdtemp()
+    path = join(directory, 'sessions.db')
+    url = '/benchmark/'
+    product = 'product01'
+    deadline = int(time()) + 60 * 60
+    try:
+        storage = SQLiteStorage(path)
+        session_ids = []
+        for index in xrange(users):
+            storage.add_user('user%d' % index, 'test', True, [product])
+            session_ids.append(str(uuid4()))
+            storage.create_session(session_ids[-1], 'user%d' % index,
+                                   product, deadline)
+        storage.close()
+
+        for count in workers:
+            per_worker = requests // count
+            start = time()
+            pids = []
+            for index in range(count):
+                pid = fork()
+                if pid != 0:
+                    pids.append(pid)
+                    continue
+
+                # Each worker opens the database itself, as a worker of
+                # prefork.py does.
+                code = 0
+                try:
+                    model.storage = SQLiteStorage(path)
+                    instance = model()
+                    offset = index * users // count
+                    for request in xrange(per_worker):
+                        session_id = session_ids[(offset + request) % users]
+                        instance.validate_session(url, session_id, product)
+                    model.storage.close()
+                except:
+                    print_exc()
+                    code = 1
+                _exit(code)
+
+            for pid in pids:
+                waitpid(pid, 0)
+            report('validate_session, %d processes' % count,
+                   per_worker * count, time() - start)
+
+    finally:
+        model.storage = None
+        rmtree(directory)
+
+
+def benchmark_load_users(users=1000000):
+    '''
+    Measures the time taken to load a catalog of users in each of the
+    supported formats, and the memory used by each user once loaded.
+    '''
+    directory = mkdtemp()
+    try:
+        for name in ('users.json', 'users.csv'):
+            path = join(directory, name)
+            catalog = open(path, 'wb')
+            if name.endswith('.csv'):
+                catalog.write('username,password,valid,products\n')
+                for index in xrange(users):
+                    catalog.write('user%d,test,true,product01 product02\n' %
+                                  index)
+            else:
+                for index in xrange(users):
+                    catalog.write('{"username": "user%d", "password": "test", '
+                                  '"valid": true, "products": ["product01", '
+                                  '"product02"]}\n' % index)
+            catalog.close()
+
+            storage = MemoryStorage()
+            before = resident_memory()
+            start = time()
+            load_users(storage, path)
+            elapsed = time() - start
+            after = resident_memory()
+
+            report('load_users, ' + name, users, elapsed)
+            print('%-40s %10.1f bytes/user' % ('user memory, ' + name,
+                                               float(after - before) / users))
+            storage = None
+
+    finally:
+        rmtree(directory)
+
+
+def benchmark_routing(requests=200000):
+    '''
+    Compares the cost of routing a validate request with itty, which builds a
+    request object, tries each url regex in turn and then checks the api,
+    version and format again in check_base_url, with the cost of resolving it
+    with the dispatcher. The cost of serving the whole request through each
+    wsgi application is then compared.
+    '''
+    url = '/paywallproxy/v1.0.0/json/validate/product01'
+    add_users(1)
+    session_id = model().create_session_id('user0', 'product01')
+    environment = {}
+    environment['REQUEST_METHOD'] = 'POST'
+    environment['PATH_INFO'] = url
+    environment['HTTP_AUTHORIZATION'] = \
+        'PolarPaywallProxySessionv1.0.0 session:' + session_id
+
+    def start_response(status, headers):
+        pass
+
+    start = time()
+    for index in xrange(requests):
+        request = Request(environment, start_response)
+        (pattern, route, callback), arguments = find_matching_url(request)
+        check_base_url(request.path, arguments['api'], arguments['version'],
+                       arguments['format'])
+    report('routing, itty', requests, time() - start)
+
+    start = time()
+    for index in xrange(requests):
+        resolve('POST', normalize(url))
+    report('routing, dispatcher', requests, time() - start)
+
+    for name, wsgi in (('itty', handle_request), ('dispatcher', application)):
+        start = time()
+        for index in xrange(requests):
+            environment['wsgi.input'] = StringIO('')
+            wsgi(environment, start_response)
+        report('validate request, ' + name, requests, time() - start)
+
+
+def benchmark_keep_alive(requests=10000):
+    '''
+    Compares the throughput of the event driven front end when a new
+    connection is opened for each validate request with its throughput when
+    every request is sent over the same persistent connection. The client
+    runs in the same process as the server.
+    '''
+    url = '/paywallproxy/v1.0.0/json/validate/product01'
+    add_users(1)
+    session_id = model().create_session_id('user0', 'product01')
+    headers = {}
+    headers['Authorization'] = ('PolarPaywallProxySessionv1.0.0 session:' +
+                                session_id)
+
+    frontend = Frontend('127.0.0.1', 0)
+    port = frontend.socket.getsockname()[1]
+    server = Thread(target=frontend.serve_forever)
+    server.start()
+    try:
+        start = time()
+        for index in xrange(requests):
+            connection = HTTPConnection('127.0.0.1', port)
+            connection.request('POST', url, '', headers)
+            connection.getresponse().read()
+            connection.close()
+        report('validate, new connections', requests, time() - start)
+
+        start = time()
+        connection = HTTPConnection('127.0.0.1', port)
+        for index in xrange(requests):
+            connection.request('POST', url, '', headers)
+            connection.getresponse().read()
+        connection.close()
+        report('validate, persistent connection', requests, time() - start)
+
+    finally:
+        frontend.stop()
+        server.join()
+
+
+# The benchmarks that can be run from the command line.
+def benchmark_errors(requests=200000):
+    '''
+    Compares the cost of encoding an error report with json for every request
+    with the cost of filling in a cached error template.
+    '''
+    url = '/paywallproxy/v1.0.0/json/validate/product01/'
+    code = 'SessionExpired'
+    message = 'Your session has expired. Please log back in.'
+
+    start = time()
+    for index in xrange(requests):
+        dumps(error_report(url, code, message))
+    report('error report, json', requests, time() - start)
+
+    start = time()
+    for index in xrange(requests):
+        encode_error(url, code, message)
+    report('error report, template', requests, time() - start)
+
+
+def benchmark_failures(requests=200000):
+    '''
+    Compares the cost of a failed validate request when its error is raised
+    and caught, as the check functions do, with the cost when its error is
+    returned and the response is built directly.
+    '''
+    url = '/paywallproxy/v1.0.0/json/validate/product01/'
+    environment = {}
+    environment['HTTP_AUTHORIZATION'] = \
+        'PolarPaywallProxySessionv1.0.0 session:invalid'
+
+    start = time()
+    for index in xrange(requests):
+        error, content = validate_result(url, environment, '', 'product01')
+        try:
+            raise_error(url, *error, scheme=SESSION_AUTHORIZATION_HEADER)
+        except RequestError, exception:
+            unicode(exception).encode('utf-8', 'replace')
+    report('failed validate, raised', requests, time() - start)
+
+    start = time()
+    for index in xrange(requests):
+        error, content = validate_result(url, environment, '', 'product01')
+        failure(url, error, SESSION_AUTHORIZATION_HEADER)
+    report('failed validate, returned', requests, time() - start)
+
+
+def benchmark_unauthorized(requests=200000):
+    '''
+    Compares the cost of choosing the WWW-Authenticate scheme of a 401 error
+    by matching the url against the auth and validate regexes, as errors.py
+    used to, with reading the scheme the error is tagged with. The cost of
+    generating the whole 401 response with errors.unauthorized is then
+    measured.
+    '''
+    url = '/paywallproxy/v1.0.0/json/validate/product01/'
+    environment = {}
+    environment['PATH_INFO'] = url
+
+    def start_response(status, headers):
+        pass
+
+    request = Request(environment, start_response)
+    try:
+        raise_error(url, 'SessionExpired',
+                    'Your session has expired. Please log back in.', 401,
+                    scheme=SESSION_AUTHORIZATION_HEADER)
+    except JsonUnauthorized, exception:
+        pass
+
+    start = time()
+    for index in xrange(requests):
+        if match(AUTH, request.path) != None:
+            scheme = AUTH_AUTHORIZATION_HEADER
+        elif match(VALIDATE, request.path) != None:
+            scheme = SESSION_AUTHORIZATION_HEADER
+    report('401 scheme, url regexes', requests, time() - start)
+
+    start = time()
+    for index in xrange(requests):
+        scheme = exception.scheme
+    report('401 scheme, tagged', requests, time() - start)
+
+    start = time()
+    for index in xrange(requests):
+        unauthorized(request, exception)
+    report('401 response', requests, time() - start)
+
+
+def benchmark_codecs(requests=200000):
+    '''
+    Compares each json codec installed on the auth and validate paths: the
+    auth request body is decoded, and the response is encoded from a
+    dictionary and from the response template with pre-encoded products.
+    '''
+    body = {}
+    body['device'] = {}
+    body['device']['manufacturer'] = 'test'
+    body['device']['model'] = 'test'
+    body['device']['os_version'] = 'test'
+    body['authParams'] = {}
+    body['authParams']['username'] = 'user0'
+    body['authParams']['password'] = 'password0'
+    body = dumps(body)
+    session_id = uuid4().hex
+    products = ProductList(['product01', 'product02'])
+
+    for name in ('ujson', 'simplejson', 'json'):
+        try:
+            codec = load_codec(name)
+        except ImportError:
+            print '%s is not installed' % name
+            continue
+
+        start = time()
+        for index in xrange(requests):
+            codec.loads(body)
+        report('auth body, ' + name, requests, time() - start)
+
+        start = time()
+        for index in xrange(requests):
+            result = {}
+            result['sessionKey'] = session_id
+            result['products'] = products
+            codec.dumps(result)
+        report('session response, ' + name, requests, time() - start)
+
+        start = time()
+        for index in xrange(requests):
+            '{"sessionKey": ' + codec.encode_string(session_id) + \
+                ', "products": ' + products.encoded + '}'
+        report('session template, ' + name, requests, time() - start)
+
+
+def benchmark_password_pool(users=1000, requests=400, clients=16,
+                            iterations=10000, pools=(0, 1, 2, 4, 8)):
+    '''
+    Measures the throughput of model.check_credentials for users whose
+    passwords are hashed, as the number of threads verifying passwords grows.
+    The same number of client threads log in throughout; with no pool, each
+    client verifies its own password.
+
+    The pool can only add throughput if hashlib releases the interpreter lock
+    while hashing, which it does when it is built with OpenSSL.
+    '''
+    product = 'product01'
+    add_users(users)
+    stored = hash_password('test', iterations)
+    storage = model().storage
+    for index in range(users):
+        storage.add_user('user%d' % index, stored, True, ('product01',))
+
+    per_client = requests // clients
+    previous = model.verifier
+    for size in pools:
+        model.verifier = VerifierPool(size)
+
+        def work(offset):
+            instance = model()
+            for index in xrange(per_client):
+                username = 'user%d' % ((offset + index) % users)
+                instance.check_credentials(username, 'test', product)
+
+        workers = [Thread(target=work, args=(index * users // clients,))
+                   for index in range(clients)]
+        start = time()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time() - start
+
+        model.verifier.stop()
+        report('check_credentials, %d verifiers' % size,
+               per_client * clients, elapsed)
+
+    model.verifier = previous
+
+
+def benchmark_credential_cache(users=100, requests=400, iterations=10000):
+    '''
+    Measures the throughput of model.check_credentials for users whose
+    passwords are hashed and who log in repeatedly, with the credential cache
+    disabled and enabled, and reports the hit rate of the cache.
+    '''
+    product = 'product01'
+    add_users(users)
+    stored = hash_password('test', iterations)
+    storage = model().storage
+    for index in range(users):
+        storage.add_user('user%d' % index, stored, True, ('product01',))
+
+    previous = model.credentials
+    instance = model()
+    for ttl in (0, 300):
+        model.credentials = CredentialCache(ttl)
+        start = time()
+        for index in xrange(requests):
+            instance.check_credentials('user%d' % (index % users), 'test',
+                                       product)
+        report('check_credentials, cache ttl %d' % ttl, requests,
+               time() - start)
+
+    cache = model.credentials
+    print('%-40s %10.3f hit rate %6d evictions' % ('credential cache',
+                                                   cache.hit_rate(),
+                                                   cache.evictions))
+    model.credentials = previous
+
+
+def benchmark_throttle(users=1000, requests=100000):
+    '''
+    Measures the cost the limits on attempts to log in add to each auth
+    request: first the cost of taking a token from a bucket, then the
+    throughput of auth_result with no limits and with limits high enough that
+    no request is refused.
+    '''
+    add_users(users)
+    environment = {}
+    environment['HTTP_AUTHORIZATION'] = AUTH_AUTHORIZATION_HEADER
+    environment['REMOTE_ADDR'] = '10.0.0.1'
+    bodies = [dumps({'device': {'manufacturer': 'test', 'model': 'test',
+                                'os_version': 'test'},
+                     'authParams': {'username': 'user%d' % index,
+                                    'password': 'test'}})
+              for index in range(users)]
+
+    buckets = TokenBuckets(1e9, 1e9)
+    start = time()
+    for index in xrange(requests):
+        buckets.allow('user%d' % (index % users))
+    report('token bucket', requests, time() - start)
+
+    previous = (publisher.throttle.clients, publisher.throttle.usernames)
+    url = '/paywallproxy/v1.0.0/json/auth/product01/'
+    for name, rate in (('no limits', None), ('limits', 1e9)):
+        publisher.throttle.clients = TokenBuckets(rate, 1e9)
+        publisher.throttle.usernames = TokenBuckets(rate, 1e9)
+        start = time()
+        for index in xrange(requests):
+            auth_result(url, environment, bodies[index % users], 'product01')
+        report('auth_result, ' + name, requests, time() - start)
+
+    publisher.throttle.clients, publisher.throttle.usernames = previous
+
+
+def benchmark_auth_body(requests=200000):
+    '''
+    Compares the cost of checking a decoded auth body with device_error,
+    auth_params_error and publisher_auth_params_error in turn with the cost of
+    checking it against the compiled schema, for a valid body and for a body
+    whose last authParams value is missing.
+    '''
+    valid = {'device': {'manufacturer': 'test', 'model': 'test',
+                        'os_version': 'test'},
+             'authParams': {'username': 'test', 'password': 'test'}}
+    invalid = {'device': valid['device'], 'authParams': {'username': 'test'}}
+
+    for name, body in (('valid', valid), ('invalid', invalid)):
+        start = time()
+        for index in xrange(requests):
+            device_error(body) or auth_params_error(body) or \
+                publisher_auth_params_error(body)
+        report('auth body checks, ' + name, requests, time() - start)
+
+        start = time()
+        for index in xrange(requests):
+            auth_body_error(body)
+        report('auth body schema, ' + name, requests, time() - start)
+
+
+def benchmark_directory(users=1000, requests=5000, clients=8):
+    '''
+    Measures the throughput of model.check_credentials when users are looked
+    up in a fake directory served by the same process: over pooled
+    connections, over a new connection for every lookup, with a millisecond
+    of latency added to every lookup, with that latency but the users cached,
+    and while the directory is failing and the circuit breaker is open.
+    '''
+    product = 'product01'
+    add_users(0)
+    fake = FakeDirectory(dict(('user%d' % index,
+                               {'password': 'test', 'valid': True,
+                                'products': ['product01', 'product02']})
+                              for index in range(users)))
+    fake.start()
+
+    per_client = requests // clients
+    cases = (('pooled', 0, 0, DIRECTORY_CONNECTIONS, 0),
+             ('new connections', 0, 0, 0, 0),
+             ('1 ms latency', 0.001, 0, DIRECTORY_CONNECTIONS, 0),
+             ('1 ms latency, cached', 0.001, 0, DIRECTORY_CONNECTIONS, 60),
+             ('circuit open', 0, requests, DIRECTORY_CONNECTIONS, 0))
+    for name, latency, failures, connections, ttl in cases:
+        fake.latency = latency
+        fake.failures = failures
+        model.directory = UserDirectory(fake.url, connections, retries=0,
+                                        failures=1, ttl=ttl)
+
+        def work(offset):
+            instance = model()
+            for index in xrange(per_client):
+                username = 'user%d' % ((offset + index) % users)
+                instance.check_credentials(username, 'test', product)
+
+        workers = [Thread(target=work, args=(index * users // clients,))
+                   for index in range(clients)]
+        start = time()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time() - start
+
+        model.directory.close()
+        report('directory, ' + name, per_client * clients, elapsed)
+
+    model.directory = None
+    fake.stop()
+
+
+BENCHMARKS = {}
+BENCHMARKS['validate_threads'] = benchmark_validate_threads
+BENCHMARKS['session_memory'] = benchmark_session_memory
+BENCHMARKS['session_tokens'] = benchmark_session_tokens
+BENCHMARKS['recovery'] = benchmark_recovery
+BENCHMARKS['prefork'] = benchmark_prefork
+BENCHMARKS['load_users'] = benchmark_load_users
+BENCHMARKS['routing'] = benchmark_routing
+BENCHMARKS['keep_alive'] = benchmark_keep_alive
+BENCHMARKS['errors'] = benchmark_errors
+BENCHMARKS['failures'] = benchmark_failures
+BENCHMARKS['unauthorized'] = benchmark_unauthorized
+BENCHMARKS['codecs'] = benchmark_codecs
+BENCHMARKS['password_pool'] = benchmark_password_pool
+BENCHMARKS['credential_cache'] = benchmark_credential_cache
+BENCHMARKS['throttle'] = benchmark_throttle
+BENCHMARKS['auth_body'] = benchmark_auth_body
+BENCHMARKS['directory'] = benchmark_directory
+
+
+def main():
+    '''
+    Runs the benchmarks named on the command line, or all of them if none are
+    named.
+    '''
+    names = argv[1:] or sorted(BENCHMARKS)
+    for name in names:
+        print(name)
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main()
@@ -30,21 +30,25 @@
 from itty import post, Response
 
 # Used to validate the values passed into the base url and raise errors.
-from publisher.utils import check_base_url, raise_error
+from publisher.utils import raise_error
+from publisher.utils import base_url_error, error_response
+from publisher.utils import content_length, body_error
 
-# Used to decode and encode post bodies that contain json encoded data.
-# Note that in python 2.5 and 2.6 the json module is called simplejson.
-# In Python 2.7 and onwards, json is used.
-try:
-    from json import loads, dumps
-except ImportError:
-    from simplejson import loads, dumps
+# Used to decode post bodies that contain json encoded data and to encode the
+# response (see codec.py).
+from publisher.codec import loads, session_body
 
 # Used to authenticate a user to the data model.
-from publisher.model import model
+from publisher.model import model, INVALID_CREDENTIALS
+
+# Used to refuse bursts of attempts to log in.
+from publisher.throttle import client_error, username_error, username_failed
+
+# Used to check the request body in a single pass.
+from publisher.schema import STRING, compile_schema
 
 # Used to match URLs.
-from constants import (AUTH, AUTH_AUTHORIZATION_HEADER)
+from constants import (AUTH, AUTH_AUTHORIZATION_HEADER, MAX_AUTH_PARAMS)
 
 
 def check_authorization_header(url, environment):
@@ -69,6 +73,19 @@ def check_authorization_header(url, environment):
             HTTP Error Code: 400.
             Required: No
     '''
+    error = authorization_header_error(environment)
+    if error != None:
+        raise_error(url, *error, scheme=AUTH_AUTHORIZATION_HEADER)
+
+
+def authorization_header_error(environment):
+    '''
+    Checks the auth-scheme token in the same way as
+    check_authorization_header, but returns the error instead of raising it.
+
+    This function returns a tuple of the code, message, status and debug
+    message of the error, or None if the token is correct.
+    '''
     # All of the errors in this function share a common code and status.
     code = 'InvalidAuthScheme'
     status = 400
@@ -77,13 +94,15 @@ def check_authorization_header(url, environment):
     # Make sure the token is provided.
     if 'HTTP_AUTHORIZATION' not in environment:
         debug = 'The authorization token has not been provided.'
-        raise_error(url, code, message, status, debug)
+        return (code, message, status, debug)
 
     # Make sure the token's value is correct. The auth-scheme token isn't
     # important for this part of the API, but it is for others.
     if environment['HTTP_AUTHORIZATION'] != AUTH_AUTHORIZATION_HEADER:
         debug = 'The authorization token is incorrect.'
-        raise_error(url, code, message, status, debug)
+        return (code, message, status, debug)
+
+    return None
 
 
 def decode_body(url, body):
@@ -109,16 +128,37 @@ def decode_body(url, body):
             HTTP Error Code: 400.
             Required: No
     '''
+    error, json_body = read_body(body)
+    if error != None:
+        raise_error(url, *error, scheme=AUTH_AUTHORIZATION_HEADER)
+
+    return json_body
+
+
+def read_body(body):
+    '''
+    Decodes the request body in the same way as decode_body, but returns any
+    error instead of raising it.
+
+    This function returns a tuple of the error, as a tuple of its code,
+    message, status and debug message, and None, or None and the decoded
+    body.
+    '''
     # All of the errors in this function share a common code and status.
     code = 'InvalidFormat'
     status = 400
     message = 'An error occurred. Please contact support.'
 
+    # Reject bodies that are too large or too complex before decoding them.
+    error = body_error(body)
+    if error != None:
+        return (error, None)
+
     # If the body cannot be decoded, a proper error response must be made.
-    # This try except block intercepts the default exception and raises
-    # a json encoded exception using the raise_error function.
+    # This try except block intercepts the default exception and returns
+    # the error instead.
     try:
-        json_body = loads(body, encoding='utf-8')
+        json_body = loads(body)
 
     except ValueError:
         # If a ValueError occurred, the json decoder could not decode the
@@ -126,14 +166,14 @@ def decode_body(url, body):
         # Note that we do not return the body of the request as it could
         # contain access credentials.
         debug = 'Could not decode post body. json is expected.'
-        raise_error(url, code, message, status, debug)
+        return ((code, message, status, debug), None)
 
     # Make sure a valid number of parameters have been provided.
     if len(json_body) < 1 or len(json_body) > 2:
         debug = 'Post body has an invalid number of parameters.'
-        raise_error(url, code, message, status, debug)
+        return ((code, message, status, debug), None)
 
-    return json_body
+    return (None, json_body)
 
 
 def check_device(url, body):
@@ -159,6 +199,17 @@ def check_device(url, body):
             HTTP Error Code: 400
             Required: No
     '''
+    error = device_error(body)
+    if error != None:
+        raise_error(url, *error, scheme=AUTH_AUTHORIZATION_HEADER)
+
+
+def device_error(body):
+    '''
+    Checks the device parameter in the same way as check_device, but
+    returns the error instead of raising it. The result is the same as the
+    result of authorization_header_error.
+    '''
     # All of the errors in this function share a common code and status.
     code = 'InvalidDevice'
     status = 400
@@ -170,49 +221,51 @@ def check_device(url, body):
     # devices that access products.
     if 'device' not in body:
         debug = 'The device has not been provided.'
-        raise_error(url, code, message, status, debug)
+        return (code, message, status, debug)
 
     # Make sure the device is a dictionary.
     if not isinstance(body['device'], dict):
         debug = 'The device is not a map.'
-        raise_error(url, code, message, status, debug)
+        return (code, message, status, debug)
 
     # Check to make sure that the manufacturer of the device has been
     # provided.
     if 'manufacturer' not in body['device']:
         debug = 'The manufacturer has not been provided.'
-        raise_error(url, code, message, status, debug)
+        return (code, message, status, debug)
 
     # Check to make sure the manufacturer is of the right type.
     manufacturer = body['device']['manufacturer']
     if not isinstance(manufacturer, unicode) and \
        not isinstance(manufacturer, str):
         debug = 'The manufacturer is not a string.'
-        raise_error(url, code, message, status, debug)
+        return (code, message, status, debug)
 
     # Check to make sure that the model of the device has been provided.
     if 'model' not in body['device']:
         debug = 'The model has not been provided.'
-        raise_error(url, code, message, status, debug)
+        return (code, message, status, debug)
 
     # Check to make sure the model is of the right type.
     model = body['device']['model']
     if not isinstance(model, unicode) and \
        not isinstance(model, str):
         debug = 'The model is not a string.'
-        raise_error(url, code, message, status, debug)
+        return (code, message, status, debug)
 
     # Check to make sure that the os_version of the device has been provided.
     if 'os_version' not in body['device']:
         debug = 'The os_version has not been provided.'
-        raise_error(url, code, message, status, debug)
+        return (code, message, status, debug)
 
     # Check to make sure the os_version is of the right type.
     os_version = body['device']['os_version']
     if not isinstance(os_version, unicode) and \
        not isinstance(os_version, str):
         debug = 'The os_version is not a string.'
-        raise_error(url, code, message, status, debug)
+        return (code, message, status, debug)
+
+    return None
 
 
 def check_auth_params(url, body):
@@ -244,6 +297,17 @@ def check_auth_params(url, body):
             HTTP Error Code: 400
             Required: No
     '''
+    error = auth_params_error(body)
+    if error != None:
+        raise_error(url, *error, scheme=AUTH_AUTHORIZATION_HEADER)
+
+
+def auth_params_error(body):
+    '''
+    Checks the authParams parameter in the same way as check_auth_params, but
+    returns the error instead of raising it. The result is the same as the
+    result of authorization_header_error.
+    '''
     # All of the errors in this function share a common code and status.
     code = 'InvalidAuthParams'
     status = 400
@@ -251,19 +315,27 @@ def check_auth_params(url, body):
 
     # Note that not having an authParams key is valid.
     if 'authParams' not in body:
-        return
+        return None
 
     # When authParams is provided, the type must be a dictionary.
     if not isinstance(body['authParams'], dict):
         debug = 'The authParams is not a map.'
-        raise_error(url, code, message, status, debug)
+        return (code, message, status, debug)
+
+    # Only a few authParams are expected, so many more are refused before
+    # each of them is checked.
+    if len(body['authParams']) > MAX_AUTH_PARAMS:
+        debug = 'The authParams has too many values.'
+        return (code, message, status, debug)
 
     # Make sure that all the values in the dictionary are strings.
     for key in body['authParams']:
         value = body['authParams'][key]
         if not isinstance(value, unicode) and not isinstance(value, str):
             debug = 'This authParams value is not a string: ' + unicode(key)
-            raise_error(url, code, message, status, debug)
+            return (code, message, status, debug)
+
+    return None
 
 
 def check_publisher_auth_params(url, body):
@@ -295,6 +367,17 @@ def check_publisher_auth_params(url, body):
             HTTP Error Code: 400
             Required: No
     '''
+    error = publisher_auth_params_error(body)
+    if error != None:
+        raise_error(url, *error, scheme=AUTH_AUTHORIZATION_HEADER)
+
+
+def publisher_auth_params_error(body):
+    '''
+    Checks the authParams parameter in the same way as
+    check_publisher_auth_params, but returns the error instead of raising it.
+    The result is the same as the result of authorization_header_error.
+    '''
     # All of the errors in this function share a common code and status.
     code = 'InvalidAuthParams'
     status = 400
@@ -304,19 +387,74 @@ def check_publisher_auth_params(url, body):
     # being a dictionary has already been carried out by check_auth_params.
     if 'authParams' not in body:
         debug = 'The authParams has not been provided.'
-        raise_error(url, code, message, status, debug)
+        return (code, message, status, debug)
 
     # Make sure username is provided. The check_auth_params has already
     # checked the type of the username.
     if 'username' not in body['authParams']:
         debug = 'The username has not been provided.'
-        raise_error(url, code, message, status, debug)
+        return (code, message, status, debug)
 
     # Make sure password is provided. The check_auth_params has already
     # checked the type of the password.
     if 'password' not in body['authParams']:
         debug = 'The password has not been provided.'
-        raise_error(url, code, message, status, debug)
+        return (code, message, status, debug)
+
+    return None
+
+
+# The schema of the decoded auth request body (see schema.py). Checking a body
+# against it reports the same errors, in the same order, as device_error,
+# auth_params_error and publisher_auth_params_error do in turn.
+AUTH_BODY_SCHEMA = [
+    {'key': 'device', 'code': 'InvalidDevice',
+     'missing': 'The device has not been provided.',
+     'type': dict, 'invalid': 'The device is not a map.',
+     'fields': [
+         {'key': 'manufacturer',
+          'missing': 'The manufacturer has not been provided.',
+          'type': STRING, 'invalid': 'The manufacturer is not a string.'},
+         {'key': 'model',
+          'missing': 'The model has not been provided.',
+          'type': STRING, 'invalid': 'The model is not a string.'},
+         {'key': 'os_version',
+          'missing': 'The os_version has not been provided.',
+          'type': STRING, 'invalid': 'The os_version is not a string.'},
+     ]},
+    {'key': 'authParams', 'code': 'InvalidAuthParams',
+     'missing': 'The authParams has not been provided.',
+     'type': dict, 'invalid': 'The authParams is not a map.',
+     'max_values': MAX_AUTH_PARAMS,
+     'too_many': 'The authParams has too many values.',
+     'values': STRING,
+     'invalid_value': 'This authParams value is not a string: ',
+     'fields': [
+         {'key': 'username',
+          'missing': 'The username has not been provided.'},
+         {'key': 'password',
+          'missing': 'The password has not been provided.'},
+     ]},
+]
+check_auth_body = compile_schema(AUTH_BODY_SCHEMA,
+                                 'An error occurred. Please contact support.',
+                                 400)
+
+
+def auth_body_error(body):
+    '''
+    Checks the device and authParams parameters of the decoded body in the
+    same way as device_error, auth_params_error and
+    publisher_auth_params_error, but in a single pass. The result is the same
+    as the result of authorization_header_error.
+    '''
+    # Bodies that are not maps are rare, and are left to the separate checks
+    # so that they are treated exactly the same way.
+    if not isinstance(body, dict):
+        return device_error(body) or auth_params_error(body) or \
+            publisher_auth_params_error(body)
+
+    return check_auth_body(body)
 
 
 @post(AUTH)
@@ -562,6 +700,16 @@ def auth(request, api, version, format, product_code):
             HTTP Error Code: 401
             Required: Yes
 
+        TooManyAttempts:
+
+            Returned when too many attempts to log in have been made from the
+            client's address or for the username (see throttle.py).
+
+            Code: TooManyAttempts
+            Message: Too many attempts to log in. Please try again later.
+            HTTP Error Code: 403
+            Required: No
+
         AccountProblem:
 
             There is a problem with the user's account. The user is
@@ -581,6 +729,17 @@ def auth(request, api, version, format, product_code):
             HTTP Error Code: 404
             Required: Yes
 
+        DirectoryUnavailable:
+
+            Returned when USER_DIRECTORY is set and the user directory cannot
+            be reached (see directory.py).
+
+            Code: DirectoryUnavailable
+            Message: An error occurred. Please contact support.
+            Debug: The user directory could not be reached.
+            HTTP Error Code: 500
+            Required: No
+
         InvalidAPI:
 
             Returned when the publisher does not recognize the requested api.
@@ -649,35 +808,80 @@ def auth(request, api, version, format, product_code):
     # Store the full URL string so that it can be used to report errors.
     url = request.path
 
-    # Validate the request and its headers.
-    check_base_url(url, api, version, format)
-    check_authorization_header(url, request._environ)
+    # Authenticate the user and create the response body. Errors are
+    # returned rather than raised, so they are reported without unwinding
+    # through itty's error handlers.
+    error = base_url_error(api, version, format)
+    if error == None:
+        # The body is only read once its length is known to be acceptable.
+        error, length = content_length(request._environ)
+    if error == None:
+        error, content = auth_result(url, request._environ, request.body,
+                                     product_code)
+    if error != None:
+        return error_response(url, error, AUTH_AUTHORIZATION_HEADER)
+
+    status = 200
+    headers = []
+    content_type = 'application/json'
+    return Response(content, headers, status, content_type)
+
+
+def auth_result(url, environment, body, product_code):
+    '''
+    Processes an auth request whose api, version and format are already known
+    to be supported. The request is described by its url, its wsgi
+    environment and its body, so that it can be processed by any front end
+    (see frontend.py). Errors are returned rather than raised. Most auth
+    requests made by abusive clients fail, so failures are kept as cheap as
+    successes.
+
+    This function returns a tuple of the error, as a tuple of its code,
+    message, status and debug message, and None, or None and the json encoded
+    response body.
+    '''
+    # Refuse clients that have made too many attempts before doing any work
+    # for them.
+    error = client_error(environment)
+    if error != None:
+        return (error, None)
+
+    # Validate the request headers.
+    error = authorization_header_error(environment)
+    if error != None:
+        return (error, None)
 
     # Validate the request body.
-    body = decode_body(url, request.body)
-    check_device(url, body)
-    check_auth_params(url, body)
+    error, body = read_body(body)
+    if error != None:
+        return (error, None)
 
     # Note that the authentication parameters that will be passed into this
-    # service are configurable through Polar's server. The function
-    # check_publisher_auth_params ensures that the authentication parameters
-    # specific to this publisher's implementation (username, password) exist
-    # and are strings.
-    check_publisher_auth_params(url, body)
+    # service are configurable through Polar's server. The schema ensures
+    # that the authentication parameters specific to this publisher's
+    # implementation (username, password) exist and are strings.
+    error = auth_body_error(body)
+    if error != None:
+        return (error, None)
+
     username = body['authParams']['username']
     password = body['authParams']['password']
 
-    # Authenticate the user to get the session id and the products.
-    (session_id, products) = model().authenticate_user(url, username, password,
-                                                                  product_code)
-
-    # Create the response body.
-    result = {}
-    result['sessionKey'] = session_id
-    result['products'] = products
-    content = dumps(result)
-
-    status = 200
-    headers = []
-    content_type = 'application/json'
-    return Response(content, headers, status, content_type)
+    # Refuse usernames that too many failed attempts have been made for
+    # before checking the credentials.
+    error = username_error(username)
+    if error != None:
+        return (error, None)
+
+    # Authenticate the user to get the session id and the products. Only
+    # attempts with the wrong credentials count against the username.
+    error, result = model().check_credentials(username, password,
+                                              product_code)
+    if error != None:
+        if error == INVALID_CREDENTIALS:
+            username_failed(username)
+        return (error, None)
+    (session_id, products) = result
+
+    # Create the response body from its template.
+    return (None, session_body(session_id, products))
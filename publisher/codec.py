@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright (c) 2012, Polar Mobile.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name Polar Mobile nor the names of its contributors
+#     may be used to endorse or promote products derived from this software
+#     without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL POLAR MOBILE BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Used to pick the json module.
+from constants import JSON_CODEC
+
+
+class Codec(object):
+    '''
+    The functions of a json module used to decode requests and encode
+    responses.
+
+    loads decodes a request body and raises ValueError if it is not valid
+    json. dumps encodes a response. encode_string encodes a single string,
+    quotes included, and is used to fill in pre-encoded response templates.
+    Every codec encodes strings the same way, so the templates produce the
+    same bytes whichever codec is in use. The spacing of the responses
+    encoded with dumps may differ from one codec to the next.
+    '''
+    def __init__(self, name, loads, dumps, encode_string):
+        '''
+        Creates the codec.
+        '''
+        self.name = name
+        self.loads = loads
+        self.dumps = dumps
+        self.encode_string = encode_string
+
+
+def load_ujson():
+    '''
+    Returns the codec of the ujson module. Forward slashes are not escaped,
+    so strings are encoded the same way as the json module encodes them;
+    versions of ujson that always escape them are not used.
+    '''
+    import ujson
+
+    def dumps(value):
+        return ujson.dumps(value, escape_forward_slashes=False)
+
+    try:
+        dumps('/')
+    except TypeError:
+        raise ImportError('This version of ujson escapes forward slashes.')
+
+    return Codec('ujson', ujson.loads, dumps, dumps)
+
+
+def load_simplejson(accelerated=False):
+    '''
+    Returns the codec of the simplejson module. If accelerated is set, the
+    module is only used if its C extension is installed.
+    '''
+    import simplejson
+    from simplejson.scanner import c_make_scanner
+    if accelerated and c_make_scanner == None:
+        raise ImportError('The simplejson C extension is not installed.')
+
+    from simplejson.encoder import encode_basestring_ascii
+    return Codec('simplejson', simplejson.loads, simplejson.dumps,
+                 encode_basestring_ascii)
+
+
+def load_json():
+    '''
+    Returns the codec of the json module of the standard library.
+    '''
+    import json
+    from json.encoder import encode_basestring_ascii
+    return Codec('json', json.loads, json.dumps, encode_basestring_ascii)
+
+
+# The function that loads each codec.
+LOADERS = {}
+LOADERS['ujson'] = load_ujson
+LOADERS['simplejson'] = load_simplejson
+LOADERS['json'] = load_json
+
+
+def load_codec(name=JSON_CODEC):
+    '''
+    Returns the codec with the given name, or the fastest codec installed if
+    the name is "auto". The json module of the standard library is used if
+    no faster codec is installed; in python 2.5, which does not have one,
+    simplejson is used without its C extension.
+    '''
+    if name != 'auto':
+        return LOADERS[name]()
+
+    # The modules are tried fastest first.
+    try:
+        return load_ujson()
+    except ImportError:
+        pass
+
+    try:
+        return load_simplejson(True)
+    except ImportError:
+        pass
+
+    try:
+        return load_json()
+    except ImportError:
+        return load_simplejson()
+
+
+# The codec used by the entry points.
+codec = load_codec()
+loads = codec.loads
+dumps = codec.dumps
+encode_string = codec.encode_string
+
+
+def encode_products(products):
+    '''
+    Encodes a list of product codes as a json array. The array is encoded in
+    the same way by every codec.
+    '''
+    return '[' + ', '.join([encode_string(code) for code in products]) + ']'
+
+
+def session_body(session_id, products):
+    '''
+    Returns the response body of a successful auth or validate request. This
+    is the same as encoding a dictionary of the "sessionKey" and "products"
+    keys with the json module, but only the session id is encoded per
+    request. The products must be a list returned by the product registry,
+    which keeps its encoding (see products.py).
+    '''
+    return '{"sessionKey": ' + encode_string(session_id) + \
+        ', "products": ' + products.encoded + '}'
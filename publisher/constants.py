@@ -40,6 +40,59 @@ AUTH = API + VERSION + FORMAT + r'/auth' + PRODUCT_CODE
 # Regex for the validate entry point.
 VALIDATE = API + VERSION + FORMAT + r'/validate' + PRODUCT_CODE
 
+# Regex for the batch validate entry point, which validates many sessions at
+# once and therefore takes no product code in its url.
+BATCH_VALIDATE = API + VERSION + FORMAT + r'/batchvalidate'
+
+# The maximum number of session and product pairs that a single batch
+# validate request may contain.
+MAX_BATCH_SIZE = 100
+
+# Limits on request bodies, which are checked before a body is read or
+# decoded. MAX_BODY_SIZE is the largest body accepted, in bytes; it leaves
+# room for a full batch validate request. MAX_BODY_DEPTH is the deepest
+# nesting of json objects and arrays, and MAX_BODY_VALUES the largest number
+# of values in all of the objects and arrays of a body. MAX_AUTH_PARAMS is the
+# largest number of authParams an auth request may carry.
+MAX_BODY_SIZE = 16384
+MAX_BODY_DEPTH = 8
+MAX_BODY_VALUES = 512
+MAX_AUTH_PARAMS = 16
+
+# Attempts to log in are limited for each remote address, and failed attempts
+# for each username, so that bursts of attempts are refused before the
+# credentials are checked (see throttle.py). Each limit allows a burst of
+# attempts, after which attempts are allowed at the given rate per second.
+# Most requests come from Polar's servers, so the limit for each address must
+# allow for all of their users. A rate of None removes a limit. At most
+# THROTTLE_SIZE addresses and usernames are tracked by each process.
+THROTTLE_CLIENT_RATE = 100
+THROTTLE_CLIENT_BURST = 500
+THROTTLE_USERNAME_RATE = 0.2
+THROTTLE_USERNAME_BURST = 10
+THROTTLE_SIZE = 100000
+
+# Users may be kept in an external directory instead of the users dictionary
+# below (see directory.py). Set USER_DIRECTORY to the url of the directory to
+# use it, for example 'http://localhost:8081/directory'. Up to
+# DIRECTORY_CONNECTIONS idle connections to the directory are kept open, and
+# requests time out after DIRECTORY_TIMEOUT seconds. A failed request is
+# retried DIRECTORY_RETRIES times, after DIRECTORY_BACKOFF seconds and twice
+# as long before each further retry. Once DIRECTORY_FAILURES lookups in a row
+# have failed, lookups fail straight away for DIRECTORY_RESET seconds. Users
+# found in the directory are remembered for DIRECTORY_CACHE_TTL seconds, and
+# at most DIRECTORY_CACHE_SIZE of them are remembered at once. Set
+# DIRECTORY_CACHE_TTL to 0 to ask the directory on every login.
+USER_DIRECTORY = None
+DIRECTORY_CONNECTIONS = 8
+DIRECTORY_TIMEOUT = 2
+DIRECTORY_RETRIES = 2
+DIRECTORY_BACKOFF = 0.05
+DIRECTORY_FAILURES = 5
+DIRECTORY_RESET = 10
+DIRECTORY_CACHE_TTL = 60
+DIRECTORY_CACHE_SIZE = 10000
+
 # Authorization headers.
 AUTH_AUTHORIZATION_HEADER = 'PolarPaywallProxyAuthv1.0.0'
 SESSION_AUTHORIZATION_HEADER = 'PolarPaywallProxySessionv1.0.0'
@@ -49,9 +102,106 @@ SESSION_AUTHORIZATION_HEADER = 'PolarPaywallProxySessionv1.0.0'
 # frequently.
 SESSION_TIMEOUT = 2
 
+# The maximum number of session keys a user may hold at once, or 0 for no
+# limit. When a user authenticates while holding this many session keys, the
+# session key that was validated least recently is removed to make room for
+# the new one. The number of session keys removed this way is counted by the
+# storage (see storage.py). The limit does not apply to session tokens.
+MAX_USER_SESSIONS = 16
+
+# The maximum number of error reports that are kept pre-encoded (see
+# encode_error in utils.py). Reports are kept for each code and message,
+# which are chosen by the server; the debug message is inserted for each
+# request. The bound only guards against a publisher building messages from
+# request data.
+ERROR_CACHE_SIZE = 256
+
+# Passwords may be stored hashed with PBKDF2-HMAC-SHA256 (see passwords.py).
+# PASSWORD_ITERATIONS is the number of iterations of new hashes, which sets
+# the cost of each login. Hashed passwords are verified by PASSWORD_WORKERS
+# threads, or by the request thread if it is 0, and at most
+# PASSWORD_QUEUE_SIZE passwords wait for a thread at once.
+PASSWORD_ITERATIONS = 100000
+PASSWORD_WORKERS = 4
+PASSWORD_QUEUE_SIZE = 64
+
+# Users whose hashed password was verified in the last CREDENTIAL_CACHE_TTL
+# seconds are not verified again when they log in with the same password (see
+# CredentialCache in passwords.py). At most CREDENTIAL_CACHE_SIZE users are
+# remembered at once. Set CREDENTIAL_CACHE_TTL to 0 to verify every login.
+CREDENTIAL_CACHE_TTL = 300
+CREDENTIAL_CACHE_SIZE = 10000
+
+# The json module used to decode requests and encode responses (see
+# codec.py). "auto" uses the fastest module installed, trying "ujson", then
+# "simplejson" with its C extension, then the standard library's "json".
+JSON_CODEC = 'auto'
+
+# The number of seconds between each pass of the session reaper, which removes
+# expired session keys in the background.
+REAPER_INTERVAL = 60
+
+# When enabled, session keys are tokens signed with SESSION_SECRET that can be
+# validated without storing them. Every server that validates the tokens must
+# share the same secret. If no secret is set, a random secret is generated
+# when the server starts, so tokens do not survive a restart.
+SESSION_TOKENS = False
+SESSION_SECRET = None
+
+# The storage used by the model to keep users and sessions. "memory" keeps
+# everything in the memory of the process. "journal" also keeps everything in
+# memory, but records every new or removed session in a journal in the
+# JOURNAL_PATH directory and writes a snapshot of the sessions every
+# SNAPSHOT_INTERVAL seconds, so sessions survive a restart. "sqlite" keeps
+# everything in the SQLite database at STORAGE_PATH.
+STORAGE = 'memory'
+STORAGE_PATH = 'publisher.db'
+JOURNAL_PATH = 'journal'
+SNAPSHOT_INTERVAL = 300
+
+# The number of server processes to run, each serving requests with
+# WORKER_THREADS threads. When WORKERS is 0, the server runs in a single
+# process using itty's reference server. Since the workers do not share
+# memory, running more than one worker requires a storage that every worker
+# can reach, which is currently the "sqlite" storage. Where the system supports
+# it and REUSE_PORT is enabled, each worker listens on its own socket and the
+# kernel spreads connections across them; otherwise the workers share a single
+# listening socket. On shutdown, workers are given SHUTDOWN_TIMEOUT seconds to
+# finish the requests they are serving.
+WORKERS = 0
+WORKER_THREADS = 8
+REUSE_PORT = True
+SHUTDOWN_TIMEOUT = 10
+
+# The front end that serves requests. "itty" uses itty's reference server, or
+# the worker processes described above. "events" holds every connection in a
+# single event loop and processes requests with FRONTEND_THREADS threads (see
+# frontend.py), so that idle and slow clients do not each hold a thread.
+FRONTEND = 'itty'
+FRONTEND_THREADS = 16
+
+# The "events" front end keeps connections open so that clients can send many
+# requests over the same connection. A connection is closed once it has been
+# idle for KEEP_ALIVE_TIMEOUT seconds or has served KEEP_ALIVE_REQUESTS
+# requests. Setting KEEP_ALIVE_REQUESTS to 0 closes every connection after a
+# single request.
+KEEP_ALIVE_TIMEOUT = 15
+KEEP_ALIVE_REQUESTS = 1000
+
+# The number of locks used to protect the users' data in the memory storage.
+# Users are spread across the locks by the hash of their username.
+LOCK_STRIPES = 64
+
+# The path of a catalog of users to load in addition to the test users below,
+# or None. Files ending in ".csv" are read as csv and all other files are read
+# as one json object per line (see loader.py). The catalog is read a line at a
+# time, so it can hold millions of users.
+USERS_FILE = None
+
 # The users dictionary is used by the model class to initialize its own record
-# of users. When a model class instance is first created, it copies the users
-# dictionary. To add new users to the system, modify the following structure.
+# of users. When a model class instance is first created, it adds each of these
+# users to its storage. To add new users to the system, modify the following
+# structure or use a USERS_FILE.
 users = {}
 
 # Create a users for testing purposes.
@@ -59,13 +209,9 @@ users['user01'] = {}
 users['user01']['valid'] = True
 users['user01']['products'] = ['product01', 'product02']
 users['user01']['password'] = 'test'
-# Note that although we don't add any session ids here, we have to initialize
-# the session id dictionary.
-users['user01']['session ids'] = {}
 
 # Create a users for testing purposes that is not valid.
 users['user02'] = {}
 users['user02']['valid'] = False
 users['user02']['products'] = ['product01', 'product02']
 users['user02']['password'] = 'test'
-users['user02']['session ids'] = {}
@@ -0,0 +1,518 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright (c) 2012, Polar Mobile.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name Polar Mobile nor the names of its contributors
+#     may be used to endorse or promote products derived from this software
+#     without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL POLAR MOBILE BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Used to make requests to the directory over persistent connections.
+from httplib import HTTPConnection, HTTPException
+from urlparse import urlsplit
+from urllib import quote, unquote
+from Queue import LifoQueue, Empty, Full
+import socket
+
+# Used to protect the circuit breaker and the cache of users, and to run the
+# fake directory.
+from threading import Lock, Thread
+from collections import OrderedDict
+
+# Used to back off between retries and to reset the circuit breaker.
+from time import time, sleep
+
+# Used to serve the fake directory.
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+# Used to decode and encode the directory's responses.
+from publisher.codec import loads, dumps
+
+# Used to configure the directory client.
+from constants import (DIRECTORY_CONNECTIONS, DIRECTORY_TIMEOUT,
+                       DIRECTORY_RETRIES, DIRECTORY_BACKOFF,
+                       DIRECTORY_FAILURES, DIRECTORY_RESET,
+                       DIRECTORY_CACHE_TTL, DIRECTORY_CACHE_SIZE)
+
+
+class DirectoryError(Exception):
+    '''
+    Raised when the user directory cannot answer a request, because it could
+    not be reached, it failed, or the circuit breaker is open.
+    '''
+    pass
+
+
+class CircuitBreaker(object):
+    '''
+    Stops requests from being sent to a directory that keeps failing. Once
+    threshold requests in a row have failed, the circuit opens and requests
+    are refused straight away. After reset seconds, a single request is let
+    through; if it succeeds the circuit closes again, otherwise it stays open
+    for another reset seconds.
+
+    The number of requests refused while the circuit is open is kept in the
+    rejections attribute.
+    '''
+    def __init__(self, threshold=DIRECTORY_FAILURES, reset=DIRECTORY_RESET):
+        '''
+        Creates a closed circuit breaker.
+        '''
+        self.threshold = threshold
+        self.reset = reset
+        self.failures = 0
+        self.opened = None
+        self.rejections = 0
+        self.lock = Lock()
+
+    def allow(self):
+        '''
+        Returns True if a request may be sent.
+        '''
+        self.lock.acquire()
+        try:
+            if self.opened == None:
+                return True
+
+            # Let one request through to test the directory, and keep the
+            # circuit open for everyone else.
+            now = time()
+            if now - self.opened >= self.reset:
+                self.opened = now
+                return True
+
+            self.rejections += 1
+            return False
+
+        finally:
+            self.lock.release()
+
+    def succeed(self):
+        '''
+        Records that a request succeeded, which closes the circuit.
+        '''
+        self.lock.acquire()
+        try:
+            self.failures = 0
+            self.opened = None
+
+        finally:
+            self.lock.release()
+
+    def fail(self):
+        '''
+        Records that a request failed, which opens the circuit once too many
+        have failed in a row.
+        '''
+        self.lock.acquire()
+        try:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened = time()
+
+        finally:
+            self.lock.release()
+
+
+class DirectoryConnection(HTTPConnection):
+    '''
+    An HTTP connection that sends each request as soon as it is written.
+    Requests are small and connections are reused, so waiting to fill a
+    packet would only delay them.
+    '''
+    def connect(self):
+        '''
+        Connects to the server and disables Nagle's algorithm.
+        '''
+        HTTPConnection.connect(self)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class ConnectionPool(object):
+    '''
+    Keeps up to size idle connections to a server open, so that requests do
+    not pay for a new connection each time. More connections are opened when
+    all of the idle ones are in use; those that do not fit in the pool once
+    they are returned are closed. The connection used most recently is used
+    first, so that the others may be closed by the server when it is quiet.
+    '''
+    def __init__(self, host, port, size=DIRECTORY_CONNECTIONS,
+                 timeout=DIRECTORY_TIMEOUT):
+        '''
+        Creates an empty pool.
+        '''
+        self.host = host
+        self.port = port
+        self.size = size
+        self.timeout = timeout
+        self.connections = LifoQueue(max(size, 1))
+
+    def get(self):
+        '''
+        Returns an idle connection, or a new one if there is none.
+        '''
+        try:
+            return self.connections.get_nowait()
+        except Empty:
+            return DirectoryConnection(self.host, self.port,
+                                       timeout=self.timeout)
+
+    def put(self, connection):
+        '''
+        Returns a connection to the pool once its response has been read.
+        '''
+        if self.size > 0:
+            try:
+                self.connections.put_nowait(connection)
+                return
+            except Full:
+                pass
+        connection.close()
+
+    def close(self):
+        '''
+        Closes the idle connections.
+        '''
+        while True:
+            try:
+                self.connections.get_nowait().close()
+            except Empty:
+                break
+
+
+class UserDirectory(object):
+    '''
+    A client for an external directory of users, which the model consults
+    instead of the storage when USER_DIRECTORY is set in constants.py.
+
+    The directory is reached over HTTP at the url it is created with. A user
+    is looked up with:
+
+        GET <url>/users/<username>
+
+    The directory answers with 404 if the user is not known, or with 200 and
+    a json map describing the user in the same way as the users dictionary
+    in constants.py:
+
+        {"password": "test", "valid": true, "products": ["product01"]}
+
+    The password may be hashed (see passwords.py). Requests are made over a
+    pool of persistent connections and time out after DIRECTORY_TIMEOUT
+    seconds. A request that fails is retried up to DIRECTORY_RETRIES times,
+    waiting DIRECTORY_BACKOFF seconds before the first retry and twice as
+    long before each one after. Once DIRECTORY_FAILURES lookups in a row have
+    failed, lookups fail straight away for DIRECTORY_RESET seconds (see
+    CircuitBreaker), so that requests do not pile up behind a directory that
+    is down.
+
+    The users found are remembered for DIRECTORY_CACHE_TTL seconds, so a user
+    who logs in again soon after is not looked up again, even while the
+    directory is down. Users that are not found are not remembered, so that
+    requests for made up usernames cannot fill the cache. At most
+    DIRECTORY_CACHE_SIZE users are remembered; once the cache is full, the
+    user that was used least recently is forgotten. The number of hits,
+    misses and evictions are kept in the hits, misses and evictions
+    attributes. A TTL of 0 disables the cache.
+    '''
+    def __init__(self, url, connections=DIRECTORY_CONNECTIONS,
+                 timeout=DIRECTORY_TIMEOUT, retries=DIRECTORY_RETRIES,
+                 backoff=DIRECTORY_BACKOFF, failures=DIRECTORY_FAILURES,
+                 reset=DIRECTORY_RESET, ttl=DIRECTORY_CACHE_TTL,
+                 size=DIRECTORY_CACHE_SIZE):
+        '''
+        Creates the client. No connection is made until a user is looked up.
+        '''
+        parts = urlsplit(url)
+        self.path = parts.path.rstrip('/') + '/users/'
+        self.pool = ConnectionPool(parts.hostname, parts.port or 80,
+                                   connections, timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = CircuitBreaker(failures, reset)
+
+        # The users found recently, keyed against their usernames, along
+        # with the time they are forgotten.
+        self.ttl = ttl
+        self.size = size
+        self.users = OrderedDict()
+        self.users_lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_user(self, username):
+        '''
+        Returns the map describing the user, with the keys "password",
+        "valid" and "products", or None if the user is not known. Raises
+        DirectoryError if the directory cannot answer.
+        '''
+        if self.ttl <= 0:
+            return self.fetch_user(username)
+
+        self.users_lock.acquire()
+        try:
+            # The entry is moved to the end, as the most recently used one.
+            entry = self.users.pop(username, None)
+            if entry != None and entry[1] > time():
+                self.users[username] = entry
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        finally:
+            self.users_lock.release()
+
+        # No lock is held while the directory is asked.
+        user = self.fetch_user(username)
+        if user == None:
+            return None
+
+        self.users_lock.acquire()
+        try:
+            self.users.pop(username, None)
+            self.users[username] = (user, time() + self.ttl)
+            while len(self.users) > self.size:
+                self.users.popitem(last=False)
+                self.evictions += 1
+
+        finally:
+            self.users_lock.release()
+
+        return user
+
+    def fetch_user(self, username):
+        '''
+        Asks the directory for the user, in the same way as get_user but
+        without the cache.
+        '''
+        if not self.breaker.allow():
+            raise DirectoryError('The circuit breaker is open.')
+
+        if isinstance(username, unicode):
+            username = username.encode('utf-8')
+        path = self.path + quote(username, safe='')
+
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                sleep(self.backoff * 2 ** (attempt - 1))
+
+            try:
+                status, body = self.request(path)
+            except (HTTPException, socket.error):
+                continue
+
+            if status == 404:
+                self.breaker.succeed()
+                return None
+            if status == 200:
+                user = self.decode_user(body)
+                if user != None:
+                    self.breaker.succeed()
+                    return user
+
+        self.breaker.fail()
+        raise DirectoryError('The user directory could not be reached.')
+
+    def request(self, path):
+        '''
+        Makes a GET request over a pooled connection. Returns a tuple of the
+        status and the body of the response.
+        '''
+        connection = self.pool.get()
+        try:
+            connection.request('GET', path,
+                               headers={'Accept': 'application/json'})
+            response = connection.getresponse()
+            body = response.read()
+        except:
+            connection.close()
+            raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            self.pool.put(connection)
+        return (response.status, body)
+
+    def decode_user(self, body):
+        '''
+        Decodes the map describing a user. Returns None if it is not valid.
+        '''
+        try:
+            user = loads(body)
+        except ValueError:
+            return None
+
+        if not isinstance(user, dict) or \
+           not isinstance(user.get('password'), (str, unicode)) or \
+           not isinstance(user.get('valid'), bool) or \
+           not isinstance(user.get('products'), list):
+            return None
+        return user
+
+    def close(self):
+        '''
+        Closes the idle connections to the directory.
+        '''
+        self.pool.close()
+
+
+class FakeDirectoryServer(ThreadingMixIn, HTTPServer):
+    '''
+    The HTTP server run by FakeDirectory, with a thread for each connection.
+    '''
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        '''
+        Clients that time out close their connections early, which is
+        expected, so errors are not reported.
+        '''
+        pass
+
+
+class FakeDirectoryHandler(BaseHTTPRequestHandler):
+    '''
+    Answers the requests made to a FakeDirectory. Connections are kept open
+    between requests.
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    # Responses are buffered and sent in one piece once they are complete,
+    # rather than a line at a time.
+    wbufsize = -1
+
+    def setup(self):
+        '''
+        Counts the connection.
+        '''
+        BaseHTTPRequestHandler.setup(self)
+        self.server.directory.count('connections')
+
+    def do_GET(self):
+        '''
+        Looks a user up.
+        '''
+        directory = self.server.directory
+        directory.count('requests')
+        if directory.latency > 0:
+            sleep(directory.latency)
+
+        prefix = '/directory/users/'
+        username = None
+        if self.path.startswith(prefix):
+            username = unquote(self.path[len(prefix):]).decode('utf-8')
+
+        if directory.take_failure():
+            self.answer(503, '{}')
+        elif username in directory.users:
+            self.answer(200, dumps(directory.users[username]))
+        else:
+            self.answer(404, '{}')
+
+    def answer(self, status, body):
+        '''
+        Sends a json response.
+        '''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *arguments):
+        '''
+        Requests are not logged.
+        '''
+        pass
+
+
+class FakeDirectory(object):
+    '''
+    A user directory served in the same process, so that the directory
+    client can be tested and measured without an external system. The users
+    are given in the same form as the users dictionary in constants.py, and
+    may be changed while the directory is running.
+
+    Every response is delayed by latency seconds, and the next failures
+    requests are answered with 503, to see how the client behaves when the
+    directory is slow or failing. The number of connections and requests
+    served are kept in the connections and requests attributes.
+    '''
+    def __init__(self, users, latency=0, host='127.0.0.1', port=0):
+        '''
+        Creates the directory. It is not served until start is called.
+        '''
+        self.users = users
+        self.latency = latency
+        self.failures = 0
+        self.connections = 0
+        self.requests = 0
+        self.lock = Lock()
+
+        self.server = FakeDirectoryServer((host, port), FakeDirectoryHandler)
+        self.server.directory = self
+        host, port = self.server.server_address[:2]
+        self.url = 'http://%s:%d/directory' % (host, port)
+
+    def start(self):
+        '''
+        Serves the directory in a background thread.
+        '''
+        thread = Thread(target=self.server.serve_forever, args=(0.05,),
+                        name='FakeDirectory')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        '''
+        Stops serving the directory.
+        '''
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, name):
+        '''
+        Adds one to the named counter.
+        '''
+        self.lock.acquire()
+        try:
+            setattr(self, name, getattr(self, name) + 1)
+
+        finally:
+            self.lock.release()
+
+    def take_failure(self):
+        '''
+        Returns True if the current request should fail.
+        '''
+        self.lock.acquire()
+        try:
+            if self.failures <= 0:
+                return False
+            self.failures -= 1
+            return True
+
+        finally:
+            self.lock.release()
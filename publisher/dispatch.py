@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright (c) 2012, Polar Mobile.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name Polar Mobile nor the names of its contributors
+#     may be used to endorse or promote products derived from this software
+#     without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL POLAR MOBILE BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Used to check product codes and to match the urls of unsupported requests.
+from re import compile
+
+# Used to write the status line of responses.
+from httplib import responses
+
+# Used to report unexpected errors.
+from traceback import print_exc
+
+# Used to turn the errors returned by the entry points into responses.
+from publisher.utils import ErrorTemplate, encode_error, base_url_error
+
+# Used to read the bodies of requests within the size limit.
+from publisher.utils import read_request_body
+
+# The entry points served by the dispatcher.
+from publisher.auth import auth_result
+from publisher.validate import validate_result, batch_result
+
+# Used to match the urls of unsupported requests and to report the right
+# authorization scheme.
+from constants import (AUTH, VALIDATE, BATCH_VALIDATE,
+                       AUTH_AUTHORIZATION_HEADER, SESSION_AUTHORIZATION_HEADER)
+
+
+# The errors reported by the dispatcher itself.
+NO_HANDLER = ErrorTemplate('NoHandler',
+    'An error occurred. Please contact support.',
+    'No handler could be found for the requested resource.')
+INTERNAL_ERROR = ErrorTemplate('InternalError',
+    'An error occurred. Please contact support.',
+    'An internal server error occurred. Please check logs.')
+
+# The supported entry points, keyed against the api, version, format and
+# action of their urls. Each value is the function that processes the request
+# and the authorization scheme reported with 401 errors. Since the api, version
+# and format are part of the key, the functions do not check them again. The
+# functions return their errors rather than raising them.
+ENTRY_POINTS = {
+    ('paywallproxy', 'v1.0.0', 'json', 'auth'):
+        (auth_result, AUTH_AUTHORIZATION_HEADER),
+    ('paywallproxy', 'v1.0.0', 'json', 'validate'):
+        (validate_result, SESSION_AUTHORIZATION_HEADER),
+}
+
+# The supported entry points whose urls do not end with a product code,
+# keyed in the same way as ENTRY_POINTS.
+BATCH_ENTRY_POINTS = {
+    ('paywallproxy', 'v1.0.0', 'json', 'batchvalidate'):
+        (batch_result, SESSION_AUTHORIZATION_HEADER),
+}
+
+# Requests for a known action with an api, version or format that is not
+# supported are rare, so they are matched against the same url regexes as itty
+# uses and their base url is checked in full. This reports exactly the same
+# errors as the itty handlers.
+UNSUPPORTED = {
+    'auth': (compile('^' + AUTH + '/$'), auth_result,
+             AUTH_AUTHORIZATION_HEADER),
+    'validate': (compile('^' + VALIDATE + '/$'), validate_result,
+                 SESSION_AUTHORIZATION_HEADER),
+    'batchvalidate': (compile('^' + BATCH_VALIDATE + '/$'), batch_result,
+                      SESSION_AUTHORIZATION_HEADER),
+}
+
+# Product codes must match the PRODUCT_CODE regex of constants.py.
+PRODUCT_CODE = compile(r'\w+$')
+
+
+def normalize(url):
+    '''
+    Adds a trailing slash to the url, as itty does before routing, so that
+    the same urls are accepted and errors report the same resource.
+    '''
+    if not url.endswith('/'):
+        return url + '/'
+    return url
+
+
+def resolve(method, url):
+    '''
+    Finds the entry point of a request by splitting its normalized url once
+    and looking the parts up in ENTRY_POINTS.
+
+    This function returns a tuple of the function that processes the request,
+    the authorization scheme of the entry point and a tuple of the arguments
+    taken from the url (the product code, if the url has one), or None if the
+    request is not supported.
+    '''
+    parts = url.split('/')
+    if method != 'POST' or parts[0] != '' or parts[-1] != '':
+        return None
+
+    key = tuple(parts[1:5])
+    if len(parts) == 6:
+        entry = BATCH_ENTRY_POINTS.get(key)
+        if entry == None:
+            return None
+        return (entry[0], entry[1], ())
+
+    if len(parts) != 7:
+        return None
+    entry = ENTRY_POINTS.get(key)
+    if entry == None or PRODUCT_CODE.match(parts[5]) == None:
+        return None
+
+    return (entry[0], entry[1], (parts[5],))
+
+
+def call(function, scheme, url, arguments):
+    '''
+    Calls the function that processes a request with the given arguments and
+    turns its result or its error into a response.
+
+    This function returns a tuple of the status, the list of extra headers and
+    the json encoded body of the response. Errors are encoded the same way as
+    the handlers in errors.py encode them.
+    '''
+    try:
+        error, content = function(*arguments)
+    except Exception:
+        print_exc()
+        return (500, [], INTERNAL_ERROR(url))
+
+    if error != None:
+        return failure(url, error, scheme)
+    return (200, [], content)
+
+
+def failure(url, error, scheme):
+    '''
+    Turns an error, as a tuple of its code, message, status and debug message,
+    into a response in the same way as call.
+    '''
+    code, message, status, debug = error
+    headers = []
+    if status == 401:
+        headers.append(('WWW-Authenticate', scheme))
+    return (status, headers, encode_error(url, code, message, debug))
+
+
+def dispatch(method, url, environment, body):
+    '''
+    Routes a request to its entry point and processes it.
+
+    This function returns a tuple of the status, the list of extra headers and
+    the json encoded body of the response.
+    '''
+    url = normalize(url)
+    method = method.upper()
+    resolved = resolve(method, url)
+    if resolved != None:
+        function, scheme, arguments = resolved
+        return call(function, scheme, url, (url, environment, body) +
+                                           arguments)
+
+    # Let check_base_url report what is wrong with the url.
+    parts = url.split('/')
+    if method == 'POST' and len(parts) in (6, 7):
+        unsupported = UNSUPPORTED.get(parts[4])
+        if unsupported != None:
+            pattern, function, scheme = unsupported
+            match = pattern.match(url)
+            if match != None:
+                # The groups of the url regexes are the api, version, format
+                # and product code, in that order.
+                groups = match.groups()
+                error = base_url_error(*groups[:3])
+                if error != None:
+                    return failure(url, error, scheme)
+                return call(function, scheme, url, (url, environment, body) +
+                                                   groups[3:])
+
+    return (404, [], NO_HANDLER(url))
+
+
+def application(environ, start_response):
+    '''
+    A wsgi application that serves the auth and validate entry points through
+    the dispatcher rather than itty's routes.
+    '''
+    # The body is read in chunks, and only if its length is within the limit.
+    error, body = read_request_body(environ)
+    if error != None:
+        url = normalize(environ.get('PATH_INFO', ''))
+        status, headers, content = failure(url, error, None)
+    else:
+        status, headers, content = dispatch(environ['REQUEST_METHOD'],
+                                            environ.get('PATH_INFO', ''),
+                                            environ, body)
+
+    headers = [('Content-Type', 'application/json'),
+               ('Content-Length', str(len(content)))] + headers
+    start_response('%d %s' % (status, responses.get(status, '')), headers)
+    return [content]
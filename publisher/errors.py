@@ -36,11 +36,6 @@ from publisher.utils import (JsonBadSyntax, JsonUnauthorized, JsonForbidden,
 # Used to encode default errors, if a non-json error is encountered.
 from publisher.utils import encode_error
 
-# Used to match the urls for 401 errors.
-from re import match
-from constants import (AUTH, VALIDATE, AUTH_AUTHORIZATION_HEADER,
-                       SESSION_AUTHORIZATION_HEADER)
-
 
 @error(400)
 def bad_syntax(request, exception):
@@ -80,13 +75,11 @@ def unauthorized(request, exception):
     headers = []
 
     # WWW-Authenticate header is returned to tell the client which
-    # Authorization schemes are applicable to this resource. First, check the
-    # auth entry point.
-    if match(AUTH, request.path) != None:
-        headers.append(('WWW-Authenticate', AUTH_AUTHORIZATION_HEADER))
-    # Check the validate entry point.
-    elif match(VALIDATE, request.path) != None:
-        headers.append(('WWW-Authenticate', SESSION_AUTHORIZATION_HEADER))
+    # Authorization schemes are applicable to this resource. The entry point
+    # that raised the error tags it with its scheme (see raise_error in
+    # utils.py).
+    if exception.scheme != None:
+        headers.append(('WWW-Authenticate', exception.scheme))
 
     # The content is json encoded by the report_error function in utils.py.
     # In order to report the error, simply cast the error as a string.
@@ -0,0 +1,466 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright (c) 2012, Polar Mobile.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name Polar Mobile nor the names of its contributors
+#     may be used to endorse or promote products derived from this software
+#     without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL POLAR MOBILE BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Used to hold the connections in a single thread.
+from asyncore import dispatcher, file_dispatcher, loop
+from asynchat import async_chat
+import socket
+
+# Used to wake the event loop up when a response is ready.
+from os import pipe, write, close
+
+# Used to process the requests in a pool of threads, and to keep the
+# pipelined requests of each connection in order.
+from Queue import Queue
+from threading import Thread
+from collections import deque
+
+# Used to close idle connections.
+from time import time
+
+# Used to log requests that fail unexpectedly.
+from traceback import print_exc
+
+# Used to write the status line of responses.
+from httplib import responses
+
+# Used to route and process the requests, and to reject bodies that are too
+# large before they are read.
+from publisher.dispatch import dispatch, normalize, failure, INTERNAL_ERROR
+from publisher.utils import content_length
+
+# Used to configure the front end.
+from constants import (FRONTEND_THREADS, KEEP_ALIVE_TIMEOUT,
+                       KEEP_ALIVE_REQUESTS)
+
+# The largest request header accepted, in bytes.
+MAX_HEADER_SIZE = 65536
+
+# The number of requests a client may send ahead of the responses before the
+# connection stops reading from it.
+MAX_PIPELINED_REQUESTS = 16
+
+
+class Connection(async_chat):
+    '''
+    A connection from a client. The connection reads requests as they arrive,
+    hands them to the front end to be processed and writes each response back
+    once it is ready. The connection never blocks the event loop, and does not
+    hold a thread while it waits for a request or a response.
+
+    Connections are persistent, so a client can send many requests without
+    opening a new connection for each one. HTTP/1.1 connections are kept open
+    unless the client asks for them to be closed, and HTTP/1.0 connections are
+    only kept open if the client asks for it. A client may also send requests
+    before the previous responses have arrived, which is known as pipelining.
+    Pipelined requests are processed one at a time, so that the responses are
+    written in the same order as the requests were read.
+    '''
+    def __init__(self, sock, frontend):
+        '''
+        Starts reading the header of a request from the socket.
+        '''
+        async_chat.__init__(self, sock, frontend.map)
+        self.frontend = frontend
+        self.buffer = []
+        self.size = 0
+        self.header = None
+
+        # The requests that have been read but not answered, oldest first.
+        # Only the oldest is being processed. A request that could not be
+        # parsed is recorded as None, and a request whose body was rejected
+        # holds the error in place of its body.
+        self.pending = deque()
+
+        # The number of requests read so far, whether the connection will be
+        # closed once the pending requests are answered, and the last time
+        # anything was read or written.
+        self.count = 0
+        self.closing = False
+        self.used = time()
+        self.set_terminator('\r\n\r\n')
+
+    def readable(self):
+        '''
+        Stops reading once the connection is closing, or while too many
+        requests are waiting to be answered.
+        '''
+        if self.closing or len(self.pending) >= MAX_PIPELINED_REQUESTS:
+            return False
+        return async_chat.readable(self)
+
+    def idle(self, now):
+        '''
+        Returns True if the connection has neither a request nor a response in
+        progress and has not been used for longer than the idle timeout.
+        '''
+        if len(self.pending) > 0 or len(self.producer_fifo) > 0:
+            return False
+        return now - self.used > self.frontend.keep_alive_timeout
+
+    def collect_incoming_data(self, data):
+        '''
+        Stores the data read from the socket until the header or the body is
+        complete. Clients that send an overly large header are disconnected.
+        '''
+        self.used = time()
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.header == None and self.size > MAX_HEADER_SIZE:
+            self.close()
+
+    def found_terminator(self):
+        '''
+        Called once the header or the body of a request has been read.
+        '''
+        data = ''.join(self.buffer)
+        self.buffer = []
+        self.size = 0
+
+        # Requests that arrive after the connection started closing are
+        # ignored.
+        if self.closing:
+            return
+
+        # Once the header is read, the body is read if there is one. A request
+        # that cannot be parsed is answered with an error and ends the
+        # connection, since the start of the next request cannot be found.
+        if self.header == None:
+            self.header = self.parse_header(data)
+            if self.header == None:
+                self.closing = True
+                self.add_request(None)
+                return
+
+            # A body that is too large is not read at all. The request is
+            # answered with an error and the connection is closed, since the
+            # body is still on its way.
+            method, url, environment = self.header
+            error, length = content_length(environment)
+            if error != None:
+                self.header = None
+                self.closing = True
+                self.add_request((method, url, environment, error))
+                return
+
+            if length > 0:
+                self.set_terminator(length)
+                return
+            data = ''
+
+        method, url, environment = self.header
+        self.header = None
+        self.set_terminator('\r\n\r\n')
+
+        # Decide whether the connection is kept open after this request.
+        self.count += 1
+        if not self.keep_alive(environment):
+            self.closing = True
+
+        self.add_request((method, url, environment, data))
+
+    def keep_alive(self, environment):
+        '''
+        Returns True if the connection can be kept open after the request with
+        the given environment has been answered.
+        '''
+        limit = self.frontend.keep_alive_requests
+        if limit <= 0 or self.count >= limit:
+            return False
+
+        option = environment.get('HTTP_CONNECTION', '').lower()
+        if environment['SERVER_PROTOCOL'] == 'HTTP/1.1':
+            return option != 'close'
+        return option == 'keep-alive'
+
+    def add_request(self, request):
+        '''
+        Adds a request to the pending requests, and starts processing it if no
+        other request is being processed.
+        '''
+        self.pending.append(request)
+        if len(self.pending) == 1:
+            self.process_request()
+
+    def process_request(self):
+        '''
+        Hands the oldest pending request to the front end.
+        '''
+        request = self.pending[0]
+        if request == None:
+            self.send_response(400, [], '')
+        elif isinstance(request[3], tuple):
+            method, url, environment, error = request
+            self.send_response(*failure(normalize(url), error, None))
+        else:
+            self.frontend.dispatch(self, *request)
+
+    def parse_header(self, data):
+        '''
+        Parses the request line and the headers of a request. The headers are
+        stored in a dictionary using the same keys as a wsgi environment.
+
+        This function returns a tuple of the method, the url and the
+        environment, or None if the header is not valid.
+        '''
+        lines = data.split('\r\n')
+        parts = lines[0].split()
+        if len(parts) != 3:
+            return None
+        method, path, protocol = parts
+        url = path.split('?', 1)[0]
+
+        environment = {}
+        environment['REQUEST_METHOD'] = method
+        environment['PATH_INFO'] = url
+        environment['SERVER_PROTOCOL'] = protocol
+
+        # The address of the client, as a wsgi server gives it, which is used
+        # to limit its attempts to log in (see throttle.py).
+        if self.addr != None:
+            environment['REMOTE_ADDR'] = self.addr[0]
+            environment['REMOTE_PORT'] = str(self.addr[1])
+        for line in lines[1:]:
+            name, separator, value = line.partition(':')
+            if separator == '':
+                return None
+            key = name.strip().upper().replace('-', '_')
+            if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                key = 'HTTP_' + key
+            environment[key] = value.strip()
+
+        # The length of the body must be a number.
+        if not environment.get('CONTENT_LENGTH', '0').isdigit():
+            return None
+
+        return (method, url, environment)
+
+    def send_response(self, status, headers, content):
+        '''
+        Writes the response to the oldest pending request. The connection is
+        closed once the response is sent if it is closing and no other request
+        is pending; otherwise the next pending request is processed.
+        '''
+        self.pending.popleft()
+        self.used = time()
+        last = self.closing and len(self.pending) == 0
+
+        lines = ['HTTP/1.1 %d %s' % (status, responses.get(status, '')),
+                 'Content-Type: application/json',
+                 'Content-Length: %d' % len(content)]
+        if last:
+            lines.append('Connection: close')
+        else:
+            lines.append('Connection: keep-alive')
+        for name, value in headers:
+            lines.append('%s: %s' % (name, value))
+        self.push('\r\n'.join(lines) + '\r\n\r\n' + content)
+
+        if last:
+            self.close_when_done()
+        elif len(self.pending) > 0:
+            self.process_request()
+
+    def handle_close(self):
+        '''
+        Called when the client stops sending. Requests that have already been
+        read are still answered before the connection is closed.
+        '''
+        if len(self.pending) == 0 and len(self.producer_fifo) == 0:
+            self.close()
+        else:
+            self.closing = True
+
+
+class Trigger(file_dispatcher):
+    '''
+    A pipe that wakes the event loop up. Threads write to the pipe when they
+    have finished a response, and the event loop then writes every finished
+    response to its connection.
+    '''
+    def __init__(self, frontend):
+        '''
+        Creates the pipe and adds it to the event loop of the front end.
+        '''
+        reader, self.writer = pipe()
+        file_dispatcher.__init__(self, reader, frontend.map)
+        close(reader)
+        self.frontend = frontend
+
+    def writable(self):
+        '''
+        Nothing is ever written through the event loop.
+        '''
+        return False
+
+    def pull(self):
+        '''
+        Wakes the event loop up. This can be called from any thread.
+        '''
+        write(self.writer, 'x')
+
+    def handle_read(self):
+        '''
+        Empties the pipe and writes the finished responses.
+        '''
+        self.recv(8192)
+        self.frontend.send_responses()
+
+
+class Frontend(dispatcher):
+    '''
+    An event driven front end for the auth and validate entry points. A single
+    thread runs the event loop, which accepts connections, reads requests and
+    writes responses for every client at once, so idle and slow clients cost
+    a socket rather than a thread. Requests that have been read are processed
+    by a fixed pool of threads, since checking credentials and sessions may
+    wait for the storage. Requests are routed by dispatch.py, which reuses the
+    validators of auth.py and validate.py, so both front ends accept and
+    reject exactly the same requests.
+
+    The event loop uses poll rather than select, so it is not limited to a
+    thousand or so connections. Connections are kept open for up to
+    keep_alive_requests requests, and are closed once they have been idle for
+    keep_alive_timeout seconds.
+    '''
+    def __init__(self, host, port, threads=FRONTEND_THREADS,
+                 keep_alive_timeout=KEEP_ALIVE_TIMEOUT,
+                 keep_alive_requests=KEEP_ALIVE_REQUESTS):
+        '''
+        Listens on the given host and port and starts the threads that
+        process requests.
+        '''
+        self.keep_alive_timeout = keep_alive_timeout
+        self.keep_alive_requests = keep_alive_requests
+        self.map = {}
+        dispatcher.__init__(self, map=self.map)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(1024)
+
+        self.stopped = False
+        self.trigger = Trigger(self)
+        self.completed = deque()
+        self.requests = Queue()
+        self.threads = []
+        for index in range(threads):
+            thread = Thread(target=self.run_thread,
+                            name='FrontendThread-%d' % index)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def handle_accept(self):
+        '''
+        Accepts a connection from a client.
+        '''
+        pair = self.accept()
+        if pair != None:
+            Connection(pair[0], self)
+
+    def dispatch(self, connection, method, url, environment, body):
+        '''
+        Queues a request to be processed by one of the threads.
+        '''
+        self.requests.put((connection, method, url, environment, body))
+
+    def run_thread(self):
+        '''
+        Processes queued requests until None is queued. A request that fails
+        unexpectedly is answered with an internal error, so that the thread
+        keeps serving and the client is not left waiting.
+        '''
+        while True:
+            item = self.requests.get()
+            if item == None:
+                break
+
+            connection, method, url, environment, body = item
+            try:
+                response = dispatch(method, url, environment, body)
+            except Exception:
+                print_exc()
+                response = (500, [], INTERNAL_ERROR(url))
+            self.completed.append((connection, response))
+            self.trigger.pull()
+
+    def send_responses(self):
+        '''
+        Writes every finished response to its connection. This is only called
+        by the event loop.
+        '''
+        while len(self.completed) > 0:
+            connection, (status, headers, content) = self.completed.popleft()
+            if connection.connected:
+                connection.send_response(status, headers, content)
+
+    def close_idle(self):
+        '''
+        Closes every connection that has been idle for too long.
+        '''
+        now = time()
+        for channel in self.map.values():
+            if isinstance(channel, Connection) and channel.idle(now):
+                channel.close()
+
+    def serve_forever(self):
+        '''
+        Runs the event loop until stop is called. Idle connections are looked
+        for about once a second.
+        '''
+        checked = time()
+        while not self.stopped:
+            loop(timeout=1, use_poll=True, map=self.map, count=1)
+            if time() - checked >= 1:
+                self.close_idle()
+                checked = time()
+
+        # Let the threads finish, then close every connection.
+        for thread in self.threads:
+            self.requests.put(None)
+        for thread in self.threads:
+            thread.join()
+        for channel in self.map.values():
+            channel.close()
+        close(self.trigger.writer)
+
+    def stop(self):
+        '''
+        Asks the event loop to stop. This can be called from any thread.
+        '''
+        self.stopped = True
+        self.trigger.pull()
+
+
+def serve(host, port, threads=FRONTEND_THREADS):
+    '''
+    Serves the auth and validate entry points on the given host and port
+    using the event driven front end.
+    '''
+    Frontend(host, port, threads).serve_forever()
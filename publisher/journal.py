@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright (c) 2012, Polar Mobile.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name Polar Mobile nor the names of its contributors
+#     may be used to endorse or promote products derived from this software
+#     without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL POLAR MOBILE BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Used to write the journal in the background and to wait for it.
+from threading import Thread, Condition, Event, Lock, local
+
+# Used to make sure the journal reaches the disk.
+from os import fsync
+
+# Used to encode the records of the journal.
+try:
+    from json import dumps
+except ImportError:
+    from simplejson import dumps
+
+
+class Journal(object):
+    '''
+    An append-only file of records describing changes to the storage. Each
+    record is a json encoded list written on its own line.
+
+    Writing a record to the disk is expensive because the file has to be
+    synchronized with fsync. Rather than synchronizing the file once per
+    record, records are queued by append and written by a background thread.
+    The thread writes every record that is waiting at once and synchronizes
+    the file a single time for the whole batch, which is known as a group
+    commit. The more threads are appending, the larger the batches and the
+    cheaper each record becomes.
+
+    A thread that needs to know that its records are on the disk calls sync,
+    which blocks until the batch containing its last record is written.
+    '''
+    def __init__(self, path):
+        '''
+        Opens the journal at the given path for appending and starts the
+        thread that writes it.
+        '''
+        self.file = open(path, 'ab')
+
+        # The condition protects the queue of records and the current batch.
+        # Each batch has an event that is set once it has been written.
+        self.condition = Condition()
+        self.pending = []
+        self.batch = Event()
+        self.closed = False
+
+        # The file lock is held while a batch is taken from the queue and
+        # written, so that batches are always written in order, even when the
+        # file is being rotated.
+        self.file_lock = Lock()
+
+        # The batch of the last record appended by each thread.
+        self.local = local()
+
+        self.thread = Thread(target=self.run, name='Journal')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def append(self, record):
+        '''
+        Queues a record to be written to the journal. The record is a list of
+        values that can be encoded as json. This function does not wait for
+        the record to be written.
+        '''
+        line = dumps(record) + '\n'
+        self.condition.acquire()
+        try:
+            self.pending.append(line)
+            self.local.batch = self.batch
+            self.condition.notify()
+
+        finally:
+            self.condition.release()
+
+    def sync(self):
+        '''
+        Blocks until every record appended by the calling thread has been
+        written to the disk.
+        '''
+        batch = getattr(self.local, 'batch', None)
+        if batch != None:
+            batch.wait()
+
+    def rotate(self, path):
+        '''
+        Writes any queued records to the current file, then closes it and
+        continues the journal in the file at the given path.
+        '''
+        self.file_lock.acquire()
+        try:
+            self.write()
+            self.file.close()
+            self.file = open(path, 'ab')
+
+        finally:
+            self.file_lock.release()
+
+    def close(self):
+        '''
+        Writes any queued records, stops the background thread and closes the
+        file.
+        '''
+        self.condition.acquire()
+        try:
+            self.closed = True
+            self.condition.notify()
+
+        finally:
+            self.condition.release()
+
+        self.thread.join()
+        self.file.close()
+
+    def write(self):
+        '''
+        Takes every queued record and writes them as a single batch. Note that
+        the file lock is assumed to be held before this function is called.
+        '''
+        # Take the queued records. Appending can continue while the batch is
+        # being written.
+        self.condition.acquire()
+        try:
+            lines = self.pending
+            batch = self.batch
+            self.pending = []
+            self.batch = Event()
+
+        finally:
+            self.condition.release()
+
+        if len(lines) > 0:
+            self.file.write(''.join(lines))
+            self.file.flush()
+            fsync(self.file.fileno())
+        batch.set()
+
+    def run(self):
+        '''
+        Writes batches of records until the journal is closed.
+        '''
+        while True:
+            # Wait for records to be queued.
+            self.condition.acquire()
+            try:
+                while len(self.pending) == 0 and not self.closed:
+                    self.condition.wait()
+                closed = self.closed
+
+            finally:
+                self.condition.release()
+
+            self.file_lock.acquire()
+            try:
+                self.write()
+
+            finally:
+                self.file_lock.release()
+
+            if closed:
+                return
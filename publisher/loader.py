@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright (c) 2012, Polar Mobile.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name Polar Mobile nor the names of its contributors
+#     may be used to endorse or promote products derived from this software
+#     without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL POLAR MOBILE BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Used to read the catalog files.
+import csv
+
+# Used to decode the lines of json catalogs.
+try:
+    from json import loads
+except ImportError:
+    from simplejson import loads
+
+# Used to report the progress of a load.
+from sys import stderr
+
+
+def compact(text):
+    '''
+    Returns the text as a byte string if it only contains ascii characters,
+    and as a unicode string otherwise. Byte strings take a quarter of the
+    memory of unicode strings, and compare and hash the same as unicode
+    strings containing the same characters, so they can still be looked up
+    with the unicode strings decoded from requests.
+    '''
+    if isinstance(text, str):
+        try:
+            text.decode('ascii')
+            return text
+        except UnicodeError:
+            return text.decode('utf-8')
+    try:
+        return text.encode('ascii')
+    except UnicodeError:
+        return text
+
+
+def read_json_users(catalog, path):
+    '''
+    Reads users from a file containing a json object on each line, like the
+    following example. Blank lines are skipped.
+
+    {"username": "user01", "password": "test", "valid": true,
+     "products": ["product01", "product02"]}
+
+    This function is a generator yielding a tuple of the username, password,
+    valid flag and list of products of each user.
+    '''
+    number = 0
+    for line in catalog:
+        number += 1
+        if line.strip() == '':
+            continue
+
+        try:
+            user = loads(line)
+            yield (compact(user['username']), compact(user['password']),
+                   bool(user['valid']),
+                   [compact(product) for product in user['products']])
+
+        except (ValueError, KeyError, TypeError):
+            raise ValueError('%s, line %d: Invalid user.' % (path, number))
+
+
+def read_csv_users(catalog, path):
+    '''
+    Reads users from a csv file. The first row names the columns, which must
+    include username, password, valid and products, like the following
+    example. The valid column is either "true" or "false" and the products
+    are separated by spaces.
+
+    username,password,valid,products
+    user01,test,true,product01 product02
+
+    This function is a generator yielding a tuple of the username, password,
+    valid flag and list of products of each user.
+    '''
+    reader = csv.DictReader(catalog)
+    for user in reader:
+        try:
+            valid = user['valid'].strip().lower()
+            if valid not in ('true', 'false'):
+                raise ValueError()
+            yield (compact(user['username']), compact(user['password']),
+                   valid == 'true',
+                   [compact(product) for product in user['products'].split()])
+
+        except (ValueError, KeyError, AttributeError):
+            raise ValueError('%s, line %d: Invalid user.' %
+                             (path, reader.line_num))
+
+
+def print_progress(count):
+    '''
+    Reports the number of users loaded so far on the standard error stream.
+    '''
+    stderr.write('Loaded %d users.\n' % count)
+
+
+def load_users(storage, path, progress=None, interval=100000):
+    '''
+    Adds every user in the catalog file at the given path to the storage.
+    Files whose names end in ".csv" are read as csv (see read_csv_users) and
+    all other files are read as json lines (see read_json_users).
+
+    The file is read one line at a time and each user is added to the storage
+    as soon as it is read, so only the storage itself grows with the size of
+    the catalog. If a progress function is given, it is called with the
+    number of users loaded after every interval users and once the load is
+    complete.
+
+    This function returns the number of users loaded. A ValueError naming the
+    line is raised if a user in the file is invalid. The users before it are
+    kept.
+    '''
+    catalog = open(path, 'rb')
+    try:
+        if path.lower().endswith('.csv'):
+            reader = read_csv_users(catalog, path)
+        else:
+            reader = read_json_users(catalog, path)
+
+        # Catalogs contain few distinct products, so every user shares the
+        # same string for each product rather than holding a copy.
+        codes = {}
+
+        count = 0
+        for username, password, valid, products in reader:
+            products = [codes.setdefault(product, product)
+                        for product in products]
+            storage.add_user(username, password, valid, products)
+            count += 1
+            if progress != None and count % interval == 0:
+                progress(count)
+
+    finally:
+        catalog.close()
+
+    if progress != None and (count == 0 or count % interval != 0):
+        progress(count)
+    return count
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright (c) 2012, Polar Mobile.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name Polar Mobile nor the names of its contributors
+#     may be used to endorse or promote products derived from this software
+#     without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL POLAR MOBILE BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Used to build the read write lock.
+from threading import Condition, Lock
+
+
+class ReadWriteLock(object):
+    '''
+    A lock that can be held by many readers at once, or by a single writer.
+    Readers only block each other when a writer holds the lock or is waiting
+    for it. Writers are given preference so that a steady stream of readers
+    cannot starve them.
+
+    Note that this lock is not re-entrant; a thread must not try to acquire it
+    again while holding it.
+    '''
+    def __init__(self):
+        '''
+        Creates an unlocked read write lock.
+        '''
+        # The condition protects the counters below and is used to wake up
+        # threads that are waiting for the lock.
+        self.condition = Condition(Lock())
+        self.readers = 0
+        self.writer = False
+        self.waiting_writers = 0
+
+    def acquire_read(self):
+        '''
+        Blocks until the lock can be shared with other readers.
+        '''
+        self.condition.acquire()
+        try:
+            while self.writer or self.waiting_writers > 0:
+                self.condition.wait()
+            self.readers += 1
+
+        finally:
+            self.condition.release()
+
+    def release_read(self):
+        '''
+        Releases a lock acquired with acquire_read.
+        '''
+        self.condition.acquire()
+        try:
+            self.readers -= 1
+            if self.readers == 0:
+                self.condition.notifyAll()
+
+        finally:
+            self.condition.release()
+
+    def acquire_write(self):
+        '''
+        Blocks until no other thread holds the lock.
+        '''
+        self.condition.acquire()
+        try:
+            self.waiting_writers += 1
+            while self.writer or self.readers > 0:
+                self.condition.wait()
+            self.waiting_writers -= 1
+            self.writer = True
+
+        finally:
+            self.condition.release()
+
+    def release_write(self):
+        '''
+        Releases a lock acquired with acquire_write.
+        '''
+        self.condition.acquire()
+        try:
+            self.writer = False
+            self.condition.notifyAll()
+
+        finally:
+            self.condition.release()
+
+
+class LockStripes(object):
+    '''
+    A fixed set of read write locks shared by the whole process. Each key is
+    mapped to one of the locks by its hash, so that threads working on
+    different keys rarely wait for each other, while threads working on the
+    same key are always serialized by the same lock.
+    '''
+    def __init__(self, count):
+        '''
+        Creates the given number of locks.
+        '''
+        self.locks = [ReadWriteLock() for i in range(count)]
+
+    def __call__(self, key):
+        '''
+        Returns the lock that protects the given key.
+        '''
+        return self.locks[hash(key) % len(self.locks)]
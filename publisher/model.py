@@ -26,8 +26,9 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
 # THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-# Used to control access to the model's shared data.
-from threading import RLock
+# Used to run the session reaper in the background and to protect the
+# creation of the storage.
+from threading import Lock, Thread, Event
 
 # Used to raise authentication errors.
 from publisher.utils import raise_error
@@ -35,143 +36,300 @@ from publisher.utils import raise_error
 # Used to generate random session keys.
 from uuid import uuid4
 
+# Used to issue and check self verifying session tokens, and to generate a
+# secret for them when none is configured.
+from publisher.tokens import create_token, read_token
+from os import urandom
+
 # Used to track the persistence of session keys.
-from datetime import datetime, timedelta
+from time import time
+
+# Used to store the users and sessions.
+from publisher.storage import open_storage
+
+# Used to load users from a catalog file.
+from publisher.loader import load_users, print_progress
+
+# Used to verify hashed passwords outside the request threads.
+from publisher.passwords import (VerifierPool, CredentialCache, is_hashed,
+                                 hash_password)
+
+# Used to look users up in an external directory.
+from publisher.directory import UserDirectory, DirectoryError
+
+# Used to initialize the storage and define the timeout for session keys.
+from constants import (SESSION_TIMEOUT, REAPER_INTERVAL, SESSION_TOKENS,
+                       SESSION_SECRET, STORAGE, USERS_FILE, USER_DIRECTORY,
+                       users)
 
-# Used to initialize the model.users dictionary and define the timeout for
-# session keys.
-from constants import SESSION_TIMEOUT, users
+# Used to tag 401 errors with the authorization scheme of their entry point.
+from constants import AUTH_AUTHORIZATION_HEADER, SESSION_AUTHORIZATION_HEADER
 
-# Used to perform a deep copy of the users dictionary to ensure that no
-# references are copied.
-from copy import deepcopy
+
+# The errors reported when a user cannot be authenticated or a session cannot
+# be validated, as tuples of the code, message, status and debug message of
+# each error. These are the arguments that raise_error takes after the url.
+INVALID_CREDENTIALS = ('InvalidPaywallCredentials',
+                       'The credentials you have provided are not valid.',
+                       401, None)
+SESSION_EXPIRED = ('SessionExpired',
+                   'Your session has expired. Please log back in.', 401, None)
+ACCOUNT_PROBLEM = ('AccountProblem',
+                   'Your account is not valid. Please contact support.', 403,
+                   None)
+INVALID_PRODUCT = ('InvalidProduct',
+                   'The requested article could not be found.', 404, None)
+DIRECTORY_UNAVAILABLE = ('DirectoryUnavailable',
+                         'An error occurred. Please contact support.', 500,
+                         'The user directory could not be reached.')
 
 
 class model:
     '''
-    In order to simplify the design of this sample, the state of the system is
-    stored in memory, as opposed to a database. The server is then run in a
-    single process with multiple threads. This model class contains a singleton
-    that stores the state of the server.
-
-    The model is structured as follows. The model contains a dictionary called
-    users that is keyed against the usersnames of the valid users. Each value
-    in this dictionary is a dictionary containing a number of keys.
-
-    The first key is "valid". The value of this key is a boolean indicating if
-    a user's account is valid or not. The second key is "products", which
-    contains a list of product codes that the user has access to. The next key
-    is "password", which contains the user's password. Note that in a
-    production system, the user's password should be salted and hashed before
-    it is saved. The last key is "session ids", whose value is a dictionary
-    with session id keys and timestamp values. An example follows:
-
-    users = {
-        "username": {
-            "valid": True,
-            "products": ["test1","test2"],
-            "password": "test"
-            "session ids": {<session id>: (product, <time stamp>)}
-            }
-        }
+    This model class contains a singleton that stores the state of the server.
+    The state itself is kept by a storage object (see storage.py), which is
+    chosen by the STORAGE setting in constants.py. By default, the state of
+    the system is stored in memory, as opposed to a database, and the server
+    is run in a single process with multiple threads. The SQLite storage can
+    be used instead to keep sessions across restarts.
+
+    The model implements the rules of the paywall on top of the storage; it
+    checks credentials and entitlements, and decides when sessions expire.
+    Each session has a deadline, in whole seconds since the epoch, after which
+    it is no longer valid. Expired sessions are reclaimed in the background by
+    the SessionReaper thread rather than on every request. Each user may hold
+    at most MAX_USER_SESSIONS sessions; once the limit is reached, creating a
+    session evicts the one that was validated least recently.
+
+    When SESSION_TOKENS is enabled in constants.py, the model does not store
+    sessions at all. Instead, create_session_id issues a token signed with
+    SESSION_SECRET that contains the username, product and deadline of the
+    session (see tokens.py). validate_session only has to check the signature
+    and the user's entitlements, so any number of servers sharing the secret
+    can validate the same tokens. The only state kept for tokens is the set of
+    signatures of tokens that were revoked before their deadline.
+
+    Passwords may be stored hashed (see passwords.py). Hashed passwords are
+    verified by a pool of PASSWORD_WORKERS threads, after the user has been
+    looked up, so that no lock is held while a password is hashed and the
+    number of passwords hashed at once is bounded. Users who log in again
+    with the same password within CREDENTIAL_CACHE_TTL seconds are found in a
+    cache of recently verified credentials instead.
+
+    When USER_DIRECTORY is set in constants.py, users logging in are looked
+    up in an external directory (see directory.py) rather than in the
+    storage. A user who logs in is copied to the storage, if the storage does
+    not already hold the same details, so that the storage can hold their
+    sessions. Sessions are validated against the directory as well, through
+    the cache of the directory client, so a disabled account or a removed
+    product takes effect within DIRECTORY_CACHE_TTL seconds. While the
+    directory cannot be reached, sessions are validated against the copy and
+    logins fail with a DirectoryUnavailable error. The copy of a user is
+    removed by the SessionReaper once the sessions of their last login have
+    expired, so the storage only holds the users who are still logged in.
     '''
-    # The object that contains the shared memory. Note how it is associated
-    # to the class and not an instance of the class. It is accessed using
-    # model.users. When an instance of this class is created, it checks to
-    # see if this is the first time the model singleton has been created
-    # by looking for users = None.
-    users = None
+    # The object that contains the shared state. Note how it is associated to
+    # the class and not an instance of the class. It is accessed using
+    # model.storage. When an instance of this class is created, it checks to
+    # see if this is the first time the model singleton has been created by
+    # looking for storage = None.
+    storage = None
+
+    # The secret used to sign session tokens. If no secret is configured, a
+    # random one is used, which means that tokens can only be validated by
+    # this process.
+    secret = SESSION_SECRET or urandom(32)
+
+    # The pool of threads that verifies hashed passwords. Like the storage,
+    # it is created with the first instance of this class, so that its
+    # threads are started in the process that serves requests.
+    verifier = None
+
+    # The cache of recently verified credentials, created with the verifier.
+    credentials = None
+
+    # A hash of a random password, created with the verifier. Passwords given
+    # for unknown users are checked against it, so that they take as long to
+    # refuse as the wrong password of a known user.
+    dummy_password = None
+
+    # The external directory of users, or None if users are kept in the
+    # storage.
+    directory = None
+
+    # The deadlines after which the users copied from the directory are
+    # removed from the storage, keyed against their usernames, and the lock
+    # that protects them. The dictionary is created with the storage.
+    copied = None
+    copied_lock = Lock()
+
+    # Protects the creation of the storage, the verifier and the credentials.
+    init_lock = Lock()
 
     def __init__(self):
         '''
         The constructor for the class. Note that self is a reference to the
         class' instance. It is like the "this" pointer in C++.
         '''
-        # If this is the first instance of the model class, we need to populate
-        # the users object with test data. We can check for the first instance
-        # by looking to see if users is None. Since multiple threads access the
-        # data, we need to block access to the shared object using a lock
-        # before modifying the data.
-        self.lock = RLock()
+        # If this is the first instance of the model class, we need to create
+        # the storage and populate it with test data. We can check for the
+        # first instance by looking to see if storage is None. Since multiple
+        # threads access the data, we need to block access to the shared
+        # object using a lock before modifying the data. The check is repeated
+        # once the lock is held as another thread may have initialized the
+        # data in the mean time.
+        if model.storage != None and model.verifier != None:
+            return
 
         # The try finally block is like an exception handler, except that it
         # ensures that the code in the finally block is always run. It is
         # useful in this case because we want to ensure that we do not
         # permanently lock other threads if this thread fails.
-        self.lock.acquire()
+        model.init_lock.acquire()
         try:
-            # Check to see if the users object is un-initialized. It will be
-            # if this is the first time an instance of model is created.
-            if model.users == None:
-                # Initialize the shared testing data by copying the dictionary
-                # in the constants file. deepcopy is used to ensure that python
-                # does not copy any references when it makes a copy of the
-                # users dictionary (from constants.py). Making a copy of the
-                # users dictionary makes testing easier.
-                model.users = deepcopy(users)
+            if model.verifier == None:
+                if USER_DIRECTORY != None:
+                    model.directory = UserDirectory(USER_DIRECTORY)
+                model.credentials = CredentialCache()
+                model.dummy_password = hash_password(urandom(16).encode('hex'))
+                model.verifier = VerifierPool()
+
+            # Check to see if the storage is un-initialized. It will be if
+            # this is the first time an instance of model is created.
+            if model.storage == None:
+                # Add the users in the constants file and the users catalog to
+                # the storage, then let the storage load any state it has
+                # kept. The storage is assigned last so that other threads
+                # never see it without the users.
+                storage = open_storage(STORAGE)
+                for username in users:
+                    user = users[username]
+                    storage.add_user(username, user['password'], user['valid'],
+                                     user['products'])
+                if USERS_FILE != None:
+                    load_users(storage, USERS_FILE, print_progress)
+                storage.open()
+                model.copied = {}
+                model.storage = storage
 
         finally:
-            self.lock.release()
+            model.init_lock.release()
 
     def create_session_id(self, username, product):
         '''
-        Creates a session key for the given user. Note that model.users is
-        assumed to be locked before this function is called. The user's
-        key and a timestamp are added to the model.users['session ids']
-        list.
+        Creates a session key for the given user and adds it to the storage
+        along with its deadline.
 
         This function takes the username and product as a parameter and returns
         the generated session key as a result.
+
+        When SESSION_TOKENS is enabled, a signed session token is returned and
+        nothing is stored.
         '''
+        # Create a deadline for the session id. This deadline will be checked
+        # later to make sure that the id is still valid.
+        deadline = int(time()) + SESSION_TIMEOUT * 60 * 60
+
+        # Tokens carry all of the information about the session with them.
+        if SESSION_TOKENS:
+            token = create_token(model.secret, username, product, deadline)
+            return unicode(token)
+
         # To generate session ids, this sample uses uuid4, which generates
         # a random unique identifier. Note that this method is not secure.
         # Please consult the cryptographic libraries packaged in your tool
         # set for proper session id generation.
         session_id = unicode(uuid4())
-
-        # Create a timestamp for the session id. This timestamp will be
-        # checked later to make sure that the id is still valid.
-        timestamp = datetime.now()
-
-        # Insert the session id into shared memory. Note that shared sessions
-        # is a map of session ids to timestamps.
-        sessions = model.users[username]['session ids']
-        sessions[session_id] = (product, timestamp)
+        model.storage.create_session(session_id, username, product, deadline)
 
         # Return the session id so that it can be reported back to the caller.
         return session_id
 
     def update_session_ids(self, username):
         '''
-        Loops through all of the session ids for a given user and checks to
-        see if session keys have been expired. This function should be
-        called when a user has been authenticated or when a product has been
-        validated.
+        Removes all of the session ids for a given user that have expired.
 
         Allowing a user to have multiple valid session keys lets them log into
         multiple devices without logging them out of their previous device.
+
+        Note that this function is no longer called on every request. Expired
+        session ids are reclaimed by expire_sessions instead.
+        '''
+        model.storage.expire_user_sessions(username, time())
+
+    def expire_sessions(self):
         '''
-        # Make sure the user is known.
-        assert username in model.users
+        Removes every session id and revoked token that has expired from the
+        storage. This function is called periodically by the SessionReaper
+        thread.
 
-        # Create a timedelta object to compare against the difference between
-        # the stored timestamp and now.
-        expired_limit = timedelta(hours=SESSION_TIMEOUT)
+        The users copied from the directory whose sessions have all expired
+        are removed from the storage as well.
 
-        # Loop through all the session ids and store only valid ids. We store
-        # only valid ids because we can't delete from the sessions dictionary
-        # while iterating over it.
-        valid_ids = {}
-        sessions = model.users[username]['session ids']
-        for session_id in sessions:
-            # If the key has not expired, store it to indicate that it is
-            # valid.
-            product, timestamp = sessions[session_id]
-            if (datetime.now() - timestamp) < expired_limit:
-                valid_ids[session_id] = (product, timestamp)
+        This function returns the number of session ids that were removed.
+        '''
+        now = time()
+        removed = model.storage.expire_sessions(now)
+        if model.directory != None:
+            self.expire_users(now)
+        return removed
 
-        # Swap the current session ids for the new set of valid is.
-        model.users[username]['session ids'] = valid_ids
+    def expire_users(self, now):
+        '''
+        Removes the users copied from the directory whose deadline is not
+        after now from the storage. The storage keeps users that still hold
+        sessions, such as sessions created by another process.
+
+        The lock is held while the users are removed, so a user logging in at
+        the same time is either removed before they are copied again, or has
+        a new deadline and is kept.
+        '''
+        model.copied_lock.acquire()
+        try:
+            expired = [username for username, deadline in model.copied.items()
+                       if deadline <= now]
+            for username in expired:
+                del model.copied[username]
+                model.storage.remove_user(username)
+
+        finally:
+            model.copied_lock.release()
+
+    def revoke_session(self, session_id):
+        '''
+        Removes a session id from the storage, so that it can no longer be
+        validated. Revoking an unknown session id does nothing.
+
+        This function takes the session id to revoke and returns True if the
+        session id was found.
+
+        When SESSION_TOKENS is enabled, the signature of the token is recorded
+        as revoked until the token expires.
+        '''
+        if SESSION_TOKENS:
+            return self.revoke_token(session_id)
+
+        return model.storage.remove_session(session_id)
+
+    def revoke_token(self, token):
+        '''
+        Revokes a session token created by create_session_id when
+        SESSION_TOKENS is enabled. Tokens that are invalid, expired or already
+        revoked are ignored.
+
+        This function takes the token to revoke and returns True if the token
+        was revoked.
+        '''
+        # Make sure the token is valid and has not expired.
+        contents = read_token(model.secret, token)
+        if contents == None:
+            return False
+        username, product, deadline, signature = contents
+        if time() >= deadline:
+            return False
+
+        # Remember the signature until the token expires on its own.
+        return model.storage.revoke_token(signature, deadline)
 
     def authenticate_user(self, url, username, password, product):
         '''
@@ -217,63 +375,161 @@ class model:
                 HTTP Error Code: 404
                 Required: Yes
         '''
-        self.lock.acquire()
+        error, result = self.check_credentials(username, password, product)
+        if error != None:
+            raise_error(url, *error, scheme=AUTH_AUTHORIZATION_HEADER)
+
+        # Return the session id and products.
+        return result
+
+    def check_credentials(self, username, password, product):
+        '''
+        Authenticates a user in the same way as authenticate_user, but returns
+        any error instead of raising it.
+
+        This function returns a tuple of the error, as a tuple of its code,
+        message, status and debug message, and None, or None and a tuple of
+        the new session id and the list of products.
+        '''
+        # Check to see if the username is known.
+        error, user = self.find_user(username)
+        if error != None:
+            return (error, None)
+
+        # The password of an unknown user is still hashed, so that the time
+        # taken to refuse it does not reveal which usernames exist.
+        if user == None:
+            model.verifier.verify(model.dummy_password, password)
+            return (INVALID_CREDENTIALS, None)
+
+        # Check to see if the password is valid.
+        if not self.check_password(username, user, password):
+            return (INVALID_CREDENTIALS, None)
+
+        # Check to see if the user is valid. The check for a valid account
+        # should come after the check for the password as the password
+        # validates the user's identity.
+        if not user['valid']:
+            return (ACCOUNT_PROBLEM, None)
+
+        # Check to see if the user has access to the requested product. The
+        # user's products are stored as a bitmap (see products.py).
+        registry = model.storage.registry
+        if not registry.entitled(user['entitlements'], product):
+            return (INVALID_PRODUCT, None)
+
+        # Users found in the directory are copied to the storage, which keeps
+        # their sessions, until the session created below has expired.
+        if model.directory != None:
+            self.store_user(username, user)
+
+        # Note that expired session keys are not cleaned up here; the
+        # SessionReaper thread reclaims them in the background.
+
+        # Return the session id and products.
+        session_id = self.create_session_id(username, product)
+        return (None, (session_id, registry.products(user['entitlements'])))
+
+    def find_user(self, username):
+        '''
+        Looks a user up in the directory, if there is one, or in the storage.
+
+        This function returns a tuple of the error, as a tuple of its code,
+        message, status and debug message, and None, or None and the
+        dictionary describing the user (see storage.py), which is None if the
+        user is not known.
+        '''
+        if model.directory == None:
+            return (None, model.storage.get_user(username))
+
+        try:
+            found = model.directory.get_user(username)
+        except DirectoryError:
+            return (DIRECTORY_UNAVAILABLE, None)
+        if found == None:
+            return (None, None)
+
+        # The user's products are turned into a bitmap of the storage's
+        # registry, as they are for the users in the storage.
+        user = {}
+        user['password'] = found['password']
+        user['valid'] = found['valid']
+        user['entitlements'] = \
+            model.storage.registry.entitlements(found['products'])
+        return (None, user)
+
+    def store_user(self, username, user):
+        '''
+        Copies a user found in the directory to the storage, unless the
+        storage already holds the same password, valid flag and products. The
+        copy is kept until SESSION_TIMEOUT hours from now.
+        '''
+        # The deadline is extended before the user is copied, so that the
+        # reaper cannot remove the copy before the session is created.
+        deadline = int(time()) + SESSION_TIMEOUT * 60 * 60
+        model.copied_lock.acquire()
         try:
-            # Most of the errors in this function share a common code and
-            # status.
-            code = 'InvalidPaywallCredentials'
-            status = 401
-
-            # Check to see if the username is known.
-            if username not in model.users:
-                message = 'The credentials you have provided are not valid.'
-                raise_error(url, code, message, status)
-
-            # Check to see if the password is valid.
-            if model.users[username]['password'] != password:
-                message = 'The credentials you have provided are not valid.'
-                raise_error(url, code, message, status)
-
-            # Check to see if the user is valid. The check for a valid account
-            # should come after the check for the password as the password
-            # validates the user's identity.
-            if not model.users[username]['valid']:
-                code = 'AccountProblem'
-                message = 'Your account is not valid. Please contact support.'
-                status = 403
-                raise_error(url, code, message, status)
-
-            # Check to see if the user has access to the requested product.
-            if product not in model.users[username]['products']:
-                code = 'InvalidProduct'
-                message = 'The requested article could not be found.'
-                status = 404
-                raise_error(url, code, message, status)
-
-            # Update all valid session keys. While this call is not required
-            # at this time, issuing it helps keep the database of session ids
-            # small; particularly since the user has likely not been accessing
-            # content recently as they are logging in. Calling update now will
-            # hopefully free up many keys, reducing the memory footprint of
-            # the server.
-            self.update_session_ids(username)
-
-            # Return the session id and products.
-            session_id = self.create_session_id(username, product)
-            products = model.users[username]['products']
-            return (session_id, products)
+            model.copied[username] = deadline
 
         finally:
-            self.lock.release()
+            model.copied_lock.release()
+
+        stored = model.storage.get_user(username)
+        if (stored != None and stored['password'] == user['password'] and
+                stored['valid'] == user['valid'] and
+                stored['entitlements'] == user['entitlements']):
+            return
+
+        products = model.storage.registry.products(user['entitlements'])
+        model.storage.add_user(username, user['password'], user['valid'],
+                               products)
+
+    def session_user(self, username):
+        '''
+        Looks up the user that a session or token belongs to. With a
+        directory, the user is looked up through the cache of the directory
+        client, so that changes to the user's account and products are seen
+        within DIRECTORY_CACHE_TTL seconds. If the directory cannot be
+        reached, the copy of the user in the storage is used instead.
+
+        The result is the same as the result of find_user.
+        '''
+        error, user = self.find_user(username)
+        if error == None:
+            return (None, user)
+
+        stored = model.storage.get_user(username)
+        if stored == None:
+            return (error, None)
+        return (None, stored)
+
+    def check_password(self, username, user, password):
+        '''
+        Returns True if the password matches the user's stored password. For
+        hashed passwords, the cache of recently verified credentials is
+        checked first; otherwise the password is verified by the pool, and
+        remembered if it matches. No lock is held while a hashed password is
+        verified.
+        '''
+        stored = user['password']
+        if not is_hashed(stored):
+            return model.verifier.verify(stored, password)
+
+        if model.credentials.check(username, user, password):
+            return True
+        if not model.verifier.verify(stored, password):
+            return False
+
+        model.credentials.add(username, user, password)
+        return True
 
     def validate_session(self, url, session_id, product):
         '''
-        This function takes a session id, attempts to find the users that
-        it is associated with. If it finds a user, it first updates the
-        session tokens and then checks to make sure that the session key
-        is still valid. It then returns the list of products that the user
-        has access to. If it finds no user, it reports that the session key
-        has been expired.
+        This function takes a session id and looks up the user that it is
+        associated with in the storage. If it finds a user, it checks to
+        make sure that the session key has not expired. It then returns the
+        list of products that the user has access to. If it finds no user, it
+        reports that the session key has been expired.
 
         Client Errors:
 
@@ -300,66 +556,182 @@ class model:
                 HTTP Error Code: 403
                 Required: Yes
         '''
-        self.lock.acquire()
-        try:
-            # Most of the errors in this function share a common code and
-            # status.
-            code = 'SessionExpired'
-            status = 401
-            message = 'Your session has expired. Please log back in.'
-
-            # Loop over all of the users and check for the valid session id.
-            for username in model.users:
-                # If the session id does not belong to this user, keep
-                # searching.
-                if session_id not in model.users[username]['session ids']:
-                    continue
-
-                # Check to see if the user is valid. The check for a valid
-                # account should come after the check for the session id as
-                # the password validates the user's identity.
-                if not model.users[username]['valid']:
-                    code = 'AccountProblem'
-                    message = ('Your account is not valid. Please contact '
-                               'support.')
-                    status = 403
-                    raise_error(url, code, message, status)
-
-                # Check to make sure the product is valid.
-                if product not in model.users[username]['products']:
-                    code = 'InvalidProduct'
-                    message = 'The requested article could not be found.'
-                    status = 404
-                    raise_error(url, code, message, status)
-
-                # Update the list of valid session ids; the session may have
-                # expired since the last validation.
-                self.update_session_ids(username)
-
-                # Check to see if the session id is valid; it may have been
-                # invalidated by the call to update_session_ids.
-                if session_id not in model.users[username]['session ids']:
-                    message = 'Your session has expired. Please log back in.'
-                    raise_error(url, code, message, status)
-
-                # Check to see if the session key is registered against the
-                # right product. The only way this can happen during normal
-                # operation is if a product that the user has authenticated
-                # has been deleted.
-                session = model.users[username]['session ids'][session_id]
-                stored_product, timestamp = session
-                if product != stored_product:
-                    # Their session has expired.
-                    raise_error(url, code, message, status)
-
-                # Return the user's products, which indicate a successful
-                # validation.
-                products = model.users[username]['products']
-                return products
-
-            # If nothing has been returned at this point, raise an error.
-            # We can only assume that their session key has expired.
-            raise_error(url, code, message, status)
+        # Tokens are validated without looking them up.
+        if SESSION_TOKENS:
+            return self.validate_token(url, session_id, product)
 
-        finally:
-            self.lock.release()
+        error, products = self.check_session(session_id, product, time())
+        if error != None:
+            raise_error(url, *error, scheme=SESSION_AUTHORIZATION_HEADER)
+
+        # Return the user's products, which indicate a successful validation.
+        return products
+
+    def check_validation(self, session_id, product):
+        '''
+        Validates a session in the same way as validate_session, but returns
+        any error instead of raising it. The result is the same as the result
+        of check_session.
+        '''
+        check = self.check_token if SESSION_TOKENS else self.check_session
+        return check(session_id, product, time())
+
+    def validate_sessions(self, pairs):
+        '''
+        Validates many sessions at once. This function takes a list of tuples
+        of a session id (or a session token when SESSION_TOKENS is enabled)
+        and a product, and checks every pair against the same time.
+
+        This function returns a list containing a tuple for each pair, in the
+        same order. Each tuple contains the error that validate_session would
+        have raised, as a tuple of its code, message, status and debug
+        message, and None, or None and the list of products that the user has
+        access to.
+        '''
+        check = self.check_token if SESSION_TOKENS else self.check_session
+        now = time()
+        return [check(session_id, product, now)
+                for session_id, product in pairs]
+
+    def check_session(self, session_id, product, now):
+        '''
+        Checks a session id in the same way as validate_session, as of the
+        given time, but returns any error instead of raising it.
+
+        This function returns a tuple of the error, as a tuple of its code,
+        message, status and debug message, and None, or None and the list of
+        products that the user has access to.
+        '''
+        # Look the session id up to find the user that owns it. If it cannot
+        # be found, we can only assume that the session key has expired.
+        session = model.storage.get_session(session_id)
+        if session == None:
+            return (SESSION_EXPIRED, None)
+
+        # The user may have been removed since the session was created.
+        error, user = self.session_user(session.username)
+        if error != None:
+            return (error, None)
+        if user == None:
+            return (SESSION_EXPIRED, None)
+
+        # Check to see if the user is valid. The check for a valid account
+        # should come after the check for the session id as the password
+        # validates the user's identity.
+        if not user['valid']:
+            return (ACCOUNT_PROBLEM, None)
+
+        # Check to make sure the product is valid.
+        registry = model.storage.registry
+        if not registry.entitled(user['entitlements'], product):
+            return (INVALID_PRODUCT, None)
+
+        # Check to see if the session id is still valid; it may have expired
+        # since the last validation. Only this session is checked, the reaper
+        # takes care of the others. If it has expired, remove it right away.
+        if now >= session.deadline:
+            model.storage.remove_session(session_id)
+            return (SESSION_EXPIRED, None)
+
+        # Check to see if the session key is registered against the right
+        # product. The only way this can happen during normal operation is if
+        # a product that the user has authenticated has been deleted.
+        if product != session.product:
+            # Their session has expired.
+            return (SESSION_EXPIRED, None)
+
+        # Mark the session as recently used, so that it is the last of the
+        # user's sessions to be evicted when the user holds too many.
+        model.storage.touch_session(session_id)
+
+        # Return the user's products, which indicate a successful validation.
+        return (None, registry.products(user['entitlements']))
+
+    def validate_token(self, url, token, product):
+        '''
+        Validates a session token created by create_session_id when
+        SESSION_TOKENS is enabled. The token's signature is checked, followed
+        by its deadline and whether it has been revoked. The user that the
+        token was issued to is then checked in the same way as
+        validate_session.
+
+        This function returns the list of products that the user has access
+        to, and raises the same errors as validate_session.
+        '''
+        error, products = self.check_token(token, product, time())
+        if error != None:
+            raise_error(url, *error, scheme=SESSION_AUTHORIZATION_HEADER)
+
+        # Return the user's products, which indicate a successful validation.
+        return products
+
+    def check_token(self, token, product, now):
+        '''
+        Checks a session token in the same way as validate_token, as of the
+        given time, but returns any error instead of raising it. The result
+        is the same as the result of check_session.
+        '''
+        # Make sure the token was issued by a server holding the secret.
+        contents = read_token(model.secret, token)
+        if contents == None:
+            return (SESSION_EXPIRED, None)
+        username, stored_product, deadline, signature = contents
+
+        # Make sure the token has not expired or been revoked.
+        if now >= deadline or model.storage.is_revoked(signature):
+            return (SESSION_EXPIRED, None)
+
+        # The user may have been removed since the token was issued.
+        error, user = self.session_user(username)
+        if error != None:
+            return (error, None)
+        if user == None:
+            return (SESSION_EXPIRED, None)
+
+        # Check to see if the user is valid. This also covers accounts that
+        # were disabled after the token was issued.
+        if not user['valid']:
+            return (ACCOUNT_PROBLEM, None)
+
+        # Check to make sure the product is valid.
+        registry = model.storage.registry
+        if not registry.entitled(user['entitlements'], product):
+            return (INVALID_PRODUCT, None)
+
+        # Check to see if the token was issued for the right product.
+        if product != stored_product:
+            return (SESSION_EXPIRED, None)
+
+        # Return the user's products, which indicate a successful validation.
+        return (None, registry.products(user['entitlements']))
+
+
+class SessionReaper(Thread):
+    '''
+    A background thread that periodically calls model.expire_sessions so that
+    the session ids of idle users are reclaimed without slowing down requests.
+    The thread is a daemon, so it does not prevent the server from exiting.
+    '''
+    def __init__(self, interval=REAPER_INTERVAL):
+        '''
+        Creates the reaper. The interval is the number of seconds to wait
+        between each pass over the expiry heap.
+        '''
+        Thread.__init__(self, name='SessionReaper')
+        self.daemon = True
+        self.interval = interval
+        self.stopped = Event()
+
+    def run(self):
+        '''
+        Expires session ids until the reaper is stopped.
+        '''
+        # Event.wait returns True as soon as stop is called.
+        while not self.stopped.wait(self.interval):
+            model().expire_sessions()
+
+    def stop(self):
+        '''
+        Asks the reaper to stop after its current pass.
+        '''
+        self.stopped.set()
@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright (c) 2012, Polar Mobile.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name Polar Mobile nor the names of its contributors
+#     may be used to endorse or promote products derived from this software
+#     without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL POLAR MOBILE BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Used to hash and verify passwords.
+from hashlib import sha256
+from hmac import new as hmac
+from os import urandom
+
+# Used to compare hashes without leaking timing information. Versions of
+# python older than 2.7.7 do not provide compare_digest.
+try:
+    from hmac import compare_digest
+except ImportError:
+    def compare_digest(a, b):
+        if len(a) != len(b):
+            return False
+        result = 0
+        for x, y in zip(a, b):
+            result |= ord(x) ^ ord(y)
+        return result == 0
+
+# Used to derive the hash of a password. Versions of python older than 2.7.8
+# do not provide pbkdf2_hmac, so it is computed with hmac instead, which is
+# much slower but gives the same hash.
+try:
+    from hashlib import pbkdf2_hmac
+except ImportError:
+    from hashlib import new as hash_new
+    from struct import pack
+
+    def pbkdf2_hmac(name, password, salt, iterations, dklen=None):
+        key = hmac(password, digestmod=lambda data='': hash_new(name, data))
+        size = key.digest_size
+        if dklen == None:
+            dklen = size
+
+        blocks = []
+        for index in xrange(1, (dklen + size - 1) // size + 1):
+            mac = key.copy()
+            mac.update(salt + pack('>I', index))
+            block = mac.digest()
+            result = long(block.encode('hex'), 16)
+            for iteration in xrange(iterations - 1):
+                mac = key.copy()
+                mac.update(block)
+                block = mac.digest()
+                result ^= long(block.encode('hex'), 16)
+            blocks.append(('%0*x' % (size * 2, result)).decode('hex'))
+
+        return ''.join(blocks)[:dklen]
+
+# Used to store the salt and hash of a password as text.
+from base64 import b64encode, b64decode
+
+# Used to verify passwords in a pool of threads.
+from Queue import Queue
+from threading import Thread, Lock
+
+# Used to remember recently verified passwords.
+from collections import OrderedDict
+from time import time
+
+# Used to configure the cost of each hash, the size of the pool and the
+# credential cache.
+from constants import (PASSWORD_ITERATIONS, PASSWORD_WORKERS,
+                       PASSWORD_QUEUE_SIZE, CREDENTIAL_CACHE_TTL,
+                       CREDENTIAL_CACHE_SIZE)
+
+# The prefix of hashed passwords. Passwords without it are stored as they were
+# given, as in the users dictionary of constants.py.
+PREFIX = 'pbkdf2_sha256$'
+
+# The number of random bytes in each salt.
+SALT_SIZE = 16
+
+
+def hash_password(password, iterations=PASSWORD_ITERATIONS, salt=None):
+    '''
+    Hashes a password with PBKDF2-HMAC-SHA256 and a random salt. The result
+    holds the number of iterations, the salt and the hash, so it can be stored
+    in place of the password (in the users dictionary of constants.py or a
+    users catalog) and checked with verify_password:
+
+        pbkdf2_sha256$<iterations>$<salt>$<hash>
+
+    Each iteration adds to the time taken to check a password, for attackers
+    as well as for the server, so PASSWORD_ITERATIONS sets the cost of a
+    login.
+    '''
+    if salt == None:
+        salt = urandom(SALT_SIZE)
+    if isinstance(password, unicode):
+        password = password.encode('utf-8')
+
+    digest = pbkdf2_hmac('sha256', password, salt, iterations)
+    return '%s%d$%s$%s' % (PREFIX, iterations, b64encode(salt),
+                           b64encode(digest))
+
+
+def is_hashed(stored):
+    '''
+    Returns True if the stored password was hashed by hash_password.
+    '''
+    return stored.startswith(PREFIX)
+
+
+def verify_password(stored, password):
+    '''
+    Returns True if the password matches the stored password, which is either
+    the result of hash_password or the password itself. The comparison takes
+    the same time wherever the first difference is.
+    '''
+    if isinstance(password, unicode):
+        password = password.encode('utf-8')
+
+    if not is_hashed(stored):
+        if isinstance(stored, unicode):
+            stored = stored.encode('utf-8')
+        return compare_digest(stored, password)
+
+    try:
+        iterations, salt, digest = stored[len(PREFIX):].split('$')
+        iterations = int(iterations)
+        salt = b64decode(salt)
+        digest = b64decode(digest)
+    except (ValueError, TypeError):
+        return False
+
+    return compare_digest(pbkdf2_hmac('sha256', password, salt, iterations),
+                          digest)
+
+
+class VerifierPool(object):
+    '''
+    Verifies hashed passwords with a fixed number of threads, so that the
+    number of logins hashing at once, and the CPU they use, is bounded no
+    matter how many requests arrive. When hashlib is built with OpenSSL, the
+    hash releases the interpreter lock, so the threads verify passwords in
+    parallel.
+
+    Requests wait in a queue of up to PASSWORD_QUEUE_SIZE passwords for a
+    thread to be free; once the queue is full, further requests wait to join
+    it. Passwords that are not hashed are compared right away, since they cost
+    nothing to check. If the pool has no threads, every password is verified
+    by the thread that asks.
+
+    No lock is held while a password is verified; the model looks the user up
+    first and verifies the password afterwards.
+    '''
+    def __init__(self, workers=PASSWORD_WORKERS, size=PASSWORD_QUEUE_SIZE):
+        '''
+        Creates the pool and starts its threads.
+        '''
+        self.requests = Queue(size)
+        self.threads = []
+        for index in range(workers):
+            thread = Thread(target=self.run_thread,
+                            name='PasswordVerifier-%d' % index)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def verify(self, stored, password):
+        '''
+        Returns True if the password matches the stored password, once a
+        thread of the pool has checked it.
+        '''
+        if len(self.threads) == 0 or not is_hashed(stored):
+            return verify_password(stored, password)
+
+        result = Queue(1)
+        self.requests.put((stored, password, result))
+        return result.get()
+
+    def run_thread(self):
+        '''
+        Verifies queued passwords until None is queued.
+        '''
+        while True:
+            item = self.requests.get()
+            if item == None:
+                break
+
+            stored, password, result = item
+            try:
+                result.put(verify_password(stored, password))
+            except Exception:
+                result.put(False)
+
+    def stop(self):
+        '''
+        Stops the threads once the passwords already queued are verified.
+        '''
+        for thread in self.threads:
+            self.requests.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+
+class CredentialCache(object):
+    '''
+    Remembers the users whose hashed passwords were verified recently, so
+    that a user who logs in again within CREDENTIAL_CACHE_TTL seconds does not
+    have their password hashed again.
+
+    Each entry is keyed against a username and holds a digest of the password
+    that was verified, signed with a key that is chosen at random when the
+    cache is created and never stored, along with the stored password and
+    valid flag of the user at the time. An entry is only used if the user's
+    stored password and valid flag are unchanged, so changing a user's
+    password or validity invalidates it.
+
+    At most CREDENTIAL_CACHE_SIZE entries are kept; once the cache is full,
+    the entry that was used least recently is evicted. The number of hits,
+    misses and evictions are kept in the hits, misses and evictions
+    attributes, so that the TTL and size can be tuned. A TTL of 0 disables the
+    cache.
+    '''
+    def __init__(self, ttl=CREDENTIAL_CACHE_TTL, size=CREDENTIAL_CACHE_SIZE):
+        '''
+        Creates an empty cache.
+        '''
+        self.ttl = ttl
+        self.size = size
+        self.key = urandom(32)
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def digest(self, username, password):
+        '''
+        Returns the keyed digest of a username and password.
+        '''
+        if isinstance(username, unicode):
+            username = username.encode('utf-8')
+        if isinstance(password, unicode):
+            password = password.encode('utf-8')
+        return hmac(self.key, username + '\0' + password, sha256).digest()
+
+    def check(self, username, user, password):
+        '''
+        Returns True if the password was verified for the user within the TTL
+        and the user's stored password and valid flag have not changed since.
+        '''
+        if self.ttl <= 0:
+            return False
+
+        digest = self.digest(username, password)
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(username, None)
+            if entry == None:
+                self.misses += 1
+                return False
+
+            # Drop entries that have expired or that were made for a
+            # different password or validity.
+            expected, stored, valid, deadline = entry
+            if (deadline <= time() or stored != user['password'] or
+                    valid != user['valid']):
+                self.misses += 1
+                return False
+
+            # Move the entry to the end, as the most recently used one.
+            self.entries[username] = entry
+            if not compare_digest(expected, digest):
+                self.misses += 1
+                return False
+
+            self.hits += 1
+            return True
+
+        finally:
+            self.lock.release()
+
+    def add(self, username, user, password):
+        '''
+        Remembers that the password was verified for the user.
+        '''
+        if self.ttl <= 0:
+            return
+
+        entry = (self.digest(username, password), user['password'],
+                 user['valid'], time() + self.ttl)
+        self.lock.acquire()
+        try:
+            self.entries.pop(username, None)
+            self.entries[username] = entry
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+        finally:
+            self.lock.release()
+
+    def invalidate(self, username):
+        '''
+        Forgets the password verified for the user, if any.
+        '''
+        self.lock.acquire()
+        try:
+            self.entries.pop(username, None)
+
+        finally:
+            self.lock.release()
+
+    def hit_rate(self):
+        '''
+        Returns the fraction of checks that were hits, or 0 if there were
+        none.
+        '''
+        checks = self.hits + self.misses
+        if checks == 0:
+            return 0.0
+        return float(self.hits) / checks
+
+
+# Prints the hash of a password, to be stored in place of the password.
+if __name__ == '__main__':
+    from getpass import getpass
+    print hash_password(getpass())
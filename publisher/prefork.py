@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright (c) 2012, Polar Mobile.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name Polar Mobile nor the names of its contributors
+#     may be used to endorse or promote products derived from this software
+#     without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL POLAR MOBILE BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Used to serve requests from a pool of threads in each worker.
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+from Queue import Queue
+from threading import Thread
+
+# Used to create the listening sockets.
+import socket
+
+# Used to run and supervise the worker processes.
+from os import fork, kill, waitpid, _exit, WNOHANG
+from signal import signal, SIGTERM, SIGINT, SIGKILL, SIG_IGN
+from errno import EINTR, ECHILD
+from time import time, sleep
+
+# Used to report workers that fail.
+from traceback import print_exc
+
+# Used to reclaim expired session ids in each worker.
+from publisher.model import SessionReaper
+
+# Used to configure the workers.
+from constants import (WORKERS, WORKER_THREADS, REUSE_PORT, SHUTDOWN_TIMEOUT,
+                       STORAGE)
+
+# The socket option that lets several sockets listen on the same port, or None
+# if the system does not support it.
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', None)
+
+# Workers that exit sooner than this many seconds after they are started are
+# restarted after the same delay, so that a worker that cannot start does not
+# keep the supervisor busy.
+RESTART_DELAY = 1
+
+
+def listen(host, port, reuse_port=False):
+    '''
+    Creates a socket listening on the given host and port. If reuse_port is
+    set, other sockets may listen on the same port at the same time.
+    '''
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        listener.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    listener.bind((host, port))
+    listener.listen(WSGIServer.request_queue_size)
+    return listener
+
+
+class PooledWSGIServer(WSGIServer):
+    '''
+    A WSGI server that accepts connections on an existing listening socket
+    and serves them with a fixed number of threads. Accepted connections are
+    queued until a thread is free, so the number of threads does not grow with
+    the number of clients.
+
+    When the server is closed, the connections that have already been
+    accepted are served before the threads stop.
+    '''
+    def __init__(self, listener, application, threads=WORKER_THREADS):
+        '''
+        Creates the server and starts its threads. The listener must already
+        be bound and listening.
+        '''
+        # The server is not bound, since it uses the listener instead of the
+        # socket it creates.
+        address = listener.getsockname()[:2]
+        WSGIServer.__init__(self, address, WSGIRequestHandler,
+                            bind_and_activate=False)
+        self.socket.close()
+        self.socket = listener
+        self.server_address = address
+        self.server_name = socket.getfqdn(address[0])
+        self.server_port = address[1]
+        self.setup_environ()
+        self.set_app(application)
+
+        self.requests = Queue()
+        self.threads = []
+        for index in range(threads):
+            thread = Thread(target=self.run_thread,
+                            name='RequestThread-%d' % index)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def process_request(self, request, client_address):
+        '''
+        Queues an accepted connection to be served by a thread.
+        '''
+        self.requests.put((request, client_address))
+
+    def run_thread(self):
+        '''
+        Serves queued connections until None is queued.
+        '''
+        while True:
+            item = self.requests.get()
+            if item == None:
+                break
+
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except:
+                self.handle_error(request, client_address)
+
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        '''
+        Stops listening, then waits for the threads to serve the connections
+        that have already been accepted.
+        '''
+        WSGIServer.server_close(self)
+        for thread in self.threads:
+            self.requests.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+class Supervisor(object):
+    '''
+    Runs a number of worker processes that serve the same port, and restarts
+    any worker that exits. Each worker serves requests with a
+    PooledWSGIServer.
+
+    When the supervisor receives SIGTERM or SIGINT, it asks every worker to
+    stop with SIGTERM. A worker that receives SIGTERM stops accepting
+    connections and finishes the ones it has accepted. Workers that are still
+    running after the shutdown timeout are killed.
+    '''
+    def __init__(self, host, port, application, workers=WORKERS,
+                 threads=WORKER_THREADS, reuse_port=REUSE_PORT,
+                 timeout=SHUTDOWN_TIMEOUT):
+        '''
+        Creates the supervisor. Nothing is started until serve is called.
+        '''
+        self.host = host
+        self.port = port
+        self.application = application
+        self.count = workers
+        self.threads = threads
+        self.timeout = timeout
+
+        # Each worker can only listen on its own socket if the system
+        # supports it and the port is known in advance.
+        self.reuse_port = reuse_port and SO_REUSEPORT != None and port != 0
+
+        # The shared listening socket, if the workers share one, and the time
+        # each running worker was started, keyed against its process id.
+        self.listener = None
+        self.workers = {}
+        self.stopping = False
+
+    def serve(self):
+        '''
+        Starts the workers and restarts them as they exit until the
+        supervisor is asked to stop.
+        '''
+        if not self.reuse_port:
+            self.listener = listen(self.host, self.port)
+
+        signal(SIGTERM, self.handle_stop)
+        signal(SIGINT, self.handle_stop)
+
+        for index in range(self.count):
+            self.spawn()
+
+        while not self.stopping:
+            # Signals interrupt waitpid, which lets the loop notice that the
+            # supervisor is stopping.
+            try:
+                pid, status = waitpid(-1, 0)
+            except OSError, error:
+                if error.errno == EINTR:
+                    continue
+                raise
+
+            started = self.workers.pop(pid, None)
+            if started == None or self.stopping:
+                continue
+
+            if time() - started < RESTART_DELAY:
+                sleep(RESTART_DELAY)
+            self.spawn()
+
+        self.stop()
+
+    def handle_stop(self, signum, frame):
+        '''
+        Called when the supervisor receives SIGTERM or SIGINT.
+        '''
+        self.stopping = True
+
+    def spawn(self):
+        '''
+        Starts a worker process.
+        '''
+        pid = fork()
+        if pid != 0:
+            self.workers[pid] = time()
+            return
+
+        # The worker never returns to the caller; it exits once it has been
+        # asked to stop.
+        code = 0
+        try:
+            self.run_worker()
+        except:
+            print_exc()
+            code = 1
+        _exit(code)
+
+    def run_worker(self):
+        '''
+        Serves requests in a worker process until it receives SIGTERM.
+        '''
+        # Interrupts from the terminal are sent to every process in the group,
+        # so the worker leaves them to the supervisor.
+        signal(SIGINT, SIG_IGN)
+
+        listener = self.listener
+        if listener == None:
+            listener = listen(self.host, self.port, True)
+        server = PooledWSGIServer(listener, self.application, self.threads)
+
+        # shutdown waits for serve_forever to return, so it cannot be called
+        # by the signal handler, which runs in the same thread.
+        def handle_stop(signum, frame):
+            Thread(target=server.shutdown).start()
+        signal(SIGTERM, handle_stop)
+
+        SessionReaper().start()
+        server.serve_forever()
+        server.server_close()
+
+    def stop(self):
+        '''
+        Asks every worker to stop and waits for them for up to the shutdown
+        timeout, after which the remaining workers are killed.
+        '''
+        for pid in self.workers:
+            self.signal_worker(pid, SIGTERM)
+
+        deadline = time() + self.timeout
+        while len(self.workers) > 0 and time() < deadline:
+            if not self.reap(WNOHANG):
+                sleep(0.1)
+
+        for pid in self.workers.keys():
+            self.signal_worker(pid, SIGKILL)
+        while len(self.workers) > 0:
+            self.reap(0)
+
+        if self.listener != None:
+            self.listener.close()
+
+    def signal_worker(self, pid, signum):
+        '''
+        Sends a signal to a worker, which may have already exited.
+        '''
+        try:
+            kill(pid, signum)
+        except OSError:
+            pass
+
+    def reap(self, options):
+        '''
+        Waits for a worker to exit. Returns True if a worker exited.
+        '''
+        try:
+            pid, status = waitpid(-1, options)
+        except OSError, error:
+            if error.errno == ECHILD:
+                self.workers.clear()
+                return True
+            if error.errno == EINTR:
+                return False
+            raise
+
+        if pid == 0:
+            return False
+        self.workers.pop(pid, None)
+        return True
+
+
+def serve(host, port, application, workers=WORKERS, threads=WORKER_THREADS):
+    '''
+    Serves the WSGI application on the given host and port with the given
+    number of worker processes and threads per worker, until the process
+    receives SIGTERM or SIGINT.
+
+    Every worker must be able to reach the sessions created by the others, so
+    more than one worker can only be used with the "sqlite" storage.
+    '''
+    if workers > 1 and STORAGE != 'sqlite':
+        raise ValueError('Running %d workers requires the "sqlite" storage.'
+                         % workers)
+
+    Supervisor(host, port, application, workers, threads).serve()
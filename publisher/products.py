@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright (c) 2012, Polar Mobile.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name Polar Mobile nor the names of its contributors
+#     may be used to endorse or promote products derived from this software
+#     without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL POLAR MOBILE BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Used to register new products from many threads at once.
+from threading import Lock
+
+# Used to keep the json encoding of each list of products.
+from publisher.codec import encode_products
+
+
+class ProductList(list):
+    '''
+    A list of product codes that keeps its json encoding, so that responses
+    can include it without encoding it again (see session_body in codec.py).
+    '''
+    def __init__(self, products):
+        '''
+        Creates the list and encodes it.
+        '''
+        list.__init__(self, products)
+        self.encoded = encode_products(products)
+
+
+class ProductRegistry(object):
+    '''
+    Interns product codes to small integers so that a user's entitlements can
+    be checked against a single integer bitmap. The product with id n is in
+    the bitmap if bit n is set. Checking an entitlement is a dictionary lookup
+    and a shift, rather than a scan through a list of product codes.
+
+    Each distinct list of product codes is interned as well, and a user's
+    entitlements are the id of their list. Users with the same list share the
+    same id, and each id keeps the bitmap of its list along with the list
+    itself, json encoded once, so that responses list the user's products in
+    the order they were stored in. The lists are shared and must not be
+    modified.
+
+    Products and lists are never unregistered. Catalogs contain far fewer
+    distinct products and lists of products than users, so the registry stays
+    small.
+    '''
+    def __init__(self):
+        '''
+        Creates an empty registry.
+        '''
+        # ids maps product codes to their ids and codes maps ids back to
+        # product codes. The lock is only held while a product or a list of
+        # products is registered.
+        self.ids = {}
+        self.codes = []
+        self.lock = Lock()
+
+        # The id of each list of product codes, and the bitmap and list of
+        # product codes of each id.
+        self.entitlement_ids = {}
+        self.bitmaps = []
+        self.lists = []
+
+    def register(self, code):
+        '''
+        Returns the id of the product code, registering it if needed.
+        '''
+        product_id = self.ids.get(code)
+        if product_id != None:
+            return product_id
+
+        self.lock.acquire()
+        try:
+            # Another thread may have registered the product in the mean time.
+            product_id = self.ids.get(code)
+            if product_id == None:
+                product_id = len(self.codes)
+                self.codes.append(code)
+                self.ids[code] = product_id
+            return product_id
+
+        finally:
+            self.lock.release()
+
+    def entitlements(self, products):
+        '''
+        Returns the id of the given list of product codes, registering the
+        list and any products that are new.
+        '''
+        key = tuple(products)
+        entitlements = self.entitlement_ids.get(key)
+        if entitlements != None:
+            return entitlements
+
+        bitmap = 0
+        for code in key:
+            bitmap |= 1 << self.register(code)
+        products = ProductList(key)
+
+        self.lock.acquire()
+        try:
+            # Another thread may have registered the list in the mean time.
+            entitlements = self.entitlement_ids.get(key)
+            if entitlements == None:
+                entitlements = len(self.lists)
+                self.bitmaps.append(bitmap)
+                self.lists.append(products)
+                self.entitlement_ids[key] = entitlements
+            return entitlements
+
+        finally:
+            self.lock.release()
+
+    def entitled(self, entitlements, product):
+        '''
+        Returns True if the product code is in the entitlements.
+        '''
+        product_id = self.ids.get(product)
+        if product_id == None:
+            return False
+        return (self.bitmaps[entitlements] >> product_id) & 1 == 1
+
+    def products(self, entitlements):
+        '''
+        Returns the list of product codes of the entitlements, in the order
+        they were given.
+        '''
+        return self.lists[entitlements]
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright (c) 2012, Polar Mobile.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name Polar Mobile nor the names of its contributors
+#     may be used to endorse or promote products derived from this software
+#     without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL POLAR MOBILE BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# The types of the strings produced by the json decoders.
+STRING = (str, unicode)
+
+
+def compile_schema(schema, message, status):
+    '''
+    Compiles a schema for a decoded json map into a function that checks a
+    map against it in a single pass, looking each value up once.
+
+    The schema is a list of fields, checked in order. Each field is a
+    dictionary with the following keys, of which only "key" is required:
+
+        key: The key of the field in its map.
+        code: The code of the errors reported for the field and the fields it
+            contains. Fields inherit the code of the field that contains them.
+        missing: The debug message reported if the field is missing. If it
+            is not given, the field is optional.
+        type: The type, or tuple of types, the value must have.
+        invalid: The debug message reported if the value has the wrong type.
+        max_values: The largest number of values the map may hold.
+        too_many: The debug message reported if it holds more.
+        values: The type, or tuple of types, of every value in the map.
+        invalid_value: The debug message reported for a value with the wrong
+            type, followed by the value's key.
+        fields: The list of fields of the map, checked once the map itself
+            has been checked.
+
+    The schema is turned into the source of a single function, with every
+    check written out in order, so that checking a map costs no more calls
+    than checking it by hand. The function returns the first error found, as
+    a tuple of its code, the given message and status, and its debug message,
+    or None.
+    '''
+    compiler = SchemaCompiler(message, status)
+    compiler.add_fields(schema, 'body', None, 1)
+    return compiler.compile()
+
+
+class SchemaCompiler(object):
+    '''
+    Writes the source of the function compiled by compile_schema. The
+    constants the function uses, such as its errors and types, are kept in
+    the namespace the function is compiled in.
+    '''
+    def __init__(self, message, status):
+        '''
+        Starts the source of the function.
+        '''
+        self.message = message
+        self.status = status
+        self.lines = ['def check(body):']
+        self.namespace = {'MESSAGE': message, 'STATUS': status}
+        self.count = 0
+
+    def constant(self, value):
+        '''
+        Adds a constant to the namespace and returns its name.
+        '''
+        name = 'CONSTANT%d' % len(self.namespace)
+        self.namespace[name] = value
+        return name
+
+    def error(self, code, debug):
+        '''
+        Returns the name of the constant holding an error, or None if there
+        is no debug message.
+        '''
+        if debug == None:
+            return 'None'
+        return self.constant((code, self.message, self.status, debug))
+
+    def add(self, depth, line):
+        '''
+        Adds a line at the given depth of indentation.
+        '''
+        self.lines.append('    ' * depth + line)
+
+    def add_fields(self, fields, container, code, depth):
+        '''
+        Adds the checks of a list of fields of the given container.
+        '''
+        for field in fields:
+            self.add_field(field, container, code, depth)
+
+    def add_field(self, field, container, code, depth):
+        '''
+        Adds the checks of a field of the given container.
+        '''
+        key = field['key']
+        code = field.get('code', code)
+        self.count += 1
+        value = 'value%d' % self.count
+
+        # Optional fields are only checked if they are present.
+        if field.get('missing') != None:
+            self.add(depth, 'if %r not in %s:' % (key, container))
+            self.add(depth + 1, 'return ' + self.error(code, field['missing']))
+        else:
+            self.add(depth, 'if %r in %s:' % (key, container))
+            depth += 1
+        self.add(depth, '%s = %s[%r]' % (value, container, key))
+
+        if field.get('type') != None:
+            self.add(depth, 'if not isinstance(%s, %s):' %
+                            (value, self.constant(field['type'])))
+            self.add(depth + 1, 'return ' + self.error(code, field['invalid']))
+
+        if field.get('max_values') != None:
+            self.add(depth, 'if len(%s) > %d:' % (value, field['max_values']))
+            self.add(depth + 1,
+                     'return ' + self.error(code, field['too_many']))
+
+        if field.get('values') != None:
+            self.add(depth, 'for name in %s:' % value)
+            self.add(depth + 1, 'if not isinstance(%s[name], %s):' %
+                                (value, self.constant(field['values'])))
+            self.add(depth + 2, 'return (%s, MESSAGE, STATUS, %s + '
+                                'unicode(name))' %
+                                (self.constant(code),
+                                 self.constant(field['invalid_value'])))
+
+        self.add_fields(field.get('fields', ()), value, code, depth)
+
+    def compile(self):
+        '''
+        Compiles the function and returns it.
+        '''
+        self.add(1, 'return None')
+        exec '\n'.join(self.lines) in self.namespace
+        return self.namespace['check']
@@ -36,7 +36,20 @@ from publisher.errors import bad_syntax, forbidden, not_found, internal_error
 from publisher.auth import auth
 
 # Import validate handling entry points.
-from publisher.validate import validate
+from publisher.validate import validate, batch_validate
+
+# Used to reclaim expired session ids in the background.
+from publisher.model import SessionReaper
+
+# Used to run the web server in several processes, without itty's routes.
+from publisher import prefork
+from publisher.dispatch import application
+
+# Used to run the event driven front end.
+from publisher import frontend
+
+# Used to choose how the web server is run.
+from constants import WORKERS, FRONTEND
 
 # Get server parameters from the command line.
 from sys import argv
@@ -56,5 +69,20 @@ def main():
         host = argv[1]
         port = int(argv[2])
 
+    # Run the event driven front end.
+    if FRONTEND == 'events':
+        SessionReaper().start()
+        frontend.serve(host, port)
+        return
+
+    # Run the web server in worker processes, each of which reclaims expired
+    # session ids itself.
+    if WORKERS > 0:
+        prefork.serve(host, port, application)
+        return
+
+    # Start reclaiming expired session ids.
+    SessionReaper().start()
+
     # Run the web server.
     run_itty(host=host, port=port)
@@ -0,0 +1,1275 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright (c) 2012, Polar Mobile.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name Polar Mobile nor the names of its contributors
+#     may be used to endorse or promote products derived from this software
+#     without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL POLAR MOBILE BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Used to control access to the shared data of the in-memory storage, to
+# give each thread its own SQLite connection and to take snapshots in the
+# background.
+from threading import Lock, Thread, Event, local
+
+# Used to control access to each user's data.
+from publisher.locks import LockStripes
+
+# Used to keep the session ids ordered by the time they expire.
+from heapq import heappush, heappop, heapify
+
+# Used to keep each user's session ids ordered by when they were created.
+from collections import OrderedDict
+
+# Used to number the uses of the sessions in memory.
+from itertools import count
+
+# Used to store the data of the SQLite storage.
+import sqlite3
+
+# Used to encode lists of products in the SQLite storage and to decode the
+# records of the journal.
+try:
+    from json import loads, dumps
+except ImportError:
+    from simplejson import loads, dumps
+
+# Used to intern the products of each user.
+from publisher.products import ProductRegistry
+
+# Used to record the changes made to the journaled storage.
+from publisher.journal import Journal
+
+# Used to write and load the snapshots of the journaled storage.
+try:
+    from cPickle import dump, load, HIGHEST_PROTOCOL
+except ImportError:
+    from pickle import dump, load, HIGHEST_PROTOCOL
+
+# Used to manage the files of the journaled storage.
+from os import listdir, makedirs, remove, rename, fsync
+from os.path import join, isdir, exists
+
+# Used to ignore expired sessions when recovering the journaled storage and
+# to order the sessions of the SQLite storage by when they were last used.
+from time import time
+
+# Used to speed up the recovery of the journaled storage.
+from gc import disable, enable, isenabled
+
+# Used to configure the storage.
+from constants import (LOCK_STRIPES, STORAGE_PATH, JOURNAL_PATH,
+                       SNAPSHOT_INTERVAL, MAX_USER_SESSIONS)
+
+
+class Session(object):
+    '''
+    A record describing a single session. Since the server may hold millions
+    of sessions, the record uses __slots__ so that it does not carry a
+    dictionary of attributes with it. It stores the username that owns the
+    session, the product the session was created for and the deadline of the
+    session, which is the time (in whole seconds since the epoch) after which
+    the session is no longer valid. The storage may also record when the
+    session was last used, which decides the session to evict when its user
+    holds too many.
+    '''
+    __slots__ = ('username', 'product', 'deadline', 'used')
+
+    def __init__(self, username, product, deadline, used=0):
+        '''
+        Creates a session record.
+        '''
+        self.username = username
+        self.product = product
+        self.deadline = deadline
+        self.used = used
+
+
+class Storage(object):
+    '''
+    The interface between the model and the place where users and sessions
+    are stored. The model only ever accesses its data through these methods,
+    so a publisher can keep their data wherever they like by implementing
+    them. Every method must be safe to call from many threads at once.
+
+    Users are described by a dictionary with the following keys:
+
+        "password": The user's password.
+        "valid": A boolean indicating if the user's account is valid.
+        "entitlements": The products that the user has access to, as given
+            by the registry of the storage (see products.py).
+
+    Sessions are described by Session records.
+
+    Each user may hold at most max_user_sessions sessions at once, unless it
+    is 0. When a session is created for a user that already holds that many,
+    the session that was used least recently is removed first. A session is
+    used when it is created or touched. The number of sessions removed this
+    way is kept in evictions, so that the limit can be sized.
+    '''
+    def __init__(self, max_user_sessions=MAX_USER_SESSIONS):
+        '''
+        Creates the registry of the products known to the storage.
+        '''
+        self.registry = ProductRegistry()
+        self.max_user_sessions = max_user_sessions
+        self.evictions = 0
+        self.evictions_lock = Lock()
+
+    def open(self):
+        '''
+        Called by the model once the initial users have been added to the
+        storage. Storage that keeps state across restarts may load it here.
+        '''
+        pass
+
+    def close(self):
+        '''
+        Releases any resources held by the storage.
+        '''
+        pass
+
+    def add_user(self, username, password, valid, products):
+        '''
+        Adds a user, replacing any existing user with the same username.
+        '''
+        raise NotImplementedError()
+
+    def remove_user(self, username):
+        '''
+        Removes a user who holds no sessions. Returns True if the user was
+        removed; users who still hold sessions are kept.
+        '''
+        raise NotImplementedError()
+
+    def get_user(self, username):
+        '''
+        Returns the dictionary describing the user, or None if the user is not
+        known. The dictionary must not be modified.
+        '''
+        raise NotImplementedError()
+
+    def get_products(self, username):
+        '''
+        Returns the list of products that the user has access to, or None if
+        the user is not known.
+        '''
+        user = self.get_user(username)
+        if user == None:
+            return None
+        return self.registry.products(user['entitlements'])
+
+    def create_session(self, session_id, username, product, deadline):
+        '''
+        Stores a new session for the given user.
+        '''
+        raise NotImplementedError()
+
+    def get_session(self, session_id):
+        '''
+        Returns the Session record of the session id, or None if it is not
+        known. Note that the session may have expired.
+        '''
+        raise NotImplementedError()
+
+    def touch_session(self, session_id):
+        '''
+        Records that the session id has just been validated, so that it is
+        the last of its user's sessions to be evicted. Touching an unknown
+        session id does nothing.
+        '''
+        raise NotImplementedError()
+
+    def count_evictions(self, count):
+        '''
+        Adds the given number of evicted sessions to evictions.
+        '''
+        if count == 0:
+            return
+
+        self.evictions_lock.acquire()
+        try:
+            self.evictions += count
+
+        finally:
+            self.evictions_lock.release()
+
+    def remove_session(self, session_id):
+        '''
+        Removes the session id. Returns True if the session id was found.
+        '''
+        raise NotImplementedError()
+
+    def expire_user_sessions(self, username, now):
+        '''
+        Removes the sessions of the given user whose deadline is not after
+        now.
+        '''
+        raise NotImplementedError()
+
+    def expire_sessions(self, now):
+        '''
+        Removes every session and revoked token whose deadline is not after
+        now. Returns the number of sessions that were removed.
+        '''
+        raise NotImplementedError()
+
+    def revoke_token(self, signature, deadline):
+        '''
+        Records that the session token with the given signature has been
+        revoked until its deadline. Returns False if it was already revoked.
+        '''
+        raise NotImplementedError()
+
+    def is_revoked(self, signature):
+        '''
+        Returns True if the session token with the given signature has been
+        revoked.
+        '''
+        raise NotImplementedError()
+
+
+class MemoryStorage(Storage):
+    '''
+    Stores users and sessions in the memory of the process. This is the
+    default storage; it is fast, but every session is lost when the server
+    stops and the users must fit in the memory of a single process.
+
+    The storage contains a dictionary called users that is keyed against the
+    usernames of the valid users. Each value in this dictionary is a
+    dictionary containing a number of keys.
+
+    The first key is "valid". The value of this key is a boolean indicating if
+    a user's account is valid or not. The second key is "entitlements", which
+    contains the id of the list of products that the user has access to (see
+    products.py). Users with the same products share the same id. The
+    next key is "password", which contains the user's password. Note that in
+    a production system, the user's password should be salted and hashed
+    before it is saved. The last key is "session ids", whose value is an
+    ordered dictionary whose keys are the session ids that belong to the user,
+    from the oldest to the newest. An example follows:
+
+    users = {
+        "username": {
+            "valid": True,
+            "entitlements": 3,
+            "password": "test"
+            "session ids": OrderedDict([(<session id>, None)])
+            }
+        }
+
+    Looking a session id up by walking every user is too slow once there are
+    more than a handful of users, so the details of each session are kept in
+    a second dictionary called sessions. It is keyed against session ids and
+    each value is a Session record containing the username, the product, the
+    deadline of the session and the number of its last use. Both the
+    sessions dictionary and the users' session id sets must always be updated
+    together. An example follows:
+
+    sessions = {
+        <session id>: Session("username", product, <deadline>, <use>)
+        }
+
+    Session ids are stored as byte strings rather than unicode strings as they
+    only contain ascii characters and take a quarter of the memory.
+
+    Expired session ids are reclaimed in the background rather than on every
+    request. The storage keeps a heap called expiry containing a tuple of the
+    deadline and the session id for every session it creates. The
+    expire_sessions function pops the expired entries off the top of the heap.
+    The signatures of revoked session tokens are kept in a dictionary called
+    revoked and are pushed onto the same heap. Sessions that are evicted or
+    removed leave their entries in the heap, so once more than half of the
+    entries are stale the heap is rebuilt from the live ones. A user logging
+    in over and over therefore cannot grow the heap without bound, and the
+    cost of the rebuilds is spread over the sessions created since the last.
+
+    Since many threads access the storage at once, each user's data is
+    protected by one of a fixed set of read write locks (see locks.py). The
+    lock is chosen by hashing the username, so requests for different users
+    rarely wait for each other. Looking a session up is a single dictionary
+    access and needs no lock at all. Touching a session only stores the next
+    number of a shared counter in its record, so validating a session never
+    waits for a write lock either. When a user holds too many sessions, the
+    session with the lowest number is evicted. Finding it scans the user's
+    sessions, so eviction takes time in proportion to MAX_USER_SESSIONS
+    rather than constant time; with the small limits that are useful, the
+    scan costs less than keeping the sessions ordered on every validation.
+    '''
+    # The number of stale entries the expiry heap may hold before it is
+    # rebuilt, whatever the number of live entries.
+    MIN_STALE_EXPIRY = 1024
+
+    def __init__(self, max_user_sessions=MAX_USER_SESSIONS):
+        '''
+        Creates an empty storage.
+        '''
+        Storage.__init__(self, max_user_sessions)
+        self.users = {}
+        self.sessions = {}
+        self.expiry = []
+        self.revoked = {}
+
+        # Numbers the uses of the sessions, from the earliest to the latest.
+        self.uses = count(1)
+
+        # user_locks protects the data of each user and expiry_lock protects
+        # the expiry heap and the revoked dictionary.
+        self.user_locks = LockStripes(LOCK_STRIPES)
+        self.expiry_lock = Lock()
+
+    def record(self, record):
+        '''
+        Called whenever a session is created or removed, or a token is
+        revoked, while the lock protecting the change is held. The record is a
+        list describing the change. It is ignored by this storage, but allows
+        other storage to keep track of the changes in order.
+        '''
+        pass
+
+    def add_user(self, username, password, valid, products):
+        '''
+        Adds a user, replacing any existing user with the same username. The
+        sessions of an existing user are kept.
+        '''
+        user = {}
+        user['valid'] = valid
+        user['entitlements'] = self.registry.entitlements(products)
+        user['password'] = password
+
+        lock = self.user_locks(username)
+        lock.acquire_write()
+        try:
+            existing = self.users.get(username)
+            if existing == None:
+                user['session ids'] = OrderedDict()
+            else:
+                user['session ids'] = existing['session ids']
+            self.users[username] = user
+
+        finally:
+            lock.release_write()
+
+    def remove_user(self, username):
+        '''
+        Removes a user who holds no session ids. Returns True if the user was
+        removed.
+        '''
+        lock = self.user_locks(username)
+        lock.acquire_write()
+        try:
+            user = self.users.get(username)
+            if user == None or len(user['session ids']) > 0:
+                return False
+            del self.users[username]
+            return True
+
+        finally:
+            lock.release_write()
+
+    def get_user(self, username):
+        '''
+        Returns the dictionary describing the user, or None if the user is not
+        known.
+        '''
+        lock = self.user_locks(username)
+        lock.acquire_read()
+        try:
+            return self.users.get(username)
+
+        finally:
+            lock.release_read()
+
+    def create_session(self, session_id, username, product, deadline):
+        '''
+        Stores a new session for the given user.
+        '''
+        # The session id is stored as a byte string. Byte strings and unicode
+        # strings containing the same ascii characters compare and hash the
+        # same, so the session id can still be looked up with either.
+        key = session_id.encode('ascii')
+
+        # Insert the session id into shared memory, and index it so that it
+        # can be found without knowing which user it belongs to. If the user
+        # already holds as many session ids as allowed, the least recently
+        # used ones are removed first.
+        evicted = 0
+        lock = self.user_locks(username)
+        lock.acquire_write()
+        try:
+            session_ids = self.users[username]['session ids']
+            if self.max_user_sessions > 0:
+                while len(session_ids) >= self.max_user_sessions:
+                    oldest = min(session_ids,
+                                 key=lambda key: self.sessions[key].used)
+                    self.discard_session(username, oldest)
+                    self.record(['r', oldest])
+                    evicted += 1
+
+            session_ids[key] = None
+            self.sessions[key] = Session(username, product, deadline,
+                                         next(self.uses))
+            self.record(['c', key, username, product, deadline])
+
+        finally:
+            lock.release_write()
+
+        self.count_evictions(evicted)
+
+        # Schedule the session id to be reclaimed once it expires. The heap
+        # lock is never held while a user is locked; expire_sessions takes the
+        # locks in the opposite order.
+        self.expiry_lock.acquire()
+        try:
+            heappush(self.expiry, (deadline, key))
+            live = len(self.sessions) + len(self.revoked)
+            if len(self.expiry) > 2 * live + MemoryStorage.MIN_STALE_EXPIRY:
+                self.compact_expiry()
+
+        finally:
+            self.expiry_lock.release()
+
+    def compact_expiry(self):
+        '''
+        Rebuilds the expiry heap from the entries of the sessions and revoked
+        tokens that still exist. Note that the expiry lock is assumed to be
+        held.
+        '''
+        entries = []
+        for entry in self.expiry:
+            deadline, key = entry
+            session = self.sessions.get(key)
+            if ((session != None and session.deadline == deadline) or
+                    self.revoked.get(key) == deadline):
+                entries.append(entry)
+        heapify(entries)
+        self.expiry = entries
+
+    def get_session(self, session_id):
+        '''
+        Returns the Session record of the session id, or None if it is not
+        known.
+        '''
+        return self.sessions.get(session_id)
+
+    def touch_session(self, session_id):
+        '''
+        Gives the session the next number of the use counter, so that it is
+        the last of its user's sessions to be evicted.
+        '''
+        # The order only matters when the sessions are limited.
+        if self.max_user_sessions <= 0:
+            return
+
+        # Taking the next number and storing an attribute are both atomic,
+        # so no lock is needed. A session removed in the meantime is simply
+        # no longer referenced.
+        session = self.sessions.get(session_id)
+        if session != None:
+            session.used = next(self.uses)
+
+    def remove_session(self, session_id):
+        '''
+        Removes the session id from both the user that owns it and the session
+        index. Returns True if the session id was found.
+        '''
+        # Find the owner of the session id using the index.
+        session = self.sessions.get(session_id)
+        if session == None:
+            return False
+
+        lock = self.user_locks(session.username)
+        lock.acquire_write()
+        try:
+            # Another thread may have removed the session id while we were
+            # waiting for the lock.
+            if self.sessions.get(session_id) is not session:
+                return False
+
+            self.discard_session(session.username, session_id)
+            self.record(['r', session_id])
+            return True
+
+        finally:
+            lock.release_write()
+
+    def discard_session(self, username, session_id):
+        '''
+        Removes a session id from both the given user and the session index.
+        Note that the user's lock is assumed to be held for writing before this
+        function is called.
+        '''
+        self.sessions.pop(session_id, None)
+        self.users[username]['session ids'].pop(session_id, None)
+
+    def expire_user_sessions(self, username, now):
+        '''
+        Loops through all of the session ids for a given user and removes the
+        ones that have expired.
+        '''
+        lock = self.user_locks(username)
+        lock.acquire_write()
+        try:
+            # Loop through all the session ids and store only valid ids. We
+            # store only valid ids because we can't delete from the session
+            # ids while iterating over them. The valid ids are kept in the
+            # order they were used.
+            valid_ids = OrderedDict()
+            for session_id in self.users[username]['session ids']:
+                # If the key has not expired, store it to indicate that it is
+                # valid.
+                if now < self.sessions[session_id].deadline:
+                    valid_ids[session_id] = None
+
+                # Expired ids must also be dropped from the session index.
+                else:
+                    del self.sessions[session_id]
+
+            # Swap the current session ids for the new set of valid is.
+            self.users[username]['session ids'] = valid_ids
+
+        finally:
+            lock.release_write()
+
+    def expire_sessions(self, now):
+        '''
+        Removes every session id that has expired from both its user and the
+        session index. Because the expiry heap is ordered by deadline, only the
+        session ids that have actually expired are visited.
+
+        Entries for session ids that have already been removed are simply
+        discarded when they reach the top of the heap.
+
+        This function returns the number of session ids that were removed.
+        '''
+        # Pop entries off the heap until the earliest one is still valid. The
+        # heap lock is released before any user is locked.
+        candidates = []
+        self.expiry_lock.acquire()
+        try:
+            while len(self.expiry) > 0 and self.expiry[0][0] <= now:
+                deadline, session_id = heappop(self.expiry)
+                candidates.append(session_id)
+
+                # The entry may belong to a revoked token, which can be
+                # forgotten now that it has expired.
+                self.revoked.pop(session_id, None)
+
+        finally:
+            self.expiry_lock.release()
+
+        removed = 0
+        for session_id in candidates:
+            # Skip session ids that no longer exist.
+            session = self.sessions.get(session_id)
+            if session == None:
+                continue
+
+            lock = self.user_locks(session.username)
+            lock.acquire_write()
+            try:
+                # Make sure the session id still exists and has actually
+                # expired before removing it.
+                if self.sessions.get(session_id) is not session:
+                    continue
+                if now < session.deadline:
+                    continue
+
+                self.discard_session(session.username, session_id)
+                removed += 1
+
+            finally:
+                lock.release_write()
+
+        return removed
+
+    def revoke_token(self, signature, deadline):
+        '''
+        Remembers the signature of a revoked token until its deadline.
+        '''
+        self.expiry_lock.acquire()
+        try:
+            if signature in self.revoked:
+                return False
+
+            self.revoked[signature] = deadline
+            heappush(self.expiry, (deadline, signature))
+            self.record(['t', signature, deadline])
+            return True
+
+        finally:
+            self.expiry_lock.release()
+
+    def is_revoked(self, signature):
+        '''
+        Returns True if the token with the given signature has been revoked.
+        '''
+        return signature in self.revoked
+
+
+class SQLiteStorage(Storage):
+    '''
+    Stores users and sessions in an SQLite database, so that sessions survive
+    a restart and can be shared by several server processes on the same
+    machine. The database is stored in write-ahead logging mode, which lets
+    readers continue while another connection writes.
+
+    SQLite connections cannot be shared between threads, so each thread is
+    given its own connection the first time it uses the storage. Connections
+    are kept open for the life of the storage, and the sqlite3 module keeps
+    the statements below prepared on each connection.
+
+    The database contains the following tables:
+
+        users: The username, password, valid flag and products of each user.
+            The products are stored as a json encoded list.
+        sessions: The session id, username, product and deadline of each
+            session, and the time it was last used. Sessions are indexed by
+            session id, by username and time last used, and by deadline.
+        revoked: The signature and deadline of each revoked session token.
+
+    Writing the time a session was used on every validation would serialize
+    every process on the write lock of the database, so the times are
+    collected in memory, with later uses of a session replacing earlier ones,
+    and written in a single transaction once enough have been collected,
+    before the sessions of a user are evicted and when expired sessions are
+    removed. Sessions used only in another process since its last write may
+    therefore be evicted a little early.
+    '''
+    # The statements used to create the database.
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS users ('
+        'username TEXT PRIMARY KEY, password TEXT, valid INTEGER, '
+        'products TEXT)',
+        'CREATE TABLE IF NOT EXISTS sessions ('
+        'session_id TEXT PRIMARY KEY, username TEXT, product TEXT, '
+        'deadline INTEGER, used REAL)',
+        'CREATE INDEX IF NOT EXISTS sessions_username ON sessions (username, '
+        'used)',
+        'CREATE INDEX IF NOT EXISTS sessions_deadline ON sessions (deadline)',
+        'CREATE TABLE IF NOT EXISTS revoked ('
+        'signature TEXT PRIMARY KEY, deadline INTEGER)',
+        'CREATE INDEX IF NOT EXISTS revoked_deadline ON revoked (deadline)',
+    )
+
+    # The number of touched sessions that are kept in memory before the
+    # times they were used are written to the database.
+    TOUCH_BATCH = 256
+
+    # The statements used to access the database.
+    ADD_USER = ('INSERT OR REPLACE INTO users (username, password, valid, '
+                'products) VALUES (?, ?, ?, ?)')
+    REMOVE_USER = ('DELETE FROM users WHERE username = ? AND NOT EXISTS ('
+                   'SELECT 1 FROM sessions WHERE username = ?)')
+    GET_USER = 'SELECT password, valid, products FROM users WHERE username = ?'
+    CREATE_SESSION = ('INSERT INTO sessions (session_id, username, product, '
+                      'deadline, used) VALUES (?, ?, ?, ?, ?)')
+    EVICT_SESSIONS = ('DELETE FROM sessions WHERE session_id IN ('
+                      'SELECT session_id FROM sessions WHERE username = ? '
+                      'ORDER BY used DESC LIMIT -1 OFFSET ?)')
+    TOUCH_SESSION = 'UPDATE sessions SET used = ? WHERE session_id = ?'
+    GET_SESSION = ('SELECT username, product, deadline FROM sessions '
+                   'WHERE session_id = ?')
+    REMOVE_SESSION = 'DELETE FROM sessions WHERE session_id = ?'
+    EXPIRE_USER_SESSIONS = ('DELETE FROM sessions WHERE username = ? AND '
+                            'deadline <= ?')
+    EXPIRE_SESSIONS = 'DELETE FROM sessions WHERE deadline <= ?'
+    EXPIRE_REVOKED = 'DELETE FROM revoked WHERE deadline <= ?'
+    REVOKE_TOKEN = 'INSERT INTO revoked (signature, deadline) VALUES (?, ?)'
+    IS_REVOKED = 'SELECT 1 FROM revoked WHERE signature = ?'
+
+    def __init__(self, path, max_user_sessions=MAX_USER_SESSIONS):
+        '''
+        Opens the database at the given path, creating it if necessary.
+        '''
+        Storage.__init__(self, max_user_sessions)
+        self.path = path
+        self.local = local()
+
+        # Every connection that has been opened, so that they can be closed.
+        self.connections = []
+        self.connections_lock = Lock()
+
+        # The time each session was last used that has not been written to
+        # the database yet, keyed against the session id.
+        self.touches = {}
+        self.touches_lock = Lock()
+
+        # Create the tables using the connection of this thread.
+        connection = self.connection()
+        for statement in SQLiteStorage.SCHEMA:
+            connection.execute(statement)
+
+    def connection(self):
+        '''
+        Returns the connection of the calling thread, opening it if this is
+        the first time the thread uses the storage.
+        '''
+        connection = getattr(self.local, 'connection', None)
+        if connection != None:
+            return connection
+
+        # Autocommit mode is used as every change is a single statement. The
+        # connection is only used by this thread, but it may be closed by
+        # another thread when the storage is closed.
+        connection = sqlite3.connect(self.path, isolation_level=None,
+                                     check_same_thread=False)
+        connection.execute('PRAGMA journal_mode = WAL')
+        connection.execute('PRAGMA synchronous = NORMAL')
+        self.local.connection = connection
+
+        self.connections_lock.acquire()
+        try:
+            self.connections.append(connection)
+
+        finally:
+            self.connections_lock.release()
+
+        return connection
+
+    def close(self):
+        '''
+        Writes the pending session uses and closes every connection opened by
+        the storage.
+        '''
+        self.write_touches()
+        self.connections_lock.acquire()
+        try:
+            for connection in self.connections:
+                connection.close()
+            self.connections = []
+            self.local = local()
+
+        finally:
+            self.connections_lock.release()
+
+    def add_user(self, username, password, valid, products):
+        '''
+        Adds a user, replacing any existing user with the same username.
+        '''
+        values = (username, password, int(valid), dumps(list(products)))
+        self.connection().execute(SQLiteStorage.ADD_USER, values)
+
+    def remove_user(self, username):
+        '''
+        Removes a user who holds no sessions. Returns True if the user was
+        removed.
+        '''
+        cursor = self.connection().execute(SQLiteStorage.REMOVE_USER,
+                                           (username, username))
+        return cursor.rowcount > 0
+
+    def get_user(self, username):
+        '''
+        Returns the dictionary describing the user, or None if the user is not
+        known.
+        '''
+        cursor = self.connection().execute(SQLiteStorage.GET_USER,
+                                           (username,))
+        row = cursor.fetchone()
+        if row == None:
+            return None
+
+        user = {}
+        user['password'] = row[0]
+        user['valid'] = bool(row[1])
+        user['entitlements'] = self.registry.entitlements(loads(row[2]))
+        return user
+
+    def create_session(self, session_id, username, product, deadline):
+        '''
+        Stores a new session for the given user.
+        '''
+        connection = self.connection()
+        values = (session_id, username, product, deadline, time())
+        connection.execute(SQLiteStorage.CREATE_SESSION, values)
+
+        # Keep only the most recently used sessions of the user, including
+        # the new one.
+        if self.max_user_sessions > 0:
+            self.write_touches()
+            cursor = connection.execute(SQLiteStorage.EVICT_SESSIONS,
+                                        (username, self.max_user_sessions))
+            self.count_evictions(cursor.rowcount)
+
+    def get_session(self, session_id):
+        '''
+        Returns the Session record of the session id, or None if it is not
+        known.
+        '''
+        cursor = self.connection().execute(SQLiteStorage.GET_SESSION,
+                                           (session_id,))
+        row = cursor.fetchone()
+        if row == None:
+            return None
+        return Session(row[0], row[1], row[2])
+
+    def touch_session(self, session_id):
+        '''
+        Records the time the session id was last used. The time is written to
+        the database with the next batch.
+        '''
+        if self.max_user_sessions <= 0:
+            return
+
+        self.touches_lock.acquire()
+        try:
+            self.touches[session_id] = time()
+            full = len(self.touches) >= SQLiteStorage.TOUCH_BATCH
+
+        finally:
+            self.touches_lock.release()
+
+        if full:
+            self.write_touches()
+
+    def write_touches(self):
+        '''
+        Writes the times of the sessions used since the last batch in a single
+        transaction.
+        '''
+        self.touches_lock.acquire()
+        try:
+            touches = self.touches
+            self.touches = {}
+
+        finally:
+            self.touches_lock.release()
+
+        if len(touches) == 0:
+            return
+
+        connection = self.connection()
+        connection.execute('BEGIN')
+        try:
+            connection.executemany(SQLiteStorage.TOUCH_SESSION,
+                [(used, session_id) for session_id, used in touches.items()])
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def remove_session(self, session_id):
+        '''
+        Removes the session id. Returns True if the session id was found.
+        '''
+        cursor = self.connection().execute(SQLiteStorage.REMOVE_SESSION,
+                                           (session_id,))
+        return cursor.rowcount > 0
+
+    def expire_user_sessions(self, username, now):
+        '''
+        Removes the expired sessions of the given user.
+        '''
+        self.connection().execute(SQLiteStorage.EXPIRE_USER_SESSIONS,
+                                  (username, now))
+
+    def expire_sessions(self, now):
+        '''
+        Removes every expired session and revoked token. Returns the number of
+        sessions that were removed.
+        '''
+        self.write_touches()
+        connection = self.connection()
+        connection.execute(SQLiteStorage.EXPIRE_REVOKED, (now,))
+        cursor = connection.execute(SQLiteStorage.EXPIRE_SESSIONS, (now,))
+        return cursor.rowcount
+
+    def revoke_token(self, signature, deadline):
+        '''
+        Remembers the signature of a revoked token until its deadline.
+        '''
+        try:
+            self.connection().execute(SQLiteStorage.REVOKE_TOKEN,
+                                      (signature, deadline))
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def is_revoked(self, signature):
+        '''
+        Returns True if the token with the given signature has been revoked.
+        '''
+        cursor = self.connection().execute(SQLiteStorage.IS_REVOKED,
+                                           (signature,))
+        return cursor.fetchone() != None
+
+
+class JournaledStorage(MemoryStorage):
+    '''
+    Stores users and sessions in memory like MemoryStorage, but also keeps
+    the sessions on the disk so that they survive a restart. Users are not
+    kept; they are expected to be added again when the server starts.
+
+    Some users are only added after the storage has been opened, such as the
+    users copied from a directory when they log in. Their sessions are still
+    recovered, held by a placeholder user that only has session ids. The
+    placeholder is not returned by get_user, and becomes the real user when
+    the user is added. The usernames of the placeholders are kept in a set
+    called placeholders, and each placeholder is removed by expire_sessions
+    once it no longer holds any session ids.
+
+    Every session that is created or removed, and every token that is
+    revoked, is appended to a journal (see journal.py). The journal is written
+    with group commits, so the cost of synchronizing it with the disk is
+    shared by all of the threads writing at the same time. The thread that
+    made the change waits until it is on the disk before returning. Sessions
+    that simply expire are not recorded, since their deadline is stored with
+    them. Sessions that are evicted are recorded as removed, but touching a
+    session is not recorded, so after a restart each user's sessions are
+    evicted in roughly the order they were created.
+
+    Replaying a long journal would make restarts slow, so every
+    snapshot_interval seconds the journal is continued in a new file and a
+    snapshot of every valid session is written. The older journal files are
+    then deleted. When the storage is opened, it loads the snapshot and
+    replays only the journal files written after it.
+
+    The directory of the storage contains the following files:
+
+        snapshot: The latest snapshot, a pickled tuple of the number of the
+            first journal file to replay, a list of session tuples and a list
+            of revoked token tuples.
+        journal.<number>: The journal files, replayed in increasing order.
+    '''
+    def __init__(self, path, snapshot_interval=SNAPSHOT_INTERVAL,
+                 max_user_sessions=MAX_USER_SESSIONS):
+        '''
+        Creates an empty storage that keeps its files in the directory at the
+        given path. Nothing is loaded until the storage is opened. Snapshots
+        are only taken automatically if the interval is greater than zero.
+        '''
+        MemoryStorage.__init__(self, max_user_sessions)
+        self.path = path
+        self.snapshot_interval = snapshot_interval
+        self.journal = None
+        self.segment = 0
+        self.placeholders = set()
+
+        # Protects the snapshots, which are also taken by a background thread.
+        self.snapshot_lock = Lock()
+        self.stopped = Event()
+        self.snapshotter = None
+
+    def open(self):
+        '''
+        Loads the snapshot, replays the journal and starts a new journal file.
+        '''
+        if not isdir(self.path):
+            makedirs(self.path)
+
+        # Recovery creates millions of objects that are never garbage, so the
+        # cyclic garbage collector only slows it down.
+        collecting = isenabled()
+        disable()
+        try:
+            self.segment = self.recover()
+
+        finally:
+            if collecting:
+                enable()
+
+        self.journal = Journal(self.segment_path(self.segment))
+
+        if self.snapshot_interval > 0:
+            self.snapshotter = Thread(target=self.run_snapshots,
+                                      name='Snapshot')
+            self.snapshotter.daemon = True
+            self.snapshotter.start()
+
+    def close(self):
+        '''
+        Stops taking snapshots and writes any queued records to the journal.
+        '''
+        self.stopped.set()
+        if self.snapshotter != None:
+            self.snapshotter.join()
+        if self.journal != None:
+            self.journal.close()
+
+    def record(self, record):
+        '''
+        Appends the record to the journal. Nothing is recorded while the
+        storage is being recovered.
+        '''
+        if self.journal != None:
+            self.journal.append(record)
+
+    def create_session(self, session_id, username, product, deadline):
+        '''
+        Stores a new session and waits for it to be written to the journal.
+        '''
+        MemoryStorage.create_session(self, session_id, username, product,
+                                     deadline)
+        self.journal.sync()
+
+    def remove_session(self, session_id):
+        '''
+        Removes the session id and waits for the removal to be written to the
+        journal.
+        '''
+        result = MemoryStorage.remove_session(self, session_id)
+        self.journal.sync()
+        return result
+
+    def revoke_token(self, signature, deadline):
+        '''
+        Revokes the token and waits for the revocation to be written to the
+        journal.
+        '''
+        result = MemoryStorage.revoke_token(self, signature, deadline)
+        self.journal.sync()
+        return result
+
+    def get_user(self, username):
+        '''
+        Returns the dictionary describing the user, or None if the user is not
+        known or is only a placeholder for recovered sessions.
+        '''
+        user = MemoryStorage.get_user(self, username)
+        if user == None or 'valid' not in user:
+            return None
+        return user
+
+    def expire_sessions(self, now):
+        '''
+        Removes every session id that has expired like MemoryStorage, then
+        removes the placeholders that no longer hold any session ids.
+        '''
+        removed = MemoryStorage.expire_sessions(self, now)
+
+        # The set only shrinks once the storage has been recovered. Copying
+        # it is a single operation in CPython and discarding a username twice
+        # is harmless, so the set needs no lock of its own.
+        for username in list(self.placeholders):
+            lock = self.user_locks(username)
+            lock.acquire_write()
+            try:
+                user = self.users.get(username)
+                if user == None or 'valid' in user:
+                    self.placeholders.discard(username)
+                elif len(user['session ids']) == 0:
+                    del self.users[username]
+                    self.placeholders.discard(username)
+
+            finally:
+                lock.release_write()
+
+        return removed
+
+    def add_placeholder(self, username):
+        '''
+        Returns the user with the given username, adding a placeholder that
+        only holds session ids if the user is not known. Note that the
+        storage is assumed to be being recovered.
+        '''
+        user = self.users.get(username)
+        if user == None:
+            user = {'session ids': OrderedDict()}
+            self.users[username] = user
+            self.placeholders.add(username)
+        return user
+
+    def segment_path(self, segment):
+        '''
+        Returns the path of the journal file with the given number.
+        '''
+        return join(self.path, 'journal.%d' % segment)
+
+    def segments(self):
+        '''
+        Returns the numbers of the journal files in the directory, in
+        increasing order.
+        '''
+        result = []
+        for name in listdir(self.path):
+            prefix, separator, number = name.partition('.')
+            if prefix == 'journal' and number.isdigit():
+                result.append(int(number))
+        return sorted(result)
+
+    def replay(self, record, now):
+        '''
+        Applies a record from the snapshot or the journal. Records may be
+        applied more than once, so they are ignored if they have already been
+        applied. Sessions that have expired are also ignored, and sessions
+        whose users are not known are held by a placeholder.
+        '''
+        kind = record[0]
+        if kind == 'c':
+            session_id, username, product, deadline = record[1:]
+            if deadline <= now or session_id in self.sessions:
+                return
+            self.add_placeholder(username)
+            MemoryStorage.create_session(self, session_id, username, product,
+                                         deadline)
+
+        elif kind == 'r':
+            MemoryStorage.remove_session(self, record[1])
+
+        elif kind == 't':
+            signature, deadline = record[1:]
+            if deadline > now:
+                MemoryStorage.revoke_token(self, signature, deadline)
+
+    def restore(self, sessions, revoked, now):
+        '''
+        Adds the sessions and revoked tokens of a snapshot to the empty
+        storage. Nothing else can use the storage while it is being opened, so
+        no locks are taken and the expiry heap is built all at once, which is
+        several times faster than replaying each session.
+        '''
+        for session_id, username, product, deadline in sessions:
+            if deadline <= now:
+                continue
+            user = self.add_placeholder(username)
+            user['session ids'][session_id] = None
+            self.sessions[session_id] = Session(username, product, deadline,
+                                                next(self.uses))
+            self.expiry.append((deadline, session_id))
+
+        for signature, deadline in revoked:
+            if deadline > now:
+                self.revoked[signature] = deadline
+                self.expiry.append((deadline, signature))
+
+        heapify(self.expiry)
+
+    def recover(self):
+        '''
+        Loads the snapshot and replays the journal files written after it.
+
+        This function returns the number of the journal file to continue the
+        journal in.
+        '''
+        now = time()
+
+        # Load the snapshot, if there is one.
+        start = 0
+        path = join(self.path, 'snapshot')
+        if exists(path):
+            snapshot = open(path, 'rb')
+            try:
+                start, sessions, revoked = load(snapshot)
+
+            finally:
+                snapshot.close()
+
+            self.restore(sessions, revoked, now)
+
+        # Replay the journal files written since the snapshot. The last line
+        # of a file may be incomplete if the server stopped while writing it,
+        # in which case it is skipped.
+        segments = [segment for segment in self.segments() if segment >= start]
+        for segment in segments:
+            journal = open(self.segment_path(segment), 'rb')
+            try:
+                for line in journal:
+                    try:
+                        record = loads(line)
+                    except ValueError:
+                        continue
+                    self.replay(record, now)
+
+            finally:
+                journal.close()
+
+        # Continue the journal in a new file.
+        return max([start] + [segment + 1 for segment in segments])
+
+    def snapshot(self):
+        '''
+        Continues the journal in a new file, writes a snapshot of every valid
+        session and deletes the journal files that the snapshot replaces.
+
+        The journal is rotated before the sessions are copied, so every change
+        recorded in the older files is part of the snapshot. Changes recorded
+        in the new file may also be part of the snapshot, which is harmless as
+        replaying them again has no effect.
+        '''
+        self.snapshot_lock.acquire()
+        try:
+            segment = self.segment + 1
+            self.journal.rotate(self.segment_path(segment))
+            self.segment = segment
+
+            # Copying a dictionary is a single operation in CPython, so the
+            # copies are consistent without locking every user.
+            sessions = self.sessions.copy()
+            revoked = self.revoked.copy()
+
+            now = time()
+            session_tuples = [(session_id, session.username, session.product,
+                               session.deadline)
+                              for session_id, session in sessions.iteritems()
+                              if session.deadline > now]
+            revoked_tuples = [(signature, deadline)
+                              for signature, deadline in revoked.iteritems()
+                              if deadline > now]
+
+            # Write the snapshot to a temporary file and rename it, so that a
+            # partially written snapshot never replaces a complete one.
+            path = join(self.path, 'snapshot')
+            temporary = path + '.tmp'
+            snapshot = open(temporary, 'wb')
+            try:
+                dump((segment, session_tuples, revoked_tuples), snapshot,
+                     HIGHEST_PROTOCOL)
+                snapshot.flush()
+                fsync(snapshot.fileno())
+
+            finally:
+                snapshot.close()
+            rename(temporary, path)
+
+            # The older journal files are no longer needed.
+            for old in self.segments():
+                if old < segment:
+                    remove(self.segment_path(old))
+
+        finally:
+            self.snapshot_lock.release()
+
+    def run_snapshots(self):
+        '''
+        Takes a snapshot every snapshot_interval seconds until the storage is
+        closed.
+        '''
+        while not self.stopped.wait(self.snapshot_interval):
+            self.snapshot()
+
+
+def open_storage(name):
+    '''
+    Creates the storage with the given name. The supported names are
+    "memory", "journal" and "sqlite". The journaled storage keeps its files in
+    the JOURNAL_PATH directory and the SQLite storage keeps its database at
+    STORAGE_PATH.
+    '''
+    if name == 'memory':
+        return MemoryStorage()
+    elif name == 'journal':
+        return JournaledStorage(JOURNAL_PATH)
+    elif name == 'sqlite':
+        return SQLiteStorage(STORAGE_PATH)
+    else:
+        raise ValueError('Unknown storage: ' + str(name))
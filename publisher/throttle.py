@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright (c) 2012, Polar Mobile.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name Polar Mobile nor the names of its contributors
+#     may be used to endorse or promote products derived from this software
+#     without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL POLAR MOBILE BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Used to protect and bound the buckets.
+from threading import Lock
+from collections import OrderedDict
+
+# Used to refill the buckets.
+from time import time
+
+# Used to configure the limits.
+from constants import (THROTTLE_CLIENT_RATE, THROTTLE_CLIENT_BURST,
+                       THROTTLE_USERNAME_RATE, THROTTLE_USERNAME_BURST,
+                       THROTTLE_SIZE)
+
+
+# The error reported when a client or username has made too many attempts to
+# log in, as a tuple of its code, message, status and debug message.
+TOO_MANY_ATTEMPTS = ('TooManyAttempts',
+                     'Too many attempts to log in. Please try again later.',
+                     403, None)
+
+
+class TokenBuckets(object):
+    '''
+    Limits the rate of attempts made for each key with a token bucket. Each
+    key's bucket holds up to burst tokens and is refilled at rate tokens per
+    second. Every attempt takes a token, and attempts are refused while the
+    bucket is empty. When only some attempts should count, limited checks the
+    bucket without taking a token and charge takes one afterwards.
+
+    At most size buckets are kept; once there are more, the bucket that was
+    used least recently is dropped. A dropped bucket is the same as a full
+    one, so this only forgets keys that have not made an attempt in a while.
+    The number of attempts refused and buckets dropped are kept in the
+    rejections and evictions attributes. If the rate is None, every attempt is
+    allowed and no buckets are kept.
+    '''
+    def __init__(self, rate, burst, size=THROTTLE_SIZE):
+        '''
+        Creates the limiter with no buckets.
+        '''
+        self.rate = rate
+        self.burst = burst
+        self.size = size
+        self.buckets = OrderedDict()
+        self.lock = Lock()
+
+        self.rejections = 0
+        self.evictions = 0
+
+    def allow(self, key):
+        '''
+        Takes a token from the key's bucket. Returns True if there was one to
+        take, or False if the attempt should be refused.
+        '''
+        if self.rate == None:
+            return True
+
+        now = time()
+        self.lock.acquire()
+        try:
+            tokens = self.level(key, now)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            else:
+                self.rejections += 1
+
+            self.store(key, tokens, now)
+            return allowed
+
+        finally:
+            self.lock.release()
+
+    def limited(self, key):
+        '''
+        Returns True if the key's bucket is empty, so that the attempt should
+        be refused, without taking a token.
+        '''
+        if self.rate == None:
+            return False
+
+        now = time()
+        self.lock.acquire()
+        try:
+            if self.level(key, now) >= 1:
+                return False
+            self.rejections += 1
+            return True
+
+        finally:
+            self.lock.release()
+
+    def charge(self, key):
+        '''
+        Takes a token from the key's bucket, if there is one to take.
+        '''
+        if self.rate == None:
+            return
+
+        now = time()
+        self.lock.acquire()
+        try:
+            self.store(key, max(0, self.level(key, now) - 1), now)
+
+        finally:
+            self.lock.release()
+
+    def level(self, key, now):
+        '''
+        Returns the number of tokens in the key's bucket at the given time.
+        Note that the lock is assumed to be held.
+        '''
+        bucket = self.buckets.get(key)
+        if bucket == None:
+            return self.burst
+        tokens, last = bucket
+        return min(self.burst, tokens + (now - last) * self.rate)
+
+    def store(self, key, tokens, now):
+        '''
+        Stores the number of tokens in the key's bucket at the given time. The
+        bucket is moved to the end, as the most recently used one, and the
+        least recently used bucket is dropped if there are too many. Note that
+        the lock is assumed to be held.
+        '''
+        self.buckets.pop(key, None)
+        self.buckets[key] = (tokens, now)
+        if len(self.buckets) > self.size:
+            self.buckets.popitem(last=False)
+            self.evictions += 1
+
+
+# The limits on attempts to log in from each remote address and for each
+# username. Each process keeps its own buckets.
+clients = TokenBuckets(THROTTLE_CLIENT_RATE, THROTTLE_CLIENT_BURST)
+usernames = TokenBuckets(THROTTLE_USERNAME_RATE, THROTTLE_USERNAME_BURST)
+
+
+def client_error(environment):
+    '''
+    Takes a token for the remote address of a request, found in its wsgi
+    environment. Returns TOO_MANY_ATTEMPTS if the address has made too many
+    attempts, or None.
+    '''
+    if not clients.allow(environment.get('REMOTE_ADDR')):
+        return TOO_MANY_ATTEMPTS
+    return None
+
+
+def username_error(username):
+    '''
+    Returns TOO_MANY_ATTEMPTS if too many failed attempts have been made to log
+    in as the user, or None. No token is taken, so that the user's own
+    successful logins are never counted against them; see username_failed.
+    '''
+    if usernames.limited(username):
+        return TOO_MANY_ATTEMPTS
+    return None
+
+
+def username_failed(username):
+    '''
+    Takes a token for a username whose credentials were not valid.
+    '''
+    usernames.charge(username)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright (c) 2012, Polar Mobile.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name Polar Mobile nor the names of its contributors
+#     may be used to endorse or promote products derived from this software
+#     without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL POLAR MOBILE BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Used to sign and verify the tokens.
+from hmac import new as hmac_new
+from hashlib import sha256
+
+# Used to encode the tokens so that they can be passed in http headers.
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+
+# Used to encode the contents of the tokens.
+try:
+    from json import loads, dumps
+except ImportError:
+    from simplejson import loads, dumps
+
+# Used to compare signatures without leaking timing information. Versions of
+# python older than 2.7.7 do not provide compare_digest.
+try:
+    from hmac import compare_digest
+except ImportError:
+    def compare_digest(a, b):
+        if len(a) != len(b):
+            return False
+        result = 0
+        for x, y in zip(a, b):
+            result |= ord(x) ^ ord(y)
+        return result == 0
+
+
+def encode(value):
+    '''
+    Encodes a byte string using url safe base64 without padding.
+    '''
+    return urlsafe_b64encode(value).rstrip('=')
+
+
+def decode(value):
+    '''
+    Decodes a byte string encoded by encode. Raises a TypeError or ValueError
+    if the value is not valid base64.
+    '''
+    return urlsafe_b64decode(value + '=' * (-len(value) % 4))
+
+
+def sign(secret, payload):
+    '''
+    Returns the encoded signature of the encoded payload.
+    '''
+    return encode(hmac_new(secret, payload, sha256).digest())
+
+
+def create_token(secret, username, product, deadline):
+    '''
+    Creates a self verifying session token. The token contains the username,
+    the product and the deadline of the session, followed by a signature of
+    those values. The two parts are separated by a period:
+
+        <payload>.<signature>
+
+    Anyone holding the secret can check the token without looking it up.
+    Note that the payload is only encoded, not encrypted, so it must not
+    contain secrets.
+
+    This function returns the token as a byte string.
+    '''
+    payload = encode(dumps([username, product, deadline]))
+    return payload + '.' + sign(secret, payload)
+
+
+def read_token(secret, token):
+    '''
+    Checks the signature of a token created by create_token and decodes it.
+
+    This function returns a tuple of the username, product, deadline and
+    signature of the token, or None if the token is not valid.
+    '''
+    # Tokens only ever contain ascii characters.
+    try:
+        token = str(token)
+    except UnicodeError:
+        return None
+
+    # Split the token and check its signature.
+    payload, separator, signature = token.partition('.')
+    if not compare_digest(sign(secret, payload), signature):
+        return None
+
+    # The signature is valid, so the payload was created by create_token.
+    username, product, deadline = loads(decode(payload))
+    return (username, product, deadline, signature)
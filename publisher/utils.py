@@ -37,6 +37,20 @@ except ImportError:
 # Used to generate exceptions.
 from itty import RequestError, NotFound, AppError, Forbidden
 
+# Used to report errors without raising them.
+from itty import Response
+
+# Used to bound the number of pre-encoded error reports and the size of
+# request bodies.
+from constants import (ERROR_CACHE_SIZE, MAX_BODY_SIZE, MAX_BODY_DEPTH,
+                       MAX_BODY_VALUES)
+
+# Used to find the structure of json encoded bodies without decoding them.
+from re import compile, DOTALL
+
+# Used to fill in the url of pre-encoded error reports.
+from publisher.codec import encode_string
+
 
 class JsonBadSyntax(RequestError):
     '''
@@ -56,9 +70,20 @@ class JsonUnauthorized(RequestError):
     error base class and create a new exception. To differentiate between
     a normal exception, and an exception that is json encoded, the class name
     is prepended with json.
+
+    The exception carries the authorization scheme of the entry point that
+    raised it, which errors.py sends in the WWW-Authenticate header.
     '''
     status = 401
 
+    def __init__(self, message, hide_traceback=False, scheme=None):
+        '''
+        Creates the exception. The scheme may be None if the entry point is
+        not known.
+        '''
+        RequestError.__init__(self, message, hide_traceback)
+        self.scheme = scheme
+
 
 class JsonForbidden(Forbidden):
     '''
@@ -112,7 +137,114 @@ def encode_error(url, code, message, debug=None):
     above is simply the debug message.
 
     This function takes the url, code and message and returns a json string
-    containing the encoded values.
+    containing the encoded values. Only the url and the debug message change
+    between errors with the same code and message, so the rest of the report
+    is encoded once and kept in a cache of error templates.
+    '''
+    return error_template(code, message, debug)(url, debug)
+
+
+class ErrorTemplate(object):
+    '''
+    A json encoded error report that is built once. Only the resource of the
+    report changes from one request to the next, so the report is split around
+    it and the url of each request is encoded and inserted between the pieces.
+
+    The debug message may carry text taken from the request, so a template
+    built with the DEBUG placeholder as its debug message leaves a second
+    slot that is filled with the debug message of each request. The text the
+    template is built from is then always chosen by the server, so the
+    placeholders are found exactly where they were put.
+    '''
+    # Placeholders used to find where the url and the debug message go.
+    RESOURCE = 'resource-placeholder'
+    DEBUG = 'debug-placeholder'
+
+    def __init__(self, code, message, debug=None):
+        '''
+        Encodes the error report.
+        '''
+        content = dumps(error_report(ErrorTemplate.RESOURCE, code, message,
+                                     debug))
+
+        # Find each slot, in the order they appear in the report. The url is
+        # slot 0 and the debug message is slot 1.
+        slots = [(content.index(dumps(ErrorTemplate.RESOURCE)), 0,
+                  dumps(ErrorTemplate.RESOURCE))]
+        if debug == ErrorTemplate.DEBUG:
+            slots.append((content.index(dumps(ErrorTemplate.DEBUG)), 1,
+                          dumps(ErrorTemplate.DEBUG)))
+        slots.sort()
+
+        self.pieces = []
+        self.slots = []
+        start = 0
+        for position, slot, placeholder in slots:
+            self.pieces.append(content[start:position])
+            self.slots.append(slot)
+            start = position + len(placeholder)
+        self.pieces.append(content[start:])
+
+    def __call__(self, url, debug=None):
+        '''
+        Returns the error report for the given url and debug message. Each is
+        escaped in the same way as the json module escapes the rest of the
+        report (see encode_text).
+        '''
+        if len(self.slots) == 1:
+            return self.pieces[0] + encode_text(url) + self.pieces[1]
+
+        values = (url, debug)
+        return (self.pieces[0] + encode_text(values[self.slots[0]]) +
+                self.pieces[1] + encode_text(values[self.slots[1]]) +
+                self.pieces[2])
+
+
+def encode_text(value):
+    '''
+    Encodes a string taken from a request as json. The url and debug message
+    of an error may contain any bytes the client sent, and reporting the error
+    must never fail, so byte strings are decoded as utf-8 with the bytes that
+    are not valid replaced.
+    '''
+    if isinstance(value, str):
+        value = value.decode('utf-8', 'replace')
+    return encode_string(value)
+
+
+# The error templates used by encode_error, keyed against the code and message
+# of each error and whether it has a debug message. These are chosen by the
+# server, so requests cannot add templates of their own.
+error_templates = {}
+
+
+def error_template(code, message, debug=None):
+    '''
+    Returns the template of an error report, building it the first time it is
+    needed. The debug message is not part of the template; it is passed to the
+    template along with the url. Once ERROR_CACHE_SIZE templates are kept,
+    further templates are built for each error and then discarded.
+    '''
+    key = (code, message, bool(debug))
+    template = error_templates.get(key)
+    if template == None:
+        if debug:
+            template = ErrorTemplate(code, message, ErrorTemplate.DEBUG)
+        else:
+            template = ErrorTemplate(code, message)
+
+        # Two threads may build the same template at once, in which case
+        # either copy may be kept.
+        if len(error_templates) < ERROR_CACHE_SIZE:
+            error_templates[key] = template
+
+    return template
+
+
+def error_report(url, code, message, debug=None):
+    '''
+    Builds the error report encoded by encode_error, without encoding it. This
+    is used to report errors as part of a larger response.
     '''
     result = {}
     result['error'] = {}
@@ -124,11 +256,10 @@ def encode_error(url, code, message, debug=None):
         result['debug'] = {}
         result['debug']['message'] = debug
 
-    # Encode the message as json and return.
-    return dumps(result)
+    return result
 
 
-def raise_error(url, code, message, status, debug=None):
+def raise_error(url, code, message, status, debug=None, scheme=None):
     '''
     For Client Errors (400-series) and Server Errors (500-series), an error
     report should be returned. Note that some errors will be returned to the
@@ -139,7 +270,9 @@ def raise_error(url, code, message, status, debug=None):
     This function takes the url, error code, message and the status (http error
     code) and creates an exception object with the parameters encoded. It then
     raises the error. The itty framework will then catch these errors and add
-    the proper header encodings. See error.py for more details.
+    the proper header encodings. See error.py for more details. 401 errors
+    carry the authorization scheme, if one is given, so that the
+    WWW-Authenticate header can be sent without matching the url again.
 
     Currently, the only supported status codes are 400, 403, 404 and 500.
     In all cases, the traceback is hidden to prevent any details of the
@@ -153,7 +286,7 @@ def raise_error(url, code, message, status, debug=None):
     if status == 400:
         raise JsonBadSyntax(message, hide_traceback=True)
     elif status == 401:
-        raise JsonUnauthorized(message, hide_traceback=True)
+        raise JsonUnauthorized(message, hide_traceback=True, scheme=scheme)
     elif status == 403:
         raise JsonForbidden(message, hide_traceback=True)
     elif status == 404:
@@ -163,6 +296,31 @@ def raise_error(url, code, message, status, debug=None):
         raise JsonAppError(message, hide_traceback=True)
 
 
+def error_response(url, error, scheme=None):
+    '''
+    Builds the response for an error without raising it. The error is a tuple
+    of the code, message, status and debug message (or None) of the error,
+    which are the arguments that raise_error takes after the url. The
+    response is the same as the one the handlers in errors.py send for the
+    exception that raise_error raises.
+
+    The scheme is the authorization scheme of the entry point, which is sent
+    in the WWW-Authenticate header of 401 errors.
+    '''
+    code, message, status, debug = error
+    content = encode_error(url, code, message, debug)
+
+    # As in raise_error, unsupported statuses are reported as an error 500.
+    headers = []
+    if status == 401 and scheme != None:
+        headers.append(('WWW-Authenticate', scheme))
+    elif status not in (400, 401, 403, 404):
+        status = 500
+
+    content_type = 'application/json'
+    return Response(content, headers, status, content_type)
+
+
 def check_base_url(url, api, version, format):
     '''
     The base url for all entry points in this API is as follows:
@@ -173,7 +331,7 @@ def check_base_url(url, api, version, format):
     supported version is "v1.0.0" and the only supported format is "json".
 
     This function examines these common parameters, and raises errors if the
-    parameters are incorrect.
+    parameters are incorrect. See base_url_error for the checks themselves.
 
     The errors this function returns are documented below.
 
@@ -208,6 +366,19 @@ def check_base_url(url, api, version, format):
             Debug: The requested format is not implemented: <format>
             HTTP Error Code: 404
     '''
+    error = base_url_error(api, version, format)
+    if error != None:
+        raise_error(url, *error)
+
+
+def base_url_error(api, version, format):
+    '''
+    Checks the common parameters of the base url in the same way as
+    check_base_url, but returns the first error found instead of raising it.
+
+    This function returns a tuple of the code, message, status and debug
+    message of the error, or None if the parameters are correct.
+    '''
     # All of the errors in this function share a common status and message.
     status = 404
     message = 'An error occurred. Please contact support.'
@@ -216,16 +387,129 @@ def check_base_url(url, api, version, format):
     if api != 'paywallproxy':
         code = 'InvalidAPI'
         debug = 'The requested api is not implemented: ' + str(api)
-        raise_error(url, code, message, status, debug)
+        return (code, message, status, debug)
 
     # Check to make sure the version is correct.
     if version != 'v1.0.0':
         code = 'InvalidVersion'
         debug = 'The requested version is not implemented: ' + str(version)
-        raise_error(url, code, message, status, debug)
+        return (code, message, status, debug)
 
     # Check to make sure the format is correct.
     if format != 'json':
         code = 'InvalidFormat'
         debug = 'The requested format is not implemented: ' + str(format)
-        raise_error(url, code, message, status, debug)
+        return (code, message, status, debug)
+
+    return None
+
+
+# The errors reported for request bodies that are over the limits, as tuples
+# of the code, message, status and debug message of each error.
+INVALID_LENGTH = ('InvalidFormat',
+                  'An error occurred. Please contact support.',
+                  400, 'The content length is not valid.')
+BODY_TOO_LARGE = ('InvalidFormat',
+                  'An error occurred. Please contact support.',
+                  400, 'The post body is too large.')
+INCOMPLETE_BODY = ('InvalidFormat',
+                   'An error occurred. Please contact support.', 400,
+                   'The post body is incomplete.')
+BODY_TOO_DEEP = ('InvalidFormat', 'An error occurred. Please contact support.',
+                 400, 'The post body is nested too deeply.')
+TOO_MANY_VALUES = ('InvalidFormat',
+                   'An error occurred. Please contact support.', 400,
+                   'The post body has too many values.')
+
+# The size of the chunks request bodies are read in.
+CHUNK_SIZE = 4096
+
+# Matches json strings, which are skipped, and the characters that open,
+# close and separate objects and arrays. The closing quote of a string is
+# optional, so a string that is never closed matches the rest of the body
+# rather than failing; together with the unrolled loop, which never
+# backtracks, this scans each character once whatever the body contains.
+STRUCTURE = compile(r'"[^"\\]*(?:\\.[^"\\]*)*"?|[\[\]{},:]', DOTALL)
+
+
+def content_length(environment, limit=MAX_BODY_SIZE):
+    '''
+    Checks the content length of a request before its body is read.
+
+    This function returns a tuple of the error, as a tuple of its code,
+    message, status and debug message, and None, or None and the length of
+    the body. A request without a content length has no body.
+    '''
+    length = environment.get('CONTENT_LENGTH')
+    if not length:
+        return (None, 0)
+
+    if not length.isdigit():
+        return (INVALID_LENGTH, None)
+
+    length = int(length)
+    if length > limit:
+        return (BODY_TOO_LARGE, None)
+
+    return (None, length)
+
+
+def read_request_body(environment, limit=MAX_BODY_SIZE):
+    '''
+    Reads the body of a request from the wsgi input stream, in chunks, once
+    its content length is known to be within the limit. Bodies that end
+    before their content length are rejected.
+
+    This function returns a tuple of the error and None, or None and the body.
+    '''
+    error, length = content_length(environment, limit)
+    if error != None or length == 0:
+        return (error, '')
+
+    stream = environment['wsgi.input']
+    chunks = []
+    while length > 0:
+        chunk = stream.read(min(length, CHUNK_SIZE))
+        if not chunk:
+            return (INCOMPLETE_BODY, None)
+        chunks.append(chunk)
+        length -= len(chunk)
+
+    return (None, ''.join(chunks))
+
+
+def body_error(body):
+    '''
+    Checks the size of a json encoded body, how deeply its objects and arrays
+    are nested and how many values they hold, before it is decoded. The body
+    is scanned once and the scan stops at the first limit that is exceeded,
+    so a hostile body is rejected before the json module builds any of it.
+
+    The members of objects are counted by their colons and the items of
+    arrays by the commas between them, so each array counts one value short.
+    Bodies that are not valid json are left for the json module to reject.
+
+    This function returns the error, or None if the body is within the limits.
+    '''
+    if len(body) > MAX_BODY_SIZE:
+        return BODY_TOO_LARGE
+
+    # The objects and arrays that are open, innermost last.
+    containers = []
+    values = 0
+    for match in STRUCTURE.finditer(body):
+        token = match.group()
+        if token == '{' or token == '[':
+            containers.append(token)
+            if len(containers) > MAX_BODY_DEPTH:
+                return BODY_TOO_DEEP
+        elif token == '}' or token == ']':
+            if len(containers) > 0:
+                containers.pop()
+        elif token == ':' or (token == ',' and len(containers) > 0 and
+                              containers[-1] == '['):
+            values += 1
+            if values > MAX_BODY_VALUES:
+                return TOO_MANY_VALUES
+
+    return None
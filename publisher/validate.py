@@ -30,21 +30,23 @@
 from itty import post, Response
 
 # Used to validate the values passed into the base url and raise errors.
-from publisher.utils import check_base_url, raise_error
+from publisher.utils import raise_error, error_report
+from publisher.utils import base_url_error, error_response
+from publisher.utils import content_length, body_error
 
 # Used to match URLs.
-from constants import (VALIDATE, SESSION_AUTHORIZATION_HEADER)
+from constants import (VALIDATE, BATCH_VALIDATE, SESSION_AUTHORIZATION_HEADER,
+                       MAX_BATCH_SIZE)
 
 # Used to validate a session key.
 from publisher.model import model
 
-# Used to decode and encode post bodies that contain json encoded data.
-# Note that in python 2.5 and 2.6 the json module is called simplejson.
-# In Python 2.7 and onwards, json is used.
-try:
-    from json import dumps
-except ImportError:
-    from simplejson import dumps
+# The error reported when a validate request has a body.
+INVALID_BODY = ('InvalidFormat', 'Invalid post body.', 400, None)
+
+# Used to decode post bodies that contain json encoded data and to encode the
+# responses (see codec.py).
+from publisher.codec import loads, dumps, session_body
 
 
 def get_session_id(url, environment):
@@ -70,6 +72,21 @@ def get_session_id(url, environment):
             HTTP Error Code: 400.
             Required: No
     '''
+    error, session_id = read_session_id(environment)
+    if error != None:
+        raise_error(url, *error, scheme=SESSION_AUTHORIZATION_HEADER)
+
+    return session_id
+
+
+def read_session_id(environment):
+    '''
+    Extracts the session id in the same way as get_session_id, but returns
+    any error instead of raising it.
+
+    This function returns a tuple of the error, as a tuple of its code,
+    message, status and debug message, and None, or None and the session id.
+    '''
     # All of the errors in this function share a common code and status.
     code = 'InvalidAuthScheme'
     status = 400
@@ -78,7 +95,7 @@ def get_session_id(url, environment):
     # Make sure the token is provided.
     if 'HTTP_AUTHORIZATION' not in environment:
         debug = 'The authorization token has not been provided.'
-        raise_error(url, code, message, status, debug)
+        return ((code, message, status, debug), None)
 
     # Make sure the token's value is correct. This token contains the session
     # id. It is not passed in the http body.
@@ -86,7 +103,7 @@ def get_session_id(url, environment):
     scheme = SESSION_AUTHORIZATION_HEADER + ' session:'
     if not token.startswith(scheme):
         debug = 'The authorization token is incorrect.'
-        raise_error(url, code, message, status, debug)
+        return ((code, message, status, debug), None)
 
     # Try to extract the session key. The syntax below extracts the characters
     # from the length of the scheme string to the end. Note that whitespace
@@ -96,10 +113,10 @@ def get_session_id(url, environment):
     # Check to make sure a session id has actually been provided.
     if len(session_id) == 0:
         debug = 'The session id has not been provided.'
-        raise_error(url, code, message, status, debug)
+        return ((code, message, status, debug), None)
 
     # Return the session key.
-    return session_id
+    return (None, session_id)
 
 
 @post(VALIDATE)
@@ -270,6 +287,17 @@ def validate(request, api, version, format, product_code):
             HTTP Error Code: 401
             Required: Yes
 
+        DirectoryUnavailable:
+
+            Returned when USER_DIRECTORY is set and the user directory cannot
+            be reached (see directory.py).
+
+            Code: DirectoryUnavailable
+            Message: An error occurred. Please contact support.
+            Debug: The user directory could not be reached.
+            HTTP Error Code: 500
+            Required: No
+
         InvalidAPI:
 
             Returned when the publisher does not recognize the requested api.
@@ -316,27 +344,287 @@ def validate(request, api, version, format, product_code):
     # Store the full URL string so that it can be used to report errors.
     url = request.path
 
+    # Validate the session and create the response body. Errors are returned
+    # rather than raised, so they are reported without unwinding through
+    # itty's error handlers.
+    error = base_url_error(api, version, format)
+    if error == None:
+        # The body is only read once its length is known to be acceptable.
+        error, length = content_length(request._environ)
+    if error == None:
+        error, content = validate_result(url, request._environ, request.body,
+                                         product_code)
+    if error != None:
+        return error_response(url, error, SESSION_AUTHORIZATION_HEADER)
+
+    status = 200
+    headers = []
+    content_type = 'application/json'
+    return Response(content, headers, status, content_type)
+
+
+def validate_result(url, environment, body, product_code):
+    '''
+    Processes a validate request whose api, version and format are already
+    known to be supported. The request is described by its url, its wsgi
+    environment and its body, so that it can be processed by any front end
+    (see frontend.py). Errors are returned rather than raised.
+
+    This function returns a tuple of the error, as a tuple of its code,
+    message, status and debug message, and None, or None and the json encoded
+    response body.
+    '''
     # Validate the request.
-    check_base_url(url, api, version, format)
-    if len(request.body.strip()) > 0:
+    if len(body.strip()) > 0:
         # If there is a body for this API call, that implies that the caller
-        # is not conforming to the API, so raise an error.
-        code = 'InvalidFormat'
-        message = 'Invalid post body.'
-        status = 400
-        raise_error(url, code, message, status)
+        # is not conforming to the API, so report an error.
+        return (INVALID_BODY, None)
 
     # Validate the session id using the data model.
-    session_id = get_session_id(url, request._environ)
-    products = model().validate_session(url, session_id, product_code)
+    error, session_id = read_session_id(environment)
+    if error != None:
+        return (error, None)
 
-    # Create the response body.
-    result = {}
-    result['sessionKey'] = session_id
-    result['products'] = products
-    content = dumps(result)
+    error, products = model().check_validation(session_id, product_code)
+    if error != None:
+        return (error, None)
+
+    # Create the response body from its template.
+    return (None, session_body(session_id, products))
+
+
+def check_batch_authorization(url, environment):
+    '''
+    Checks the auth-scheme token of a batch validate request. The session ids
+    of a batch are passed in the body, so the token only names the scheme:
+
+        Authorization: PolarPaywallProxySessionv1.0.0
+
+    The errors raised are the same InvalidAuthScheme errors as
+    get_session_id raises.
+    '''
+    error = batch_authorization_error(environment)
+    if error != None:
+        raise_error(url, *error, scheme=SESSION_AUTHORIZATION_HEADER)
+
+
+def batch_authorization_error(environment):
+    '''
+    Checks the auth-scheme token of a batch validate request in the same way
+    as check_batch_authorization, but returns the error instead of raising
+    it, or None if the token is correct.
+    '''
+    # All of the errors in this function share a common code and status.
+    code = 'InvalidAuthScheme'
+    status = 400
+    message = 'An error occurred. Please contact support.'
+
+    # Make sure the token is provided.
+    if 'HTTP_AUTHORIZATION' not in environment:
+        debug = 'The authorization token has not been provided.'
+        return (code, message, status, debug)
+
+    # Make sure the token's value is correct.
+    if environment['HTTP_AUTHORIZATION'].strip() != \
+        SESSION_AUTHORIZATION_HEADER:
+        debug = 'The authorization token is incorrect.'
+        return (code, message, status, debug)
+
+    return None
+
+
+def decode_batch(url, body):
+    '''
+    Decodes the body of a batch validate request and returns the list of
+    session id and product pairs that it contains.
+
+    Server Errors:
+
+        InvalidFormat:
+
+            Returned when the body is not a json encoded object with a
+            "sessions" list of at most MAX_BATCH_SIZE objects, each with a
+            "sessionKey" and a "product" string.
+
+            Code: InvalidFormat
+            Message: An error occurred. Please contact support.
+            Debug: Varies with the error.
+            HTTP Error Code: 400.
+            Required: No
+    '''
+    error, pairs = read_batch(body)
+    if error != None:
+        raise_error(url, *error, scheme=SESSION_AUTHORIZATION_HEADER)
+
+    return pairs
+
+
+def read_batch(body):
+    '''
+    Decodes the body of a batch validate request in the same way as
+    decode_batch, but returns any error instead of raising it.
+
+    This function returns a tuple of the error, as a tuple of its code,
+    message, status and debug message, and None, or None and the list of
+    pairs.
+    '''
+    # All of the errors in this function share a common code and status.
+    code = 'InvalidFormat'
+    status = 400
+    message = 'An error occurred. Please contact support.'
+
+    # Reject bodies that are too large or too complex before decoding them.
+    error = body_error(body)
+    if error != None:
+        return (error, None)
+
+    try:
+        json_body = loads(body)
+    except ValueError:
+        debug = 'Could not decode post body. json is expected.'
+        return ((code, message, status, debug), None)
+
+    if not isinstance(json_body, dict) or \
+        not isinstance(json_body.get('sessions'), list):
+        debug = 'The post body does not contain a list of sessions.'
+        return ((code, message, status, debug), None)
+
+    sessions = json_body['sessions']
+    if len(sessions) < 1 or len(sessions) > MAX_BATCH_SIZE:
+        debug = 'The number of sessions must be between 1 and %d.' % \
+            MAX_BATCH_SIZE
+        return ((code, message, status, debug), None)
+
+    pairs = []
+    for session in sessions:
+        if not isinstance(session, dict):
+            debug = 'Each session must be an object.'
+            return ((code, message, status, debug), None)
+
+        session_id = session.get('sessionKey')
+        product = session.get('product')
+        if not isinstance(session_id, basestring) or \
+            not isinstance(product, basestring):
+            debug = 'Each session must have a sessionKey and a product.'
+            return ((code, message, status, debug), None)
+
+        pairs.append((session_id.strip(), product))
+
+    return (None, pairs)
+
+
+@post(BATCH_VALIDATE)
+def batch_validate(request, api, version, format):
+    '''
+    Overview:
+
+        Validates many sessions in a single request. Each session is checked
+        in the same way as by the validate entry point, but a failed session
+        does not fail the request; its error is reported in place of its
+        products. The URL for this entry point is:
+
+            /paywallproxy/v1.0.0/json/batchvalidate
+
+    Parameters:
+
+        The authorization header names the session scheme, without a session
+        id:
+
+            Authorization: PolarPaywallProxySessionv1.0.0
+
+        The body is a json encoded object with a "sessions" list of up to
+        MAX_BATCH_SIZE (see constants.py) objects, each with the
+        "sessionKey" to validate and the "product" to validate it against.
+
+    Example:
+
+        Example Request:
+
+            POST /paywallproxy/v1.0.0/json/batchvalidate HTTP/1.1
+            Authorization: PolarPaywallProxySessionv1.0.0
+
+            {
+                "sessions": [
+                    {"sessionKey": "9c4a51cc08d1", "product": "gold-level"},
+                    {"sessionKey": "5ab1d2e50c03", "product": "gold-level"}
+                ]
+            }
+
+        Example Response:
+
+            HTTP/1.1 200 OK
+            Content-Type: application/json
+
+            {
+                "results": [
+                    {
+                        "sessionKey": "9c4a51cc08d1",
+                        "products": ["gold-level", "silver-level"]
+                    },
+                    {
+                        "sessionKey": "5ab1d2e50c03",
+                        "error": {
+                            "code": "SessionExpired",
+                            "message": "Your session has expired. ...",
+                            "resource": "/paywallproxy/v1.0.0/json/..."
+                        },
+                        "status": 401
+                    }
+                ]
+            }
+
+    Errors:
+
+        The errors of each session are the AccountProblem, InvalidProduct and
+        SessionExpired errors of the validate entry point, reported with
+        their status in the results. The request itself fails with the
+        InvalidAPI, InvalidVersion, InvalidFormat and InvalidAuthScheme
+        errors of the validate entry point.
+    '''
+    # Store the full URL string so that it can be used to report errors.
+    url = request.path
+
+    # Validate the sessions and create the response body.
+    error = base_url_error(api, version, format)
+    if error == None:
+        # The body is only read once its length is known to be acceptable.
+        error, length = content_length(request._environ)
+    if error == None:
+        error, content = batch_result(url, request._environ, request.body)
+    if error != None:
+        return error_response(url, error, SESSION_AUTHORIZATION_HEADER)
 
     status = 200
     headers = []
     content_type = 'application/json'
     return Response(content, headers, status, content_type)
+
+
+def batch_result(url, environment, body):
+    '''
+    Processes a batch validate request in the same way as validate_result,
+    and returns the same result.
+    '''
+    error = batch_authorization_error(environment)
+    if error != None:
+        return (error, None)
+
+    error, pairs = read_batch(body)
+    if error != None:
+        return (error, None)
+
+    # Validate every session in a single pass over the data model.
+    results = []
+    checked = model().validate_sessions(pairs)
+    for (session_id, product), (error, products) in zip(pairs, checked):
+        if error != None:
+            code, message, status, debug = error
+            result = error_report(url, code, message, debug)
+            result['status'] = status
+        else:
+            result = {}
+            result['products'] = products
+        result['sessionKey'] = session_id
+        results.append(result)
+
+    return (None, dumps({'results': results}))
@@ -36,7 +36,7 @@ from mock import patch
 from itty import Request, Response
 
 # Used to test error handling code in errors.py.
-from simplejson import dumps
+from simplejson import dumps, loads
 from publisher.errors import (bad_syntax, unauthorized, forbidden, not_found,
                               internal_error)
 from publisher.utils import (JsonBadSyntax, JsonUnauthorized, JsonForbidden,
@@ -44,23 +44,71 @@ from publisher.utils import (JsonBadSyntax, JsonUnauthorized, JsonForbidden,
 
 # Used to test error encoding.
 from publisher.utils import encode_error, raise_error, check_base_url
+from publisher.utils import error_report, error_templates
+from publisher.utils import read_request_body, body_error
 
 # Used to test auth handling code.
 from publisher.auth import (check_authorization_header, decode_body,
                             check_device, check_auth_params, auth,
                             check_publisher_auth_params,)
+from publisher.auth import (auth_body_error, device_error, auth_params_error,
+                            publisher_auth_params_error)
 
 # Used to test the model code.
-from publisher.model import model
+from publisher.model import model, SessionReaper, INVALID_CREDENTIALS
 
 # Used to reset the models singleton and test timeouts.
 from publisher.constants import SESSION_TIMEOUT
 
-# Used to test the timestamps in model.py.
-from datetime import datetime, timedelta
+# Used to test the deadlines in model.py and to wait for background threads.
+from time import sleep, time
 
 # Used to test the validate API entry point.
-from publisher.validate import get_session_id, validate
+from publisher.validate import get_session_id, validate, batch_validate
+
+# Used to test the storage used by the model.
+from publisher.storage import MemoryStorage, SQLiteStorage, JournaledStorage
+from publisher.journal import Journal
+from tempfile import mkdtemp
+from shutil import rmtree
+from os.path import join
+from os import listdir
+
+# Used to test the locks that protect the model.
+from publisher.locks import ReadWriteLock, LockStripes
+from threading import Thread
+
+# Used to test the users catalog loader.
+from publisher.loader import load_users
+
+# Used to test the prefork server.
+from publisher.prefork import listen, PooledWSGIServer, serve
+from urllib2 import urlopen
+
+# Used to test the event driven front end and the dispatcher.
+from publisher.frontend import Frontend
+from publisher.dispatch import resolve, dispatch, application
+from publisher.auth import auth_result
+from publisher.validate import batch_result
+from socket import create_connection
+from StringIO import StringIO
+
+# Used to test the product registry.
+from publisher.products import ProductRegistry, ProductList
+
+# Used to test the json codecs.
+from publisher.codec import load_codec, session_body
+
+# Used to test hashed passwords.
+from publisher.passwords import hash_password, verify_password, VerifierPool
+from publisher.passwords import CredentialCache
+
+# Used to test the limits on attempts to log in.
+from publisher.throttle import TokenBuckets
+
+# Used to test the external user directory.
+from publisher.directory import (UserDirectory, FakeDirectory,
+                                 DirectoryError)
 
 
 def test_start_response(status, headers):
@@ -116,6 +164,99 @@ class TestUtils(TestCase):
             '"code": "TestError", "resource": "/test/"}}'
         self.assertEqual(result, content)
 
+    @patch('publisher.utils.ERROR_CACHE_SIZE', 1)
+    def test_encode_error_cache(self):
+        '''
+        Tests that cached error reports escape each url the same way as the
+        json module, and that the number of cached reports is bounded.
+        '''
+        error_templates.clear()
+        for url in ('/test/', u'/t\xe9st/"quoted"\\/', '/other/'):
+            for debug in (None, 'A debug message.', 'Another message.'):
+                result = encode_error(url, 'TestError', 'Test.', debug)
+                self.assertEqual(result,
+                    dumps(error_report(url, 'TestError', 'Test.', debug)))
+        self.assertEqual(len(error_templates), 1)
+        error_templates.clear()
+
+    def test_encode_error_debug(self):
+        '''
+        Tests that debug messages carrying text from the request are encoded
+        correctly and share the template of their code and message.
+        '''
+        error_templates.clear()
+        debugs = ('resource-placeholder', 'debug-placeholder',
+                  '"resource-placeholder"', u'"\u0000" \\ "debug"')
+        for debug in debugs:
+            for url in ('/test/', 'resource-placeholder'):
+                result = encode_error(url, 'TestError', 'Test.', debug)
+                self.assertEqual(result,
+                    dumps(error_report(url, 'TestError', 'Test.', debug)))
+        self.assertEqual(error_templates.keys(),
+                         [('TestError', 'Test.', True)])
+        error_templates.clear()
+
+    def test_encode_error_invalid_utf8(self):
+        '''
+        Tests that urls and debug messages that are not valid utf-8 are
+        reported with the invalid bytes replaced rather than failing.
+        '''
+        url = '/paywallproxy/v1.0.0/json/auth/\xff'
+        result = encode_error(url, 'TestError', 'Test.', 'Bad: \xfe')
+        self.assertEqual(loads(result),
+            error_report(u'/paywallproxy/v1.0.0/json/auth/\ufffd',
+                         'TestError', 'Test.', u'Bad: \ufffd'))
+
+    def test_read_request_body(self):
+        '''
+        Tests that bodies are only read when their length is within the
+        limit, and that bodies shorter than their length are rejected.
+        '''
+        environment = {}
+        self.assertEqual(read_request_body(environment), (None, ''))
+
+        environment['wsgi.input'] = StringIO('x' * 5000)
+        environment['CONTENT_LENGTH'] = '5000'
+        self.assertEqual(read_request_body(environment), (None, 'x' * 5000))
+
+        for length, debug in (('-1', 'The content length is not valid.'),
+                              ('16385', 'The post body is too large.'),
+                              ('10', 'The post body is incomplete.')):
+            environment['wsgi.input'] = StringIO('x' * 5)
+            environment['CONTENT_LENGTH'] = length
+            error, body = read_request_body(environment)
+            self.assertEqual(error[3], debug)
+
+        # Nothing is read from a body that is too large.
+        environment['wsgi.input'] = StringIO('x' * 16385)
+        environment['CONTENT_LENGTH'] = '16385'
+        read_request_body(environment)
+        self.assertEqual(environment['wsgi.input'].tell(), 0)
+
+    def test_body_error(self):
+        '''
+        Tests that bodies that are nested too deeply or hold too many values
+        are rejected, and that strings are not mistaken for structure.
+        '''
+        self.assertEqual(body_error(dumps({'a': [{'b': '[[[[{{{{:,'}]})),
+                         None)
+        self.assertEqual(body_error('[' * 8 + ']' * 8), None)
+        self.assertEqual(body_error('[' * 9 + ']' * 9)[3],
+                         'The post body is nested too deeply.')
+        self.assertEqual(body_error(dumps(range(512))), None)
+        self.assertEqual(body_error(dumps(range(514)))[3],
+                         'The post body has too many values.')
+        self.assertEqual(body_error(' ' * 16385)[3],
+                         'The post body is too large.')
+
+        # Strings that are never closed are scanned once, however they end.
+        for body in ('"\\' * 8192, '["' + '\\"' * 5461, '[' * 9 + '"\\'):
+            start = time()
+            body_error(body)
+            self.assertTrue(time() - start < 0.05)
+        self.assertEqual(body_error('[' * 9 + '"\\')[3],
+                         'The post body is nested too deeply.')
+
     def test_raise_error_bad_syntax(self):
         '''
         Tests generation of a 400 error.
@@ -372,14 +513,22 @@ class TestErrors(TestCase):
         url = '/paywallproxy/v1.0.0/json/auth/product01'
         request = create_request(url)
         content = dumps('test')
-        exception = JsonUnauthorized(content)
+        exception = JsonUnauthorized(content,
+                                     scheme='PolarPaywallProxyAuthv1.0.0')
         request._environ = {}
 
+        # Capture the headers of the response.
+        responses = []
+        request._start_response = lambda status, headers: \
+            responses.append(headers)
+
         # Issue the request to the method being tested.
         result = unauthorized(request, exception)
 
         # Check the result.
         self.assertEqual(result, content)
+        self.assertTrue(('Www-Authenticate', 'PolarPaywallProxyAuthv1.0.0')
+                        in responses[0])
 
     def test_unauthorized_pass_validation(self):
         '''
@@ -390,14 +539,22 @@ class TestErrors(TestCase):
         url = '/paywallproxy/v1.0.0/json/validate/product01'
         request = create_request(url)
         content = dumps('test')
-        exception = JsonUnauthorized(content)
+        exception = JsonUnauthorized(content,
+                                     scheme='PolarPaywallProxySessionv1.0.0')
         request._environ = {}
 
+        # Capture the headers of the response.
+        responses = []
+        request._start_response = lambda status, headers: \
+            responses.append(headers)
+
         # Issue the request to the method being tested.
         result = unauthorized(request, exception)
 
         # Check the result.
         self.assertEqual(result, content)
+        self.assertTrue(('Www-Authenticate', 'PolarPaywallProxySessionv1.0.0')
+                        in responses[0])
 
     def test_unauthorized_unknown_exception(self):
         '''
@@ -935,6 +1092,33 @@ class TestAuth(TestCase):
         else:
             raise AssertionError('No exception raised.')
 
+    def test_check_auth_params_count(self):
+        '''
+        Tests to see if the check_auth_params function refuses too many
+        authParams.
+        '''
+        # Create seed data for the test.
+        url = '/test/'
+        body = {}
+        body['authParams'] = dict(('key%d' % index, 'value')
+                                  for index in range(17))
+
+        # Call the check_auth_params function and expect an exception.
+        try:
+            check_auth_params(url, body)
+
+        # Catch the exception and analyze it.
+        except JsonBadSyntax, exception:
+            content = u'{"debug": {"message": "The authParams has too many '\
+                'values."}, "error": {"message": "An error occurred. '\
+                'Please contact support.", "code": "InvalidAuthParams", '\
+                '"resource": "/test/"}}'
+            self.assertEqual(unicode(exception), content)
+
+        # If no exception was raised, raise an error.
+        else:
+            raise AssertionError('No exception raised.')
+
     def test_check_auth_params(self):
         '''
         Tests to see if the check_auth_params with a positive example.
@@ -1030,6 +1214,44 @@ class TestAuth(TestCase):
         else:
             raise AssertionError('No exception raised.')
 
+    def test_auth_body_error(self):
+        '''
+        Tests to see if the compiled schema reports the same errors as the
+        device, authParams and publisher authParams checks do in turn.
+        '''
+        def body():
+            return {'device': {'manufacturer': 'test', 'model': u'test',
+                               'os_version': 'test'},
+                    'authParams': {'username': 'test', 'password': 'test'}}
+
+        bodies = [body(), {}, 'ab', [], {'authParams': {}}]
+        for key in ('device', 'authParams'):
+            for value in (None, 1, 'test', [], {}):
+                bodies.append(body())
+                bodies[-1][key] = value
+            bodies.append(body())
+            del bodies[-1][key]
+        for container, key in (('device', 'manufacturer'),
+                               ('device', 'model'),
+                               ('device', 'os_version'),
+                               ('authParams', 'username'),
+                               ('authParams', 'password')):
+            for value in (None, 1, [], {}):
+                bodies.append(body())
+                bodies[-1][container][key] = value
+            bodies.append(body())
+            del bodies[-1][container][key]
+        bodies.append(body())
+        bodies[-1]['authParams'].update(('key%d' % index, 'test')
+                                        for index in range(20))
+        bodies.append(body())
+        bodies[-1]['authParams']['other'] = 1
+
+        for value in bodies:
+            expected = device_error(value) or auth_params_error(value) or \
+                publisher_auth_params_error(value)
+            self.assertEqual(auth_body_error(value), expected)
+
     @patch('publisher.model.uuid4')
     def test_auth(self, model_uuid4):
         '''
@@ -1079,6 +1301,69 @@ class TestAuth(TestCase):
         self.assertEquals(result.content_type, 'application/json')
         self.assertEquals(result.status, 200)
 
+    def test_auth_throttled(self):
+        '''
+        Tests that the auth function refuses attempts from clients that have
+        made too many, and for usernames that too many failed attempts have
+        been made for, before checking the credentials.
+        '''
+        environment = {}
+        environment['HTTP_AUTHORIZATION'] = 'PolarPaywallProxyAuthv1.0.0'
+        environment['REMOTE_ADDR'] = '10.0.0.1'
+        body = {}
+        body['device'] = {}
+        body['device']['manufacturer'] = 'test'
+        body['device']['model'] = 'test'
+        body['device']['os_version'] = 'test'
+        body['authParams'] = {}
+        body['authParams']['username'] = 'user01'
+        body['authParams']['password'] = 'test'
+        content = dumps(body)
+
+        expected = '{"error": {"message": "Too many attempts to log in. '\
+            'Please try again later.", "code": "TooManyAttempts", '\
+            '"resource": "/test/"}}'
+        request = create_request('/test/')
+        request._environ = environment
+
+        # Every attempt from a client counts, and the body is not even decoded
+        # once it has made too many.
+        with patch('publisher.throttle.clients', TokenBuckets(1e-6, 1)):
+            with patch.object(model, 'check_credentials') as check:
+                check.return_value = (None, ('test', ProductList([])))
+                error, result = auth_result('/test/', environment, content,
+                                            'product01')
+                self.assertEqual(error, None)
+
+                request.body = '{'
+                result = auth(request, 'paywallproxy', 'v1.0.0', 'json',
+                              'product01')
+                self.assertEqual(result.status, 403)
+                self.assertEqual(result.output, expected)
+                self.assertEqual(check.call_count, 1)
+
+        # Only failed attempts count against a username, so the user can keep
+        # logging in until someone gets the password wrong.
+        with patch('publisher.throttle.usernames', TokenBuckets(1e-6, 1)):
+            with patch.object(model, 'check_credentials') as check:
+                check.return_value = (None, ('test', ProductList([])))
+                for attempt in range(3):
+                    error, result = auth_result('/test/', environment,
+                                                content, 'product01')
+                    self.assertEqual(error, None)
+
+                check.return_value = (INVALID_CREDENTIALS, None)
+                error, result = auth_result('/test/', environment, content,
+                                            'product01')
+                self.assertEqual(error, INVALID_CREDENTIALS)
+
+                request.body = content
+                result = auth(request, 'paywallproxy', 'v1.0.0', 'json',
+                              'product01')
+                self.assertEqual(result.status, 403)
+                self.assertEqual(result.output, expected)
+                self.assertEqual(check.call_count, 4)
+
     @patch('publisher.model.uuid4')
     def test_unicode(self, model_uuid4):
         '''
@@ -1118,20 +1403,16 @@ class TestAuth(TestCase):
         model_uuid4.return_value = session_id
 
         # Try to authenticate the invalid user.
-        try:
-            # Run the auth function.
-            result = auth(request, api, version, format, product_code)
-
-        # Catch the exception and analyze it.
-        except JsonUnauthorized, exception:
-            content = u'{"error": {"message": "The credentials you have '\
-                'provided are not valid.", "code": '\
-                '"InvalidPaywallCredentials", "resource": "/test/"}}'
-            self.assertEqual(unicode(exception), content)
+        result = auth(request, api, version, format, product_code)
 
-        # If no exception was raised, raise an error.
-        else:
-            raise AssertionError('No exception raised.')
+        # The error is returned with the scheme of the auth entry point.
+        content = u'{"error": {"message": "The credentials you have '\
+            'provided are not valid.", "code": '\
+            '"InvalidPaywallCredentials", "resource": "/test/"}}'
+        self.assertEquals(result.output, content)
+        self.assertEquals(result.status, 401)
+        self.assertEquals(result.headers['WWW-Authenticate'],
+                          'PolarPaywallProxyAuthv1.0.0')
 
 
 class TestModel(TestCase):
@@ -1144,36 +1425,35 @@ class TestModel(TestCase):
         This function is called after every test to reset the state of the
         singleton in model.py.
         '''
-        # Reset the shared data in the model class. When users is set to None
-        # the model class copies it again from constants.py.
-        model.users = None
+        # Reset the shared data in the model class. When storage is set to
+        # None the model class creates it again from constants.py.
+        model.storage = None
 
-    @patch('publisher.model.datetime')
-    def create_expired_session(self, username, product,model_datetime):
+    @patch('publisher.model.time')
+    def create_expired_session(self, username, product, model_time):
         '''
         In order to test session key expiry, we need to create a session that
-        has expired using the mock testing library to override datetime.now.
-        Unfortunately, the code to check for outdated keys also uses
-        datetime.now. So we have to mock the datetime.now function using a
-        separate function.
+        has expired using the mock testing library to override time.
+        Unfortunately, the code to check for outdated keys also uses time. So
+        we have to mock the time function using a separate function.
         '''
         # Create a timestamp that is intentionally outdated so that the
         # update function expires the id.
-        timestamp = datetime.now() - timedelta(hours=SESSION_TIMEOUT + 1)
-        model_datetime.now.return_value = timestamp
+        timestamp = time() - (SESSION_TIMEOUT + 1) * 60 * 60
+        model_time.return_value = timestamp
 
         # Generate the session id and return it.
         return model().create_session_id(username, product)
 
-    @patch('publisher.model.datetime')
+    @patch('publisher.model.time')
     @patch('publisher.model.uuid4')
-    def test_create_session_id(self, model_uuid4, model_datetime):
+    def test_create_session_id(self, model_uuid4, model_time):
         '''
         Tests to see if a user's session id is created properly. There is no
         need to worry about threading as all the tests are run in a single
         thread, so locking isn't an issue.
         '''
-        # Create seed data for the test. Mock will override uuid4 and datetime
+        # Create seed data for the test. Mock will override uuid4 and time
         # in the call to create_session_id to insert our testing values.
         session_id = 'test'
 
@@ -1181,10 +1461,10 @@ class TestModel(TestCase):
         # tested.
         model_uuid4.return_value = session_id
 
-        # Create a fake timestamp and mock out the datetime class in the
+        # Create a fake timestamp and mock out the time function in the
         # called function so that a comparison can be made.
-        timestamp = datetime.now()
-        model_datetime.now.return_value = timestamp
+        timestamp = 1000000000.5
+        model_time.return_value = timestamp
 
         # Note that the test user has already been loaded in constants.py.
         username = 'user01'
@@ -1200,9 +1480,15 @@ class TestModel(TestCase):
 
         # Introspect into the model class to make sure the session key was
         # generated properly.
-        sessions = model.users[username]['session ids']
-        session_timestamp = sessions[session_id]
-        self.assertEqual(session_timestamp, (product, timestamp))
+        self.assertEqual(model.storage.users[username]['session ids'].keys(),
+                         [session_id])
+
+        # The session id must also be indexed against its user.
+        session = model.storage.sessions[session_id]
+        self.assertEqual(session.username, username)
+        self.assertEqual(session.product, product)
+        deadline = 1000000000 + SESSION_TIMEOUT * 60 * 60
+        self.assertEqual(session.deadline, deadline)
 
     def test_update_session_id(self):
         '''
@@ -1220,9 +1506,123 @@ class TestModel(TestCase):
         model().update_session_ids(username)
 
         # Make sure a session id was removed.
-        session_ids = model.users[username]['session ids']
+        session_ids = model.storage.users[username]['session ids']
         self.assertEqual(len(session_ids), 0)
 
+        # Make sure the session id was removed from the index as well.
+        self.assertEqual(len(model.storage.sessions), 0)
+
+    def test_expire_sessions(self):
+        '''
+        Test to make sure that expire_sessions removes expired session ids
+        from the user and the session index while keeping valid ones.
+        '''
+        # Create one expired and one valid session. user01 has already been
+        # created in constants.py.
+        username = 'user01'
+        product = 'product01'
+        expired_id = self.create_expired_session(username, product)
+        valid_id = model().create_session_id(username, product)
+
+        # Only the expired session should be removed.
+        self.assertEqual(model().expire_sessions(), 1)
+        session_ids = model.storage.users[username]['session ids']
+        self.assertEqual(session_ids.keys(), [valid_id])
+        self.assertEqual(model.storage.sessions.keys(), [valid_id])
+
+        # The heap should only contain the valid session.
+        self.assertEqual(len(model.storage.expiry), 1)
+        self.assertEqual(model().expire_sessions(), 0)
+
+    def test_session_reaper(self):
+        '''
+        Test to make sure that the reaper thread expires session ids in the
+        background and stops when asked to.
+        '''
+        # Create the expired session.
+        username = 'user01'
+        product = 'product01'
+        self.create_expired_session(username, product)
+
+        # Run the reaper with a short interval and wait for it to stop.
+        reaper = SessionReaper(0.01)
+        reaper.start()
+        for i in range(100):
+            if len(model.storage.sessions) == 0:
+                break
+            sleep(0.01)
+        reaper.stop()
+        reaper.join()
+
+        # Make sure the session id was removed.
+        self.assertEqual(len(model.storage.sessions), 0)
+        self.assertEqual(len(model.storage.users[username]['session ids']), 0)
+
+    def test_revoke_session(self):
+        '''
+        Test to make sure that a revoked session id is removed from both the
+        user and the session index and can no longer be validated.
+        '''
+        # Create seed data for the test. user01 is defined in constants.py.
+        url = '/test/'
+        username = 'user01'
+        product = 'product01'
+        session_id = model().create_session_id(username, product)
+
+        # Revoke the session. Revoking it twice should report that it was
+        # not found the second time.
+        self.assertTrue(model().revoke_session(session_id))
+        self.assertFalse(model().revoke_session(session_id))
+        session_ids = model.storage.users[username]['session ids']
+        self.assertTrue(session_id not in session_ids)
+        self.assertTrue(session_id not in model.storage.sessions)
+
+        # Try to validate the revoked session.
+        try:
+            model().validate_session(url, session_id, product)
+
+        # Catch the exception and analyze it.
+        except JsonUnauthorized, exception:
+            content = u'{"error": {"message": "Your session has expired. '\
+                'Please log back in.", "code": "SessionExpired", "resource": '\
+                '"/test/"}}'
+            self.assertEqual(unicode(exception), content)
+            self.assertEqual(exception.scheme,
+                             'PolarPaywallProxySessionv1.0.0')
+
+        # If no exception was raised, raise an error.
+        else:
+            raise AssertionError('No exception raised.')
+
+    @patch('publisher.model.uuid4')
+    def test_max_user_sessions(self, model_uuid4):
+        '''
+        Test to make sure that a user cannot hold more than the allowed number
+        of session ids, and that the session id validated least recently is
+        evicted first.
+        '''
+        url = '/test/'
+        username = 'user01'
+        product = 'product01'
+        model()
+        model.storage.max_user_sessions = 2
+
+        # Create two sessions and validate the first, so that the second is
+        # the least recently used.
+        model_uuid4.return_value = 'first'
+        model().create_session_id(username, product)
+        model_uuid4.return_value = 'second'
+        model().create_session_id(username, product)
+        model().validate_session(url, 'first', product)
+
+        # Creating a third session evicts the second.
+        model_uuid4.return_value = 'third'
+        model().create_session_id(username, product)
+        session_ids = model.storage.users[username]['session ids']
+        self.assertEqual(session_ids.keys(), ['first', 'third'])
+        self.assertTrue('second' not in model.storage.sessions)
+        self.assertEqual(model.storage.evictions, 1)
+
     def test_authenticate_user_username(self):
         '''
         Test to make sure the authenticate_user function checks for a valid
@@ -1244,6 +1644,7 @@ class TestModel(TestCase):
                 'provided are not valid.", "code": '\
                 '"InvalidPaywallCredentials", "resource": "/test/"}}'
             self.assertEqual(unicode(exception), content)
+            self.assertEqual(exception.scheme, 'PolarPaywallProxyAuthv1.0.0')
 
         # If no exception was raised, raise an error.
         else:
@@ -1275,6 +1676,57 @@ class TestModel(TestCase):
         else:
             raise AssertionError('No exception raised.')
 
+    def test_authenticate_user_hashed_password(self):
+        '''
+        Test to make sure the authenticate_user function checks passwords
+        that are stored hashed.
+        '''
+        model().storage.add_user('hashed', hash_password('secret', 10), True,
+                                 ['product01'])
+
+        error, result = model().check_credentials('hashed', 'invalid',
+                                                  'product01')
+        self.assertEqual(error[0], 'InvalidPaywallCredentials')
+
+        error, result = model().check_credentials('hashed', 'secret',
+                                                  'product01')
+        self.assertEqual(error, None)
+        self.assertEqual(result[1], ['product01'])
+
+    def test_authenticate_user_unknown_password(self):
+        '''
+        Test to make sure that the password given for an unknown user is
+        still hashed, so that unknown usernames cannot be told apart from
+        wrong passwords by timing.
+        '''
+        instance = model()
+        with patch.object(model.verifier, 'verify',
+                          wraps=model.verifier.verify) as verify:
+            error, result = instance.check_credentials('unknown', 'secret',
+                                                       'product01')
+            self.assertEqual(error[0], 'InvalidPaywallCredentials')
+            verify.assert_called_once_with(model.dummy_password, 'secret')
+
+    def test_authenticate_user_cached_password(self):
+        '''
+        Test to make sure that repeat logins are not verified again until the
+        user's password changes.
+        '''
+        model().storage.add_user('cached', hash_password('secret', 10), True,
+                                 ['product01'])
+        with patch.object(model.verifier, 'verify',
+                          wraps=model.verifier.verify) as verify:
+            for password in ('secret', 'secret', 'invalid', 'secret'):
+                model().check_credentials('cached', password, 'product01')
+            self.assertEqual(verify.call_count, 2)
+
+            model().storage.add_user('cached', hash_password('other', 10),
+                                     True, ['product01'])
+            error, result = model().check_credentials('cached', 'secret',
+                                                      'product01')
+            self.assertEqual(error[0], 'InvalidPaywallCredentials')
+            self.assertEqual(verify.call_count, 3)
+
     def test_authenticate_user_valid(self):
         '''
         Test to make sure the authenticate_user function checks to make sure
@@ -1456,6 +1908,990 @@ class TestModel(TestCase):
         # Make sure the products match.
         self.assertEqual(result, products)
 
+    def test_validate_sessions(self):
+        '''
+        Test to make sure the validate_sessions function reports the result
+        of every pair in order, without raising errors.
+        '''
+        # Create seed data for the test. user01 is defined in constants.py.
+        session_id = model().create_session_id('user01', 'product01')
+        pairs = [(session_id, 'product01'), ('invalid', 'product01'),
+                 (session_id, 'product03')]
+
+        # Run validation.
+        results = model().validate_sessions(pairs)
+
+        # Make sure each pair has its own result.
+        self.assertEqual(results, [
+            (None, ['product01', 'product02']),
+            (('SessionExpired', 'Your session has expired. Please log back '
+              'in.', 401, None), None),
+            (('InvalidProduct', 'The requested article could not be found.',
+              404, None), None)])
+
+
+class TestTokens(TestCase):
+    '''
+    Test the session token mode of publisher/model.py, which uses the code in
+    publisher/tokens.py. The mode is enabled for each test by mocking out
+    SESSION_TOKENS.
+    '''
+    def tearDown(self):
+        '''
+        This function is called after every test to reset the state of the
+        singleton in model.py.
+        '''
+        model.storage = None
+
+    def assertSessionExpired(self, session_id, product):
+        '''
+        Asserts that validating the session id fails because the session has
+        expired.
+        '''
+        try:
+            model().validate_session('/test/', session_id, product)
+
+        # Catch the exception and analyze it.
+        except JsonUnauthorized, exception:
+            content = u'{"error": {"message": "Your session has expired. '\
+                'Please log back in.", "code": "SessionExpired", "resource": '\
+                '"/test/"}}'
+            self.assertEqual(unicode(exception), content)
+
+        # If no exception was raised, raise an error.
+        else:
+            raise AssertionError('No exception raised.')
+
+    @patch('publisher.model.SESSION_TOKENS', True)
+    def test_validate_token(self):
+        '''
+        Test to make sure that a session token can be validated without being
+        stored.
+        '''
+        # user01 is defined in constants.py.
+        url = '/test/'
+        username = 'user01'
+        product = 'product01'
+        session_id = model().create_session_id(username, product)
+
+        # Nothing should have been stored.
+        self.assertEqual(len(model.storage.sessions), 0)
+        self.assertEqual(len(model.storage.users[username]['session ids']), 0)
+
+        # Validate the token.
+        result = model().validate_session(url, session_id, product)
+        self.assertEqual(result, ['product01', 'product02'])
+
+        # The token is only valid for the product it was created for.
+        self.assertSessionExpired(session_id, 'product02')
+
+    @patch('publisher.model.SESSION_TOKENS', True)
+    def test_validate_token_tampered(self):
+        '''
+        Test to make sure that a token that was not signed with the secret is
+        rejected.
+        '''
+        # Create a token for user02 and a token for user01, then try to use
+        # the contents of one with the signature of the other.
+        first = model().create_session_id('user01', 'product01')
+        second = model().create_session_id('user02', 'product01')
+        tampered = second.split('.')[0] + '.' + first.split('.')[1]
+        self.assertSessionExpired(tampered, 'product01')
+        self.assertSessionExpired('invalid', 'product01')
+
+    @patch('publisher.model.SESSION_TOKENS', True)
+    def test_revoke_token(self):
+        '''
+        Test to make sure that a revoked token is rejected, and that it is
+        forgotten once it expires.
+        '''
+        product = 'product01'
+        session_id = model().create_session_id('user01', product)
+
+        # Revoke the token. Revoking it twice should fail the second time.
+        self.assertTrue(model().revoke_session(session_id))
+        self.assertFalse(model().revoke_session(session_id))
+        self.assertSessionExpired(session_id, product)
+
+        # Once the token has expired, it no longer needs to be remembered.
+        later = time() + SESSION_TIMEOUT * 60 * 60 + 1
+        self.assertEqual(len(model.storage.revoked), 1)
+        with patch('publisher.model.time') as model_time:
+            model_time.return_value = later
+            model().expire_sessions()
+        self.assertEqual(len(model.storage.revoked), 0)
+
+
+class TestStorage(TestCase):
+    '''
+    Test the code in publisher/storage.py. The same checks are run against
+    each storage.
+    '''
+    def setUp(self):
+        '''
+        Creates a temporary directory for the SQLite databases.
+        '''
+        self.directory = mkdtemp()
+
+    def tearDown(self):
+        '''
+        Removes the temporary directory and resets the model singleton.
+        '''
+        rmtree(self.directory)
+        model.storage = None
+
+    def check_storage(self, storage):
+        '''
+        Checks that a storage implements the interface defined by Storage.
+        '''
+        # Users can be added and looked up.
+        storage.add_user('user01', 'test', True, ['product01', 'product02'])
+        user = storage.get_user('user01')
+        self.assertEqual(user['password'], 'test')
+        self.assertEqual(user['valid'], True)
+        self.assertEqual(storage.registry.products(user['entitlements']),
+                         ['product01', 'product02'])
+        self.assertEqual(storage.get_products('user01'),
+                         ['product01', 'product02'])
+        self.assertEqual(storage.get_user('invalid'), None)
+        self.assertEqual(storage.get_products('invalid'), None)
+
+        # Sessions can be created, looked up and removed.
+        storage.create_session(u'first', 'user01', 'product01', 100)
+        storage.create_session(u'second', 'user01', 'product02', 200)
+        session = storage.get_session('first')
+        self.assertEqual(session.username, 'user01')
+        self.assertEqual(session.product, 'product01')
+        self.assertEqual(session.deadline, 100)
+        self.assertTrue(storage.remove_session('first'))
+        self.assertFalse(storage.remove_session('first'))
+        self.assertEqual(storage.get_session('first'), None)
+
+        # Sessions expire once their deadline has passed.
+        storage.create_session(u'third', 'user01', 'product01', 300)
+        storage.expire_user_sessions('user01', 200)
+        self.assertEqual(storage.get_session('second'), None)
+        self.assertNotEqual(storage.get_session('third'), None)
+        self.assertEqual(storage.expire_sessions(299), 0)
+        self.assertEqual(storage.expire_sessions(300), 1)
+        self.assertEqual(storage.get_session('third'), None)
+
+        # Tokens can be revoked until their deadline.
+        self.assertTrue(storage.revoke_token('signature', 400))
+        self.assertFalse(storage.revoke_token('signature', 400))
+        self.assertTrue(storage.is_revoked('signature'))
+        storage.expire_sessions(400)
+        self.assertFalse(storage.is_revoked('signature'))
+
+        # Users hold a limited number of sessions, and the least recently
+        # used one is evicted to make room for a new one.
+        storage.max_user_sessions = 2
+        storage.create_session(u'fourth', 'user01', 'product01', 500)
+        sleep(0.01)
+        storage.create_session(u'fifth', 'user01', 'product01', 500)
+        sleep(0.01)
+        storage.touch_session('fourth')
+        sleep(0.01)
+        storage.create_session(u'sixth', 'user01', 'product01', 500)
+        self.assertNotEqual(storage.get_session('fourth'), None)
+        self.assertEqual(storage.get_session('fifth'), None)
+        self.assertNotEqual(storage.get_session('sixth'), None)
+        self.assertEqual(storage.evictions, 1)
+
+        # Users are only removed once they hold no sessions.
+        self.assertFalse(storage.remove_user('user01'))
+        self.assertNotEqual(storage.get_user('user01'), None)
+        storage.expire_sessions(500)
+        self.assertTrue(storage.remove_user('user01'))
+        self.assertEqual(storage.get_user('user01'), None)
+        self.assertFalse(storage.remove_user('user01'))
+
+    def test_memory_storage(self):
+        '''
+        Test the in-memory storage.
+        '''
+        self.check_storage(MemoryStorage())
+
+    def test_expiry_compaction(self):
+        '''
+        Test to make sure that the entries of evicted sessions do not pile up
+        in the expiry heap while a user logs in over and over.
+        '''
+        storage = MemoryStorage(2)
+        storage.add_user('user01', 'test', True, ['product01'])
+        storage.revoke_token('signature', 1000)
+        for index in range(5000):
+            storage.create_session(str(index), 'user01', 'product01', 1000)
+        self.assertEqual(len(storage.sessions), 2)
+        self.assertTrue(len(storage.expiry) <=
+                        2 * 3 + MemoryStorage.MIN_STALE_EXPIRY + 1)
+        self.assertTrue(storage.is_revoked('signature'))
+
+        # The live sessions and the revoked token still expire.
+        self.assertEqual(storage.expire_sessions(1000), 2)
+        self.assertFalse(storage.is_revoked('signature'))
+
+    def test_sqlite_storage(self):
+        '''
+        Test the SQLite storage.
+        '''
+        storage = SQLiteStorage(join(self.directory, 'test.db'))
+        self.check_storage(storage)
+        storage.close()
+
+    def test_sqlite_storage_model(self):
+        '''
+        Test to make sure that sessions created through the model with the
+        SQLite storage can be validated after the database is reopened and
+        from another thread.
+        '''
+        path = join(self.directory, 'test.db')
+        with patch('publisher.model.STORAGE', 'sqlite'):
+            with patch('publisher.storage.STORAGE_PATH', path):
+                session_id, products = model().authenticate_user('/test/',
+                    'user01', 'test', 'product01')
+        model.storage.close()
+
+        # Reopen the database and validate the session from another thread.
+        model.storage = SQLiteStorage(path)
+        results = []
+        def validate_in_thread():
+            results.append(model().validate_session('/test/', session_id,
+                                                    'product01'))
+        thread = Thread(target=validate_in_thread)
+        thread.start()
+        thread.join()
+        self.assertEqual(results, [['product01', 'product02']])
+        model.storage.close()
+
+    def test_sqlite_touches(self):
+        '''
+        Test to make sure that the SQLite storage collects the times sessions
+        were used and writes them in batches.
+        '''
+        path = join(self.directory, 'test.db')
+        storage = SQLiteStorage(path)
+        storage.add_user('user01', 'test', True, ['product01'])
+        storage.create_session(u'first', 'user01', 'product01', 500)
+        storage.create_session(u'second', 'user01', 'product01', 500)
+
+        # Repeated uses of a session replace each other until the batch is
+        # written.
+        storage.touch_session('first')
+        storage.touch_session('first')
+        self.assertEqual(storage.touches.keys(), ['first'])
+        storage.write_touches()
+        self.assertEqual(storage.touches, {})
+
+        # A full batch is written at once.
+        with patch.object(SQLiteStorage, 'TOUCH_BATCH', 2):
+            storage.touch_session('first')
+            storage.touch_session('second')
+        self.assertEqual(storage.touches, {})
+
+        # Pending uses are written when the storage is closed.
+        storage.touch_session('second')
+        used = storage.touches['second']
+        storage.close()
+        storage = SQLiteStorage(path)
+        cursor = storage.connection().execute(
+            'SELECT used FROM sessions WHERE session_id = ?', ('second',))
+        self.assertEqual(cursor.fetchone()[0], used)
+        storage.close()
+
+    def test_journaled_storage(self):
+        '''
+        Test the journaled storage.
+        '''
+        storage = JournaledStorage(join(self.directory, 'journal'), 0)
+        storage.open()
+        self.check_storage(storage)
+        storage.close()
+
+    def test_journal(self):
+        '''
+        Test to make sure that records are on the disk once sync returns and
+        that rotating the journal continues it in a new file.
+        '''
+        first = join(self.directory, 'first')
+        second = join(self.directory, 'second')
+        journal = Journal(first)
+        journal.append(['c', 'session'])
+        journal.sync()
+        self.assertEqual(open(first).read(), '["c", "session"]\n')
+
+        journal.rotate(second)
+        journal.append(['r', 'session'])
+        journal.close()
+        self.assertEqual(open(first).read(), '["c", "session"]\n')
+        self.assertEqual(open(second).read(), '["r", "session"]\n')
+
+    def test_journaled_storage_recovery(self):
+        '''
+        Test to make sure that sessions are recovered from the snapshot and
+        the journal written after it, and that incomplete records, expired
+        sessions and removed sessions are ignored.
+        '''
+        path = join(self.directory, 'journal')
+        deadline = int(time()) + 100
+        storage = JournaledStorage(path, 0)
+        storage.add_user('user01', 'test', True, ['product01'])
+        storage.open()
+        storage.create_session('first', 'user01', 'product01', deadline)
+        storage.create_session('second', 'user01', 'product01', deadline)
+        storage.snapshot()
+        storage.create_session('third', 'user01', 'product01', deadline)
+        storage.create_session('old', 'user01', 'product01', 100)
+        storage.remove_session('second')
+        storage.revoke_token('signature', deadline)
+        storage.close()
+
+        # Simulate a crash while a record was being written.
+        with open(join(path, 'journal.1'), 'ab') as journal:
+            journal.write('["c", "fourth", "us')
+
+        storage = JournaledStorage(path, 0)
+        storage.add_user('user01', 'test', True, ['product01'])
+        storage.open()
+        self.assertEqual(sorted(storage.sessions.keys()), ['first', 'third'])
+        self.assertEqual(sorted(storage.users['user01']['session ids']),
+                         ['first', 'third'])
+        self.assertTrue(storage.is_revoked('signature'))
+
+        # The journal continues in a new file, and the files replaced by the
+        # next snapshot are deleted.
+        storage.create_session('fifth', 'user01', 'product01', deadline)
+        storage.snapshot()
+        storage.close()
+        self.assertEqual(sorted(listdir(path)), ['journal.3', 'snapshot'])
+
+        storage = JournaledStorage(path, 0)
+        storage.add_user('user01', 'test', True, ['product01'])
+        storage.open()
+        self.assertEqual(sorted(storage.sessions.keys()),
+                         ['fifth', 'first', 'third'])
+        storage.close()
+
+    def test_journaled_storage_unknown_users(self):
+        '''
+        Test to make sure that the sessions of users who are only added once
+        the storage has been opened are recovered, and that the placeholders
+        holding them are removed once their sessions are.
+        '''
+        path = join(self.directory, 'journal')
+        deadline = int(time()) + 100
+        storage = JournaledStorage(path, 0)
+        storage.open()
+        for username in ('user01', 'user02'):
+            storage.add_user(username, 'test', True, ['product01'])
+        storage.create_session('first', 'user01', 'product01', deadline)
+        storage.snapshot()
+        storage.create_session('second', 'user02', 'product01', deadline)
+        storage.close()
+
+        storage = JournaledStorage(path, 0)
+        storage.open()
+        self.assertEqual(sorted(storage.sessions.keys()), ['first', 'second'])
+        self.assertEqual(storage.get_user('user01'), None)
+        self.assertEqual(storage.get_products('user02'), None)
+        self.assertEqual(storage.placeholders, set(['user01', 'user02']))
+
+        # Adding the user keeps their sessions.
+        storage.add_user('user01', 'test', True, ['product01'])
+        self.assertEqual(storage.users['user01']['session ids'].keys(),
+                         ['first'])
+        self.assertEqual(storage.get_user('user01')['valid'], True)
+
+        # Placeholders are removed once they hold no sessions.
+        storage.remove_session('second')
+        storage.expire_sessions(0)
+        self.assertEqual(storage.placeholders, set())
+        self.assertFalse('user02' in storage.users)
+        self.assertNotEqual(storage.get_session('first'), None)
+        storage.close()
+
+
+class TestLocks(TestCase):
+    '''
+    Test the code in publisher/locks.py.
+    '''
+    def test_read_write_lock_readers(self):
+        '''
+        Test to make sure that many readers can hold the lock at once.
+        '''
+        lock = ReadWriteLock()
+        lock.acquire_read()
+        lock.acquire_read()
+        self.assertEqual(lock.readers, 2)
+        lock.release_read()
+        lock.release_read()
+        self.assertEqual(lock.readers, 0)
+
+    def test_read_write_lock_writer(self):
+        '''
+        Test to make sure that a writer waits for the readers to finish.
+        '''
+        lock = ReadWriteLock()
+        lock.acquire_read()
+
+        # Try to acquire the lock for writing from another thread.
+        writer = Thread(target=lock.acquire_write)
+        writer.start()
+        writer.join(0.05)
+
+        # The writer must be blocked until the reader is done.
+        self.assertTrue(writer.isAlive())
+        self.assertFalse(lock.writer)
+        lock.release_read()
+        writer.join()
+        self.assertTrue(lock.writer)
+        lock.release_write()
+
+    def test_lock_stripes(self):
+        '''
+        Test to make sure that a key is always protected by the same lock.
+        '''
+        stripes = LockStripes(8)
+        self.assertEqual(len(stripes.locks), 8)
+        self.assertTrue(stripes('user01') is stripes('user01'))
+
+
+class TestProducts(TestCase):
+    '''
+    Test the code in publisher/products.py.
+    '''
+    def test_register(self):
+        '''
+        Test to make sure that each product code is given its own id once.
+        '''
+        registry = ProductRegistry()
+        self.assertEqual(registry.register('product01'), 0)
+        self.assertEqual(registry.register('product02'), 1)
+        self.assertEqual(registry.register(u'product01'), 0)
+        self.assertEqual(registry.codes, ['product01', 'product02'])
+
+    def test_entitlements(self):
+        '''
+        Test to make sure that entitlements contain exactly their products
+        and that users with the same products share them.
+        '''
+        registry = ProductRegistry()
+        empty = registry.entitlements([])
+        entitlements = registry.entitlements(['product01', 'product03'])
+        self.assertEqual(registry.bitmaps[entitlements], 3)
+        self.assertEqual(registry.entitlements(('product01', u'product03')),
+                         entitlements)
+        self.assertTrue(registry.entitled(entitlements, 'product01'))
+        self.assertTrue(registry.entitled(entitlements, u'product03'))
+        self.assertFalse(registry.entitled(entitlements, 'product02'))
+        registry.register('product02')
+        self.assertFalse(registry.entitled(entitlements, 'product02'))
+        self.assertFalse(registry.entitled(empty, 'product01'))
+
+    def test_products(self):
+        '''
+        Test to make sure that products are listed in the order they were
+        stored in and that the list is cached.
+        '''
+        registry = ProductRegistry()
+        registry.register('product01')
+        entitlements = registry.entitlements(['product02', 'product01'])
+        self.assertEqual(registry.products(entitlements),
+                         ['product02', 'product01'])
+        self.assertTrue(registry.products(entitlements) is
+                        registry.products(entitlements))
+        self.assertEqual(registry.products(entitlements).encoded,
+                         '["product02", "product01"]')
+        self.assertEqual(registry.products(registry.entitlements([])), [])
+        self.assertNotEqual(registry.entitlements(['product01', 'product02']),
+                            entitlements)
+
+
+class TestCodec(TestCase):
+    '''
+    Test the code in publisher/codec.py.
+    '''
+    def test_codecs(self):
+        '''
+        Test to make sure that every codec installed decodes the same values
+        and encodes strings the same way as the json module.
+        '''
+        for name in ('ujson', 'simplejson', 'json'):
+            try:
+                codec = load_codec(name)
+            except ImportError:
+                continue
+
+            self.assertEqual(codec.loads('{"a": ["b", 1]}'), {'a': ['b', 1]})
+            self.assertRaises(ValueError, codec.loads, '{')
+            for value in ('/test/', u't\xe9st', '"\\\n'):
+                self.assertEqual(codec.encode_string(value), dumps(value))
+
+    def test_session_body(self):
+        '''
+        Test to make sure that the response template matches the response the
+        json module encodes.
+        '''
+        products = ProductList(['product01', u'product\xe9'])
+        result = session_body(u'"test"', products)
+        self.assertEqual(loads(result), {'sessionKey': u'"test"',
+                                         'products': products})
+        self.assertEqual(result, dumps({'sessionKey': u'"test"',
+                                        'products': products}))
+
+
+class TestPasswords(TestCase):
+    '''
+    Test the code in publisher/passwords.py.
+    '''
+    def test_hash_password(self):
+        '''
+        Test to make sure that hashed passwords are salted and can be
+        verified, and that passwords stored as they were given still are.
+        '''
+        stored = hash_password(u'p\xe4ss', 10)
+        self.assertTrue(stored.startswith('pbkdf2_sha256$10$'))
+        self.assertNotEqual(stored, hash_password(u'p\xe4ss', 10))
+
+        self.assertTrue(verify_password(stored, u'p\xe4ss'))
+        self.assertFalse(verify_password(stored, 'pass'))
+        self.assertFalse(verify_password('pbkdf2_sha256$10$', 'pass'))
+        self.assertTrue(verify_password('pass', 'pass'))
+        self.assertFalse(verify_password('pass', 'invalid'))
+
+    def test_verifier_pool(self):
+        '''
+        Test to make sure that the pool verifies passwords from several
+        threads at once, and that it verifies them inline without threads.
+        '''
+        stored = hash_password('pass', 10)
+        for workers in (0, 2):
+            pool = VerifierPool(workers, 1)
+            results = []
+
+            def verify(password):
+                results.append((password, pool.verify(stored, password)))
+            threads = [Thread(target=verify, args=(password,))
+                       for password in ('pass', 'invalid') * 4]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            pool.stop()
+
+            self.assertEqual(sorted(results),
+                             [('invalid', False)] * 4 + [('pass', True)] * 4)
+
+
+    @patch('publisher.passwords.time')
+    def test_credential_cache(self, passwords_time):
+        '''
+        Test to make sure that the credential cache expires, invalidates and
+        evicts its entries, and counts its hits, misses and evictions.
+        '''
+        passwords_time.return_value = 1000
+        cache = CredentialCache(60, 2)
+        user = {'password': hash_password('pass', 10), 'valid': True}
+
+        cache.add('user01', user, 'pass')
+        self.assertTrue(cache.check('user01', user, 'pass'))
+        self.assertFalse(cache.check('user01', user, 'invalid'))
+        self.assertFalse(cache.check('user02', user, 'pass'))
+
+        # A change to the user's validity invalidates the entry.
+        invalid = {'password': user['password'], 'valid': False}
+        self.assertFalse(cache.check('user01', invalid, 'pass'))
+        self.assertFalse(cache.check('user01', user, 'pass'))
+
+        # Entries expire after the TTL.
+        cache.add('user01', user, 'pass')
+        passwords_time.return_value = 1060
+        self.assertFalse(cache.check('user01', user, 'pass'))
+
+        # The least recently used entry is evicted.
+        for username in ('user01', 'user02', 'user03'):
+            cache.add(username, user, 'pass')
+        self.assertFalse(cache.check('user01', user, 'pass'))
+        self.assertTrue(cache.check('user03', user, 'pass'))
+
+        self.assertEqual((cache.hits, cache.misses, cache.evictions),
+                         (2, 6, 1))
+        self.assertEqual(cache.hit_rate(), 0.25)
+
+
+class TestThrottle(TestCase):
+    '''
+    Test the code in publisher/throttle.py.
+    '''
+    @patch('publisher.throttle.time')
+    def test_token_buckets(self, throttle_time):
+        '''
+        Test to make sure that each key's bucket allows a burst of attempts
+        and is refilled at its rate, and that the number of buckets is
+        bounded.
+        '''
+        throttle_time.return_value = 1000.0
+        buckets = TokenBuckets(0.5, 2, 2)
+        self.assertEqual([buckets.allow('a') for index in range(3)],
+                         [True, True, False])
+        self.assertTrue(buckets.allow('b'))
+
+        throttle_time.return_value = 1002.0
+        self.assertEqual([buckets.allow('a') for index in range(2)],
+                         [True, False])
+
+        # Adding a third key drops the least recently used one, b, whose
+        # bucket starts full again.
+        self.assertTrue(buckets.allow('c'))
+        self.assertEqual(buckets.evictions, 1)
+        self.assertEqual(buckets.rejections, 2)
+        self.assertEqual(sorted(buckets.buckets), ['a', 'c'])
+
+        # Without a rate, nothing is refused.
+        buckets = TokenBuckets(None, 0)
+        self.assertTrue(buckets.allow('a'))
+        self.assertEqual(len(buckets.buckets), 0)
+
+    @patch('publisher.throttle.time')
+    def test_charge(self, throttle_time):
+        '''
+        Test to make sure that checking a bucket does not take a token, and
+        that the bucket is empty once enough tokens have been charged.
+        '''
+        throttle_time.return_value = 1000.0
+        buckets = TokenBuckets(0.5, 2)
+        self.assertFalse(buckets.limited('a'))
+        self.assertFalse(buckets.limited('a'))
+        self.assertEqual(len(buckets.buckets), 0)
+
+        buckets.charge('a')
+        self.assertFalse(buckets.limited('a'))
+        buckets.charge('a')
+        buckets.charge('a')
+        self.assertTrue(buckets.limited('a'))
+        self.assertEqual(buckets.rejections, 1)
+
+        throttle_time.return_value = 1002.0
+        self.assertFalse(buckets.limited('a'))
+
+
+class TestDirectory(TestCase):
+    '''
+    Test the code in publisher/directory.py against a fake directory.
+    '''
+    def setUp(self):
+        '''
+        Starts a fake directory with a couple of users.
+        '''
+        users = {}
+        users['reader01'] = {'password': 'test', 'valid': True,
+                           'products': ['product01', 'product02']}
+        users[u'\u674e\u521a'] = {'password': 'test', 'valid': False,
+                                 'products': []}
+        self.fake = FakeDirectory(users)
+        self.fake.start()
+
+    def tearDown(self):
+        '''
+        Stops the fake directory and the model's use of it.
+        '''
+        self.fake.stop()
+        model.directory = None
+        model.storage = None
+
+    def test_get_user(self):
+        '''
+        Test to make sure that users are looked up over a single persistent
+        connection.
+        '''
+        directory = UserDirectory(self.fake.url)
+        self.assertEqual(directory.get_user('reader01'),
+                         {'password': 'test', 'valid': True,
+                          'products': ['product01', 'product02']})
+        self.assertEqual(directory.get_user(u'\u674e\u521a')['valid'], False)
+        self.assertEqual(directory.get_user('reader02'), None)
+        self.assertEqual(directory.get_user('a/b'), None)
+        self.assertEqual((self.fake.connections, self.fake.requests), (1, 4))
+        directory.close()
+
+    def test_retries(self):
+        '''
+        Test to make sure that failed requests are retried, and that the
+        circuit opens once too many lookups fail and closes once the
+        directory answers again.
+        '''
+        directory = UserDirectory(self.fake.url, retries=2, backoff=0.001,
+                                  failures=1, reset=0.05, ttl=0)
+        self.fake.failures = 2
+        self.assertEqual(directory.get_user('reader01')['valid'], True)
+        self.assertEqual(self.fake.requests, 3)
+
+        self.fake.failures = 3
+        self.assertRaises(DirectoryError, directory.get_user, 'reader01')
+        self.assertRaises(DirectoryError, directory.get_user, 'reader01')
+        self.assertEqual(self.fake.requests, 6)
+        self.assertEqual(directory.breaker.rejections, 1)
+
+        sleep(0.05)
+        self.assertEqual(directory.get_user('reader01')['valid'], True)
+        self.assertEqual(directory.breaker.opened, None)
+        directory.close()
+
+    @patch('publisher.directory.time')
+    def test_cache(self, directory_time):
+        '''
+        Test to make sure that users found are remembered until their TTL
+        runs out, that unknown users are not remembered, and that the number
+        of users remembered is bounded.
+        '''
+        directory_time.return_value = 1000.0
+        directory = UserDirectory(self.fake.url, ttl=10, size=1)
+        self.assertEqual(directory.get_user('reader01')['valid'], True)
+        self.assertEqual(directory.get_user('reader01')['valid'], True)
+        self.assertEqual(directory.get_user('reader02'), None)
+        self.assertEqual(directory.get_user('reader02'), None)
+        self.assertEqual(self.fake.requests, 3)
+        self.assertEqual((directory.hits, directory.misses), (1, 3))
+
+        # Users are still found while the directory is failing.
+        self.fake.failures = 10
+        self.assertEqual(directory.get_user('reader01')['valid'], True)
+
+        # Once the TTL has run out, the directory is asked again.
+        self.fake.failures = 0
+        directory_time.return_value = 1010.0
+        self.assertEqual(directory.get_user('reader01')['valid'], True)
+        self.assertEqual(self.fake.requests, 4)
+
+        # Only the most recently used user is remembered.
+        directory.get_user(u'\u674e\u521a')
+        self.assertEqual(directory.users.keys(), [u'\u674e\u521a'])
+        self.assertEqual(directory.evictions, 1)
+        directory.close()
+
+    def test_timeout(self):
+        '''
+        Test to make sure that a slow directory is reported as unavailable.
+        '''
+        directory = UserDirectory(self.fake.url, timeout=0.05, retries=0)
+        self.fake.latency = 0.2
+        self.assertRaises(DirectoryError, directory.get_user, 'reader01')
+        directory.close()
+
+    def test_model(self):
+        '''
+        Test to make sure that the model authenticates users against the
+        directory, copies them to the storage only when they change, and
+        validates their sessions through the cache of the directory client.
+        '''
+        model.directory = UserDirectory(self.fake.url, retries=0)
+        instance = model()
+        with patch.object(model.storage, 'add_user',
+                          wraps=model.storage.add_user) as add_user:
+            for attempt in range(2):
+                error, result = instance.check_credentials('reader01',
+                                                           'test',
+                                                           'product02')
+                self.assertEqual(error, None)
+            self.assertEqual(add_user.call_count, 1)
+
+            # A change in the directory is copied once the cached user has
+            # been forgotten.
+            self.fake.users['reader01']['products'] = ['product02']
+            model.directory.users.clear()
+            error, result = instance.check_credentials('reader01', 'test',
+                                                       'product02')
+            self.assertEqual(add_user.call_count, 2)
+        session_id, products = result
+        self.assertEqual(products, ['product02'])
+
+        requests = self.fake.requests
+        self.assertEqual(instance.check_validation(session_id, 'product02'),
+                         (None, ['product02']))
+        self.assertEqual(self.fake.requests, requests)
+
+        error, result = model().check_credentials(u'\u674e\u521a', 'test',
+                                                  'product01')
+        self.assertEqual(error[0], 'AccountProblem')
+        error, result = model().check_credentials('reader02', 'test',
+                                                  'product01')
+        self.assertEqual(error[0], 'InvalidPaywallCredentials')
+
+        # Users that have not been found recently cannot log in while the
+        # directory is failing.
+        self.fake.failures = 1
+        error, result = model().check_credentials('reader03', 'test',
+                                                  'product02')
+        self.assertEqual(error[0], 'DirectoryUnavailable')
+        self.assertEqual(error[2], 500)
+
+    def test_model_validation(self):
+        '''
+        Test to make sure that disabled accounts and removed products are
+        seen by validation once the cached user has been forgotten, and that
+        the copy in the storage is used while the directory is failing.
+        '''
+        model.directory = UserDirectory(self.fake.url, retries=0)
+        instance = model()
+        error, result = instance.check_credentials('reader01', 'test',
+                                                   'product02')
+        session_id, products = result
+
+        # The copy is used while the directory cannot be reached.
+        self.fake.failures = 1
+        model.directory.users.clear()
+        self.assertEqual(instance.check_validation(session_id, 'product02'),
+                         (None, ['product01', 'product02']))
+
+        self.fake.users['reader01']['products'] = ['product01']
+        model.directory.users.clear()
+        error, result = instance.check_validation(session_id, 'product02')
+        self.assertEqual(error[0], 'InvalidProduct')
+
+        self.fake.users['reader01']['valid'] = False
+        model.directory.users.clear()
+        error, result = instance.check_validation(session_id, 'product02')
+        self.assertEqual(error[0], 'AccountProblem')
+
+        del self.fake.users['reader01']
+        model.directory.users.clear()
+        error, result = instance.check_validation(session_id, 'product02')
+        self.assertEqual(error[0], 'SessionExpired')
+
+    @patch('publisher.model.time')
+    def test_model_expire_users(self, model_time):
+        '''
+        Test to make sure that the users copied from the directory are
+        removed from the storage once the sessions of their last login have
+        expired.
+        '''
+        model_time.return_value = 1000.0
+        model.directory = UserDirectory(self.fake.url, retries=0)
+        instance = model()
+        instance.check_credentials('reader01', 'test', 'product02')
+        deadline = 1000 + SESSION_TIMEOUT * 60 * 60
+        self.assertEqual(model.copied, {'reader01': deadline})
+
+        model_time.return_value = deadline - 1.0
+        instance.expire_sessions()
+        self.assertNotEqual(model.storage.get_user('reader01'), None)
+
+        model_time.return_value = float(deadline)
+        self.assertEqual(instance.expire_sessions(), 1)
+        self.assertEqual(model.storage.get_user('reader01'), None)
+        self.assertEqual(model.copied, {})
+
+        # The user is copied again when they log in again.
+        error, result = instance.check_credentials('reader01', 'test',
+                                                   'product02')
+        self.assertEqual(error, None)
+        self.assertNotEqual(model.storage.get_user('reader01'), None)
+
+
+class TestLoader(TestCase):
+    '''
+    Test the code in publisher/loader.py.
+    '''
+    def setUp(self):
+        '''
+        Creates a temporary directory for the catalogs.
+        '''
+        self.directory = mkdtemp()
+
+    def tearDown(self):
+        '''
+        Removes the temporary directory and resets the model singleton.
+        '''
+        rmtree(self.directory)
+        model.storage = None
+
+    def write_catalog(self, name, contents):
+        '''
+        Writes a catalog to the temporary directory and returns its path.
+        '''
+        path = join(self.directory, name)
+        with open(path, 'wb') as catalog:
+            catalog.write(contents)
+        return path
+
+    def test_load_json_users(self):
+        '''
+        Test to make sure that users are loaded from a json lines catalog and
+        that progress is reported.
+        '''
+        path = self.write_catalog('users.json',
+            '{"username": "user03", "password": "test", "valid": true, '
+            '"products": ["product01"]}\n'
+            '\n'
+            '{"username": "user04", "password": "test", "valid": false, '
+            '"products": []}\n')
+        storage = MemoryStorage()
+        progress = []
+        self.assertEqual(load_users(storage, path, progress.append, 1), 2)
+        self.assertEqual(progress, [1, 2])
+
+        user = storage.get_user('user03')
+        self.assertEqual(storage.get_products('user03'), ['product01'])
+        self.assertTrue(user['valid'])
+        self.assertFalse(storage.get_user(u'user04')['valid'])
+
+        # Ascii strings are stored as byte strings.
+        self.assertTrue(isinstance(user['password'], str))
+        self.assertTrue(isinstance(storage.users.keys()[0], str))
+
+    def test_load_csv_users(self):
+        '''
+        Test to make sure that users are loaded from a csv catalog.
+        '''
+        path = self.write_catalog('users.csv',
+            'username,password,valid,products\n'
+            'user03,test,true,product01 product02\n'
+            'user04,test,False,\n')
+        storage = MemoryStorage()
+        self.assertEqual(load_users(storage, path), 2)
+        self.assertEqual(storage.get_products('user03'),
+                         ['product01', 'product02'])
+        self.assertFalse(storage.get_user('user04')['valid'])
+        self.assertEqual(storage.get_products('user04'), [])
+
+    def test_load_invalid_users(self):
+        '''
+        Test to make sure that invalid users are reported with their line.
+        '''
+        path = self.write_catalog('users.json',
+            '{"username": "user03", "password": "test", "valid": true, '
+            '"products": []}\n'
+            '{"username": "user04"}\n')
+        try:
+            load_users(MemoryStorage(), path)
+            self.fail()
+        except ValueError, exception:
+            self.assertEqual(str(exception), path + ', line 2: Invalid user.')
+
+        path = self.write_catalog('users.csv',
+            'username,password,valid,products\n'
+            'user03,test,yes,product01\n')
+        try:
+            load_users(MemoryStorage(), path)
+            self.fail()
+        except ValueError, exception:
+            self.assertEqual(str(exception), path + ', line 2: Invalid user.')
+
+    def test_model_users_file(self):
+        '''
+        Test to make sure that the model loads the USERS_FILE catalog along
+        with the users in the constants file.
+        '''
+        path = self.write_catalog('users.csv',
+            'username,password,valid,products\n'
+            'user03,secret,true,product02\n')
+        with patch('publisher.model.USERS_FILE', path):
+            with patch('publisher.model.print_progress'):
+                session_id, products = model().authenticate_user('/test/',
+                    'user03', 'secret', 'product02')
+        self.assertEqual(products, ['product02'])
+        self.assertNotEqual(model.storage.get_user('user01'), None)
+
 
 class TestValidate(TestCase):
     '''
@@ -1584,19 +3020,12 @@ class TestValidate(TestCase):
         # Create the post body.
         request.body = 'test'
 
-        # Call the validate function and expect an exception.
-        try:
-            validate(request, api, version, format, product_code)
-
-        # Catch the exception and analyze it.
-        except JsonBadSyntax, exception:
-            content = u'{"error": {"message": "Invalid post body.", '\
-                '"code": "InvalidFormat", "resource": "/test/"}}'
-            self.assertEqual(unicode(exception), content)
-
-        # If no exception was raised, raise an error.
-        else:
-            raise AssertionError('No exception raised.')
+        # Call the validate function and expect an error response.
+        result = validate(request, api, version, format, product_code)
+        content = u'{"error": {"message": "Invalid post body.", '\
+            '"code": "InvalidFormat", "resource": "/test/"}}'
+        self.assertEquals(result.output, content)
+        self.assertEquals(result.status, 400)
 
     def test_validate(self):
         '''
@@ -1636,6 +3065,345 @@ class TestValidate(TestCase):
         self.assertEquals(result.content_type, 'application/json')
         self.assertEquals(result.status, 200)
 
+    def test_batch_validate(self):
+        '''
+        Tests a batch of sessions, one of which is valid.
+        '''
+        # Create seed data for the test. user01 is defined in constants.py.
+        session_id = model().create_session_id('user01', 'product01')
+
+        # Create a test request with the session scheme and two sessions.
+        request = create_request('/test/')
+        request._environ = {}
+        request._environ['HTTP_AUTHORIZATION'] = \
+            'PolarPaywallProxySessionv1.0.0'
+        body = {}
+        body['sessions'] = [{'sessionKey': session_id, 'product': 'product01'},
+                            {'sessionKey': 'invalid', 'product': 'product01'}]
+        request.body = dumps(body)
+
+        # Run the batch_validate function.
+        result = batch_validate(request, 'paywallproxy', 'v1.0.0', 'json')
+
+        # Check the result.
+        self.assertEquals(result.status, 200)
+        self.assertEquals(loads(result.output), {'results': [
+            {'sessionKey': session_id,
+             'products': ['product01', 'product02']},
+            {'sessionKey': 'invalid', 'status': 401,
+             'error': {'code': 'SessionExpired', 'resource': '/test/',
+                       'message': 'Your session has expired. Please log '
+                                  'back in.'}}]})
+
+    def test_batch_validate_body(self):
+        '''
+        Tests to see if batches that are empty or too large are rejected.
+        '''
+        request = create_request('/test/')
+        request._environ = {}
+        request._environ['HTTP_AUTHORIZATION'] = \
+            'PolarPaywallProxySessionv1.0.0'
+
+        session = {'sessionKey': 'test', 'product': 'product01'}
+        for sessions in ([], [session] * 101, ['test'], [{'product': 'p'}]):
+            request.body = dumps({'sessions': sessions})
+            result = batch_validate(request, 'paywallproxy', 'v1.0.0', 'json')
+            self.assertEquals(result.status, 400)
+            self.assertTrue('InvalidFormat' in result.output)
+
+
+class TestPrefork(TestCase):
+    '''
+    Test the code in publisher/prefork.py.
+    '''
+    def test_pooled_server(self):
+        '''
+        Test to make sure that the pooled server serves requests from its
+        threads and stops when asked to.
+        '''
+        def application(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [environ['PATH_INFO']]
+
+        listener = listen('127.0.0.1', 0)
+        server = PooledWSGIServer(listener, application, 2)
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            port = listener.getsockname()[1]
+            for index in range(4):
+                response = urlopen('http://127.0.0.1:%d/test' % port)
+                self.assertEqual(response.read(), '/test')
+
+        finally:
+            server.shutdown()
+            thread.join()
+            server.server_close()
+
+    def test_serve_storage(self):
+        '''
+        Test to make sure that several workers cannot be run with a storage
+        that they do not share.
+        '''
+        with patch('publisher.prefork.STORAGE', 'memory'):
+            self.assertRaises(ValueError, serve, '127.0.0.1', 0, None, 2)
+
+
+class TestFrontend(TestCase):
+    '''
+    Test the code in publisher/frontend.py.
+    '''
+    def test_frontend(self):
+        '''
+        Test to make sure that the front end serves requests while other
+        connections are idle, and stops when asked to.
+        '''
+        frontend = Frontend('127.0.0.1', 0, 2)
+        port = frontend.socket.getsockname()[1]
+        thread = Thread(target=frontend.serve_forever)
+        thread.start()
+        idle = [create_connection(('127.0.0.1', port)) for index in range(10)]
+        try:
+            connection = create_connection(('127.0.0.1', port))
+            connection.sendall('POST /test HTTP/1.0\r\n'
+                               'Content-Length: 2\r\n\r\n{}')
+            response = connection.makefile().read()
+            connection.close()
+            self.assertTrue(response.startswith('HTTP/1.1 404 Not Found'))
+            self.assertTrue(response.endswith('"resource": "/test/"}}'))
+
+            # A body that is too large is rejected before it is sent.
+            connection = create_connection(('127.0.0.1', port))
+            connection.sendall('POST /test HTTP/1.1\r\n'
+                               'Content-Length: 100000\r\n\r\n')
+            response = connection.makefile().read()
+            connection.close()
+            self.assertTrue(response.startswith('HTTP/1.1 400 Bad Request'))
+            self.assertTrue('The post body is too large.' in response)
+
+        finally:
+            for connection in idle:
+                connection.close()
+            frontend.stop()
+            thread.join()
+
+    def test_remote_address(self):
+        '''
+        Test to make sure that attempts to log in through the front end are
+        limited for each client address.
+        '''
+        frontend = Frontend('127.0.0.1', 0, 2)
+        port = frontend.socket.getsockname()[1]
+        thread = Thread(target=frontend.serve_forever)
+        thread.start()
+        clients = TokenBuckets(1e-6, 1)
+        try:
+            with patch('publisher.throttle.clients', clients):
+                statuses = []
+                for attempt in range(2):
+                    connection = create_connection(('127.0.0.1', port))
+                    connection.sendall(
+                        'POST /paywallproxy/v1.0.0/json/auth/product01 '
+                        'HTTP/1.0\r\n'
+                        'Authorization: PolarPaywallProxyAuthv1.0.0\r\n'
+                        'Content-Length: 1\r\n\r\n{')
+                    response = connection.makefile().read()
+                    connection.close()
+                    statuses.append(response.split(' ', 2)[1])
+
+            self.assertEqual(statuses, ['400', '403'])
+            self.assertEqual(clients.buckets.keys(), ['127.0.0.1'])
+
+        finally:
+            frontend.stop()
+            thread.join()
+
+    @patch('publisher.frontend.print_exc')
+    def test_failed_request(self, frontend_print_exc):
+        '''
+        Test to make sure that a request whose url is not valid utf-8, or
+        whose processing fails unexpectedly, is answered and leaves the
+        worker thread serving the next request.
+        '''
+        frontend = Frontend('127.0.0.1', 0, 1)
+        port = frontend.socket.getsockname()[1]
+        thread = Thread(target=frontend.serve_forever)
+        thread.start()
+
+        def send(path):
+            connection = create_connection(('127.0.0.1', port))
+            connection.settimeout(5)
+            connection.sendall('POST %s HTTP/1.0\r\n\r\n' % path)
+            response = connection.makefile().read()
+            connection.close()
+            return response
+
+        try:
+            for attempt in range(2):
+                response = send('/paywallproxy/v1.0.0/json/auth/\xff')
+                self.assertTrue(response.startswith('HTTP/1.1 404'))
+
+            with patch('publisher.frontend.dispatch') as dispatch:
+                dispatch.side_effect = ValueError('test')
+                response = send('/test')
+            self.assertTrue(response.startswith('HTTP/1.1 500'))
+            self.assertTrue('"code": "InternalError"' in response)
+            self.assertEqual(frontend_print_exc.call_count, 1)
+
+            response = send('/test')
+            self.assertTrue(response.startswith('HTTP/1.1 404'))
+
+        finally:
+            frontend.stop()
+            thread.join()
+
+    def test_keep_alive(self):
+        '''
+        Test to make sure that pipelined requests are answered in order over
+        the same connection, and that idle connections are closed.
+        '''
+        frontend = Frontend('127.0.0.1', 0, 2, 0)
+        port = frontend.socket.getsockname()[1]
+        thread = Thread(target=frontend.serve_forever)
+        thread.start()
+        try:
+            connection = create_connection(('127.0.0.1', port))
+            connection.sendall('POST /first HTTP/1.1\r\n\r\n'
+                               'POST /second HTTP/1.1\r\n'
+                               'Connection: close\r\n\r\n')
+            response = connection.makefile().read()
+            connection.close()
+            first = response.index('"resource": "/first/"')
+            second = response.index('"resource": "/second/"')
+            self.assertTrue(first < second)
+            self.assertEqual(response.count('Connection: keep-alive'), 1)
+            self.assertEqual(response.count('Connection: close'), 1)
+
+            # Connections without a request in progress are closed once they
+            # have been idle for longer than the timeout.
+            connection = create_connection(('127.0.0.1', port))
+            connection.settimeout(5)
+            self.assertEqual(connection.recv(1), '')
+            connection.close()
+
+        finally:
+            frontend.stop()
+            thread.join()
+
+
+class TestDispatch(TestCase):
+    '''
+    Test the code in publisher/dispatch.py.
+    '''
+    def tearDown(self):
+        '''
+        Resets the model singleton.
+        '''
+        model.storage = None
+
+    def test_resolve(self):
+        '''
+        Test to make sure that only supported requests are resolved.
+        '''
+        url = '/paywallproxy/v1.0.0/json/auth/product01/'
+        self.assertEqual(resolve('POST', url), (auth_result,
+            'PolarPaywallProxyAuthv1.0.0', ('product01',)))
+        self.assertEqual(resolve('POST', '/paywallproxy/v1.0.0/json/'
+                                 'batchvalidate/'), (batch_result,
+            'PolarPaywallProxySessionv1.0.0', ()))
+        self.assertEqual(resolve('POST', '/paywallproxy/v1.0.0/json/auth/'),
+                         None)
+        self.assertEqual(resolve('GET', url), None)
+        self.assertEqual(resolve('POST', url + 'extra/'), None)
+        self.assertEqual(resolve('POST', '/paywallproxy/v2.0.0/json/auth/'
+                                 'product01/'), None)
+        self.assertEqual(resolve('POST', '/paywallproxy/v1.0.0/json/auth/'
+                                 'product-01/'), None)
+
+    @patch('publisher.model.uuid4')
+    def test_dispatch(self, model_uuid4):
+        '''
+        Test to make sure that requests are routed to the auth and validate
+        entry points and that their errors are reported.
+        '''
+        model_uuid4.return_value = 'test'
+        url = '/paywallproxy/v1.0.0/json/auth/product01'
+        environment = {}
+        environment['HTTP_AUTHORIZATION'] = 'PolarPaywallProxyAuthv1.0.0'
+        body = {}
+        body['device'] = {}
+        body['device']['manufacturer'] = 'test'
+        body['device']['model'] = 'test'
+        body['device']['os_version'] = 'test'
+        body['authParams'] = {}
+        body['authParams']['username'] = 'user01'
+        body['authParams']['password'] = 'test'
+        result = dispatch('POST', url, environment, dumps(body))
+        expected = '{"sessionKey": "test", "products": ["product01", '\
+                   '"product02"]}'
+        self.assertEqual(result, (200, [], expected))
+
+        # Expired sessions report the scheme of the validate entry point.
+        url = '/paywallproxy/v1.0.0/json/validate/product01'
+        environment = {}
+        environment['HTTP_AUTHORIZATION'] = \
+            'PolarPaywallProxySessionv1.0.0 session:invalid'
+        status, headers, content = dispatch('POST', url, environment, '')
+        self.assertEqual(status, 401)
+        self.assertEqual(headers, [('WWW-Authenticate',
+                                    'PolarPaywallProxySessionv1.0.0')])
+
+        # Unsupported versions are reported the same way as check_base_url
+        # reports them.
+        url = '/paywallproxy/v2.0.0/json/validate/product01'
+        status, headers, content = dispatch('POST', url, environment, '')
+        self.assertEqual(status, 404)
+        self.assertTrue('InvalidVersion' in content)
+
+        # Batches are routed without a product code.
+        url = '/paywallproxy/v1.0.0/json/batchvalidate'
+        environment['HTTP_AUTHORIZATION'] = 'PolarPaywallProxySessionv1.0.0'
+        body = dumps({'sessions': [{'sessionKey': 'invalid',
+                                    'product': 'product01'}]})
+        status, headers, content = dispatch('POST', url, environment, body)
+        self.assertEqual(status, 200)
+        self.assertTrue('SessionExpired' in content)
+        url = '/paywallproxy/v2.0.0/json/batchvalidate'
+        status, headers, content = dispatch('POST', url, environment, body)
+        self.assertEqual(status, 404)
+        self.assertTrue('InvalidVersion' in content)
+
+        # Unknown urls and methods are not found. Like itty, the resource
+        # ends with a slash.
+        status, headers, content = dispatch('GET', url, environment, '')
+        self.assertEqual(status, 404)
+        self.assertEqual(content, encode_error(url + '/', 'NoHandler',
+            'An error occurred. Please contact support.',
+            'No handler could be found for the requested resource.'))
+
+    def test_application(self):
+        '''
+        Test to make sure that the wsgi application reads the body of the
+        request and reports the status of the response.
+        '''
+        environment = {}
+        environment['REQUEST_METHOD'] = 'POST'
+        environment['PATH_INFO'] = '/paywallproxy/v1.0.0/json/auth/product01'
+        environment['CONTENT_LENGTH'] = '2'
+        environment['wsgi.input'] = StringIO('{}')
+        result = application(environment, test_start_response)
+        self.assertTrue('InvalidAuthScheme' in result[0])
+
+        # Bodies that are too large or shorter than their length are
+        # rejected.
+        environment['CONTENT_LENGTH'] = '100000'
+        result = application(environment, test_start_response)
+        self.assertTrue('The post body is too large.' in result[0])
+        environment['CONTENT_LENGTH'] = '3'
+        environment['wsgi.input'] = StringIO('{}')
+        result = application(environment, test_start_response)
+        self.assertTrue('The post body is incomplete.' in result[0])
+
 
 # If the script is called directly, then the global variable __name__ will
 # be set to main.